@@ -8,6 +8,9 @@ class Args:
         # parser.add_argument('-w', '--white', action='store_true', help='Calibrate white tape level')
         parser.add_argument('-t', '--print-teensy-info', action='store_true', help='Print teensy info to console')
         parser.add_argument('-n', '--now', action='store_true', help='Start drive now (do not wait for start button)')
+        parser.add_argument('-c', '--conflate', action='store_true', help='Handle MQTT messages on a separate thread, dropping stale pose/vel/gyro samples')
+        parser.add_argument('-s', '--simulate', action='store_true', help='Use an in-process broker and simulated Teensy instead of the robot')
+        parser.add_argument('--log-enqueue', action='store_true', help='Write the log files from a background thread')
         parser.add_argument(
             '-l', 
             '--log-level', 
@@ -0,0 +1,182 @@
+import numpy as np
+
+
+class RingBuffer:
+  """
+  Fixed capacity history of samples in a preallocated numpy array: one row per sample,
+  one column per field, the first column is the timestamp (sec) and must not decrease.
+
+  With statistics, mean and variance of every field over the samples in the buffer are kept up to date
+  on append, so reading them is O(1). Without, append only stores the row and they are computed from
+  the buffer when read (O(n)). Min and max are computed when read and kept until the next append.
+  Append from one thread only (the MQTT thread), a reader running at the same time may see the newest
+  row half written.
+  """
+
+  def __init__(self, fields, capacity, statistics=True):
+    self.fields = tuple(fields)
+    self.capacity = capacity
+    self.statistics = statistics
+    self.data = np.zeros((capacity, len(self.fields)))
+    self.count = 0
+
+    # Running statistics of the value fields (every field after the timestamp)
+    width = len(self.fields) - 1
+    self.sum = [0.0] * width
+    self.sum_sq = [0.0] * width
+    # (count, min, max) of the last min()/max() read, replaced as a whole so readers need no lock
+    self.extrema = (0, [np.nan] * width, [np.nan] * width)
+
+
+  def __len__(self):
+    return min(self.count, self.capacity)
+
+
+  def index(self, field):
+    return self.fields.index(field)
+
+
+  def append(self, row):
+    """
+    Append one sample, row has a value for every field, timestamp first
+    """
+    i = self.count % self.capacity
+    if not self.statistics:
+      self.data[i] = row
+      self.count += 1
+      return
+
+    old = self.data[i, 1:].tolist() if self.count >= self.capacity else None
+    self.data[i] = row
+    new = self.data[i, 1:].tolist()
+
+    sums = self.sum
+    sums_sq = self.sum_sq
+    if old is None:
+      for j, v in enumerate(new):
+        sums[j] += v
+        sums_sq[j] += v * v
+    else:
+      for j, v in enumerate(new):
+        o = old[j]
+        sums[j] += v - o
+        sums_sq[j] += v * v - o * o
+
+    self.count += 1
+    if self.count % self.capacity == 0:
+      self.__resum()
+
+
+  def __resum(self):
+    # Recompute the sums once per turn of the buffer, so rounding errors do not accumulate
+    values = self.data[:, 1:]
+    self.sum = values.sum(axis=0).tolist()
+    self.sum_sq = (values * values).sum(axis=0).tolist()
+
+
+  def clear(self):
+    self.__init__(self.fields, self.capacity, self.statistics)
+
+
+  ##### HISTORY #####
+
+  def latest(self):
+    """
+    Copy of the newest row, None when empty
+    """
+    if self.count == 0:
+      return None
+    return self.data[(self.count - 1) % self.capacity].copy()
+
+
+  def last(self, n):
+    """
+    Copy of the newest n rows (or less if not available), oldest first
+    """
+    n = min(n, len(self))
+    if n <= 0:
+      return self.data[:0].copy()
+
+    end = self.count % self.capacity
+    start = end - n
+    if start >= 0:
+      return self.data[start:end].copy()
+    return np.concatenate((self.data[start:], self.data[:end]))
+
+
+  def window(self, seconds, end_time=None):
+    """
+    Copy of the rows with a timestamp within seconds before end_time (default: newest timestamp), oldest first
+    """
+    if self.count == 0:
+      return self.last(0)
+    if end_time is None:
+      end_time = self.data[(self.count - 1) % self.capacity, 0]
+    start_time = end_time - seconds
+
+    # The buffer holds two sorted runs: [head:] (older) and [:head] (newer)
+    head = self.count % self.capacity if self.count >= self.capacity else 0
+    newer = self.data[:head, 0] if head > 0 else self.data[:len(self), 0]
+    older = self.data[head:, 0] if head > 0 else newer[:0]
+    n = len(newer) - np.searchsorted(newer, start_time, side='right')
+    n += len(older) - np.searchsorted(older, start_time, side='right')
+
+    rows = self.last(n)
+    return rows[rows[:, 0] <= end_time]
+
+
+  ##### STATISTICS #####
+  # Over every sample in the buffer, field is a field name or None for all value fields
+
+  def __select(self, values, field):
+    if field is None:
+      return np.array(values)
+    return values[self.fields.index(field) - 1]
+
+
+  def __computed(self, function, field):
+    # Without running statistics, over the value fields of the rows in the buffer
+    if len(self) == 0:
+      return self.__select([np.nan] * len(self.sum), field)
+    return self.__select(function(self.data[:len(self), 1:], axis=0), field)
+
+
+  def mean(self, field=None):
+    if not self.statistics:
+      return self.__computed(np.mean, field)
+    n = len(self)
+    if n == 0:
+      return self.__select([np.nan] * len(self.sum), field)
+    return self.__select([s / n for s in self.sum], field)
+
+
+  def var(self, field=None):
+    if not self.statistics:
+      return self.__computed(np.var, field)
+    n = len(self)
+    if n == 0:
+      return self.__select([np.nan] * len(self.sum), field)
+    return self.__select([max(0.0, sq / n - (s / n) ** 2) for s, sq in zip(self.sum, self.sum_sq)], field)
+
+
+  def std(self, field=None):
+    return np.sqrt(self.var(field))
+
+
+  def __extrema(self):
+    # Recomputed on the first read after an append, off the appending thread
+    count = self.count
+    extrema = self.extrema
+    if extrema[0] != count:
+      values = self.data[:len(self), 1:]
+      extrema = (count, values.min(axis=0).tolist(), values.max(axis=0).tolist())
+      self.extrema = extrema
+    return extrema
+
+
+  def min(self, field=None):
+    return self.__select(self.__extrema()[1], field)
+
+
+  def max(self, field=None):
+    return self.__select(self.__extrema()[2], field)
@@ -0,0 +1,43 @@
+import math
+
+
+class RunningStats:
+  """
+  Streaming mean and variance per axis (Welford's algorithm), without allocations per sample
+  """
+  __slots__ = ('count', 'mean', 'm2')
+
+  def __init__(self, size):
+    self.count = 0
+    self.mean = [0.0] * size
+    self.m2 = [0.0] * size
+
+
+  def update(self, values, start=0):
+    """
+    Add one sample, the axes are values[start:start + size]
+    """
+    self.count += 1
+    n = self.count
+    mean = self.mean
+    m2 = self.m2
+    for i in range(len(mean)):
+      x = values[start + i]
+      delta = x - mean[i]
+      mean[i] += delta / n
+      m2[i] += delta * (x - mean[i])
+
+
+  def variance(self, axis):
+    return self.m2[axis] / (self.count - 1) if self.count > 1 else 0.0
+
+
+  def std(self, axis):
+    return math.sqrt(self.variance(axis))
+
+
+  def reset(self):
+    self.count = 0
+    for i in range(len(self.mean)):
+      self.mean[i] = 0.0
+      self.m2[i] = 0.0
@@ -1,47 +1,122 @@
 from abc import ABC, abstractmethod
+from threading import Event
 import time
-from libs.services.mqtt_service import mqtt_service
+from libs.clock import clock
 from libs.logger import Logger
+from libs.base.ring_buffer import RingBuffer
+from libs.services.payload_parser import TEENSY_SCHEMAS
 
 
 class Sensor(ABC):
-  SLEEP_WAIT_SEC = 0.01
-  PRINT_CYCLES = 0.5/SLEEP_WAIT_SEC
+  QOS = {} # subscription qos per subtopic, default 0
+  HISTORY_CAPACITY = 1000 # samples kept per stream, 10 s at 100 Hz
+  WAIT_TIMEOUT_SEC = 10
+  WAIT_PRINT_SEC = 0.5
+  DECODE_ERROR_LOG_EVERY = 1000
+  SNAPSHOT_TIMEOUT_SEC = 0.1 # an update takes microseconds, longer means the updating thread is stuck
 
 
-  def wait_for_data(self, name):
-    self.logger = Logger(name)
-    self.logger.info('Starting...')
-    self.__wait_for_data()
-    self.logger.info("Initiated")
+  def __init__(self, name):
+    self.name = name
+    # Set on the first valid sample
+    self.ready = Event()
+    self.ready_time = None
+    self.router = None
+    # Incremented before and after every sample update, odd while the MQTT thread is updating
+    self.sequence = 0
+    self.decode_error_counter = 0
 
 
-  def __wait_for_data(self):
-    # Wait for data
-    loops = 0
-    while not mqtt_service.stopped and self._is_no_data():
-      time.sleep(self.SLEEP_WAIT_SEC)
+  def wait_for_data(self, timeout=WAIT_TIMEOUT_SEC):
+    """
+    Wait for the first valid sample, returns False on timeout
+    """
+    return not wait_for_sensors([self], timeout)
+
+
+  def _after_ready(self):
+    """
+    Called from wait_for_sensors, on the waiting thread, once the sensor has data
+    """
+    pass
+
+
+  def snapshot(self):
+    """
+    Immutable, self-consistent copy of the latest samples and their timestamps
+    """
+    return snapshot(self)[0]
 
-      if loops % self.PRINT_CYCLES == 0:
-        self.logger.error(f"No data received after {loops*self.SLEEP_WAIT_SEC:.2f}s (continues...)")
-      loops += 1
 
-  
+  def _sequenced(self, handler):
+    """
+    Wraps a decode handler between the sequence increments used by snapshot().
+    A decoder error is logged and dropped, it neither leaves the sequence odd nor stops the MQTT loop
+    """
+    def update(payload):
+      self.sequence += 1
+      try:
+        handler(payload)
+      except Exception as e:
+        self.decode_error_counter += 1
+        logger = getattr(self, 'logger', None)
+        # The first errors and then every DECODE_ERROR_LOG_EVERY, a broken stream fails 100 times a second
+        if logger is not None and (self.decode_error_counter <= 10 or self.decode_error_counter % self.DECODE_ERROR_LOG_EVERY == 0):
+          logger.exception(f"Decoding failed ({self.decode_error_counter} errors): {e}")
+      finally:
+        self.sequence += 1
+    return update
+
+
+  def __check_ready(self, payload):
+    # Registered after the decode handlers, until the first valid sample
+    if self.ready.is_set() or self._is_no_data():
+      return
+
+    self.ready_time = clock.now()
+    self.ready.set()
+    for subtopic in self._handlers():
+      self.router.unregister(subtopic, self.__check_ready)
+
   def _update_sampling_time(self, curr_time, prev_time, update_counter, prev_sampling_time):
     """
-    Update sampling rate estimation
+    Update sampling rate estimation, times are float seconds.
+    update_counter is the number of samples received before this one
     """
-    delta_t = (curr_time - prev_time).total_seconds()
-    if update_counter == 2:
+    if update_counter == 0:
+      # First sample, there is no previous sample to compare with
+      return prev_sampling_time
+
+    delta_t = curr_time - prev_time
+    if update_counter == 1:
       return delta_t
     else:
       # Use exponential moving average to update delta_t
       return (prev_sampling_time * 99 + delta_t) / 100
 
 
-  def _print_mqtt_debug(self, topic, msg):
+  def _create_history(self, subtopic, fields=None, statistics=True):
+    """
+    Ring buffer for the samples of subtopic, the columns are the payload fields (time first).
+    statistics=False skips the running mean and variance, for a stream nobody reads them from
+    """
+    return RingBuffer(TEENSY_SCHEMAS[subtopic] if fields is None else fields, self.HISTORY_CAPACITY, statistics)
+
+
+  def register(self, router):
+    """
+    Register the decode handlers for the subtopics owned by this sensor
+    """
+    self.router = router
+    for subtopic, handler in self._handlers().items():
+      router.register(subtopic, self._sequenced(handler), self.QOS.get(subtopic, 0))
+      router.register(subtopic, self.__check_ready)
+
+
+  def _print_mqtt_debug(self, topic, values):
     try:
-      self.logger.debug(f"Decoding MQTT message: topic={topic}, msg={msg.rstrip()}")
+      # Formatted by loguru only when debug is enabled
+      self.logger.debug("Decoding MQTT message: topic={}, msg={}", topic, values)
     except:
       pass
 
@@ -55,8 +130,78 @@ class Sensor(ABC):
 
 
   @abstractmethod
-  def decode(self, topic, msg):
+  def _snapshot(self):
     """
-    Handle the reception of mqtt messages
+    Should return an immutable copy of the latest samples with their timestamps (a namedtuple)
     """
-    return msg.split(" ")
\ No newline at end of file
+    pass
+
+
+  @abstractmethod
+  def _handlers(self):
+    """
+    Should return {subtopic: handler(payload)} for every subtopic decoded by this sensor
+    """
+    pass
+
+
+
+def wait_for_sensors(sensors, timeout=Sensor.WAIT_TIMEOUT_SEC):
+  """
+  Wait for the first valid sample of every sensor at once, at most timeout seconds in total.
+  Logs when each sensor got ready and returns the names of the sensors still without data
+  """
+  start = clock.now()
+  deadline = start + timeout
+  waiting = list(sensors)
+  for sensor in waiting:
+    sensor.logger = Logger(sensor.name)
+    sensor.logger.info('Starting...')
+
+  while True:
+    waiting = [sensor for sensor in waiting if not sensor.ready.is_set()]
+    remaining = deadline - clock.now()
+    if not waiting or remaining <= 0:
+      break
+
+    # Wakes up as soon as the first waiting sensor is ready, or regularly to report the missing ones
+    if not waiting[0].ready.wait(min(Sensor.WAIT_PRINT_SEC, remaining)) and clock.now() < deadline:
+      for sensor in waiting:
+        if not sensor.ready.is_set():
+          sensor.logger.error(f"No data received after {clock.now() - start:.2f}s (continues...)")
+
+  for sensor in sensors:
+    if sensor.ready.is_set():
+      sensor._after_ready()
+      sensor.logger.info(f"Initiated, first data after {max(0.0, sensor.ready_time - start) * 1000:.0f} ms")
+
+  missing = [sensor.name for sensor in waiting]
+  for sensor in waiting:
+    sensor.logger.error(f"No data received within {timeout}s")
+  return missing
+
+
+
+def snapshot(*sensors):
+  """
+  Snapshots of one or more sensors read together: none of them was updated while they were copied.
+  Lock free, the copy is repeated when the MQTT thread updated a sensor in the meantime. After
+  SNAPSHOT_TIMEOUT_SEC of retries the last copy is returned unchecked, so readers never hang
+  """
+  deadline = None
+  while True:
+    sequences = [sensor.sequence for sensor in sensors]
+    if not any(sequence & 1 for sequence in sequences):
+      snapshots = tuple(sensor._snapshot() for sensor in sensors)
+      if all(sensor.sequence == sequence for sensor, sequence in zip(sensors, sequences)):
+        return snapshots
+
+    if deadline is None:
+      deadline = clock.now() + Sensor.SNAPSHOT_TIMEOUT_SEC
+    elif clock.now() > deadline:
+      names = ', '.join(sensor.name for sensor in sensors)
+      Logger('sensor').warning(f"Snapshot of {names} not consistent after {Sensor.SNAPSHOT_TIMEOUT_SEC} s, using the latest values")
+      return tuple(sensor._snapshot() for sensor in sensors)
+
+    # An update is in progress, let the MQTT thread finish it
+    time.sleep(0)
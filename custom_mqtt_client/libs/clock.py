@@ -0,0 +1,139 @@
+from collections import deque
+from time import monotonic, time
+
+
+class Clock:
+  """
+  One time base for the whole client: float seconds of time.monotonic().
+
+  teensy_interface stamps every message with its wall clock (epoch sec), wall_to_host() moves
+  those stamps onto the monotonic base with the wall offset estimated at startup. The offset is
+  only re-estimated when the heartbeats show a wall clock step (e.g. NTP after boot) that persists
+  for WALL_WINDOW_SEC, so the transport delay of the samples stays measurable.
+  The Teensy has its own clock (sec since boot, sent in T0/hbt, T0/pose and T0/vel), its offset
+  and drift to the host are estimated from the heartbeats.
+  """
+  DRIFT_FORGETTING = 0.99 # weight of the older heartbeats in the drift fit, about 100 heartbeats
+  OFFSET_WINDOW = 30      # heartbeats searched for the one with the smallest transport delay
+  WALL_STEP_SEC = 0.1     # heartbeats further than this from the wall offset are a possible wall clock step
+  WALL_WINDOW_SEC = 30.0  # a step is taken over once every heartbeat showed it for this long
+
+
+  def __init__(self):
+    # The offset of this host's wall clock, teensy_interface runs on the same host
+    self.wall_offset = time() - monotonic()
+    # Host time of the first heartbeat showing the current possible step, None without one
+    self.wall_step_since = None
+    # wall - recv of the least delayed heartbeat since then
+    self.wall_step_offset = 0.0
+    self.wall_step_counter = 0
+    self.reset_teensy()
+
+
+  def now(self):
+    return monotonic()
+
+
+  def wall_to_host(self, wall_time):
+    return wall_time - self.wall_offset
+
+
+  def host_to_wall(self, host_time):
+    return host_time + self.wall_offset
+
+
+  def update_wall(self, wall_time, recv_time):
+    """
+    Called for every heartbeat with its teensy_interface stamp and the host time it was received.
+    The sample delay is measured against the wall offset, it is not re-derived from the samples:
+    only a deviation in the same direction for WALL_WINDOW_SEC moves the offset, to the least
+    delayed heartbeat of that time
+    """
+    d = wall_time - recv_time
+    deviation = d - self.wall_offset
+    if abs(deviation) <= self.WALL_STEP_SEC:
+      self.wall_step_since = None
+      return
+
+    since = self.wall_step_since
+    if since is None or (deviation > 0) != (self.wall_step_offset > self.wall_offset):
+      self.wall_step_since = recv_time
+      self.wall_step_offset = d
+      return
+
+    self.wall_step_offset = max(self.wall_step_offset, d)
+    if recv_time - since >= self.WALL_WINDOW_SEC:
+      # Reported in the telemetry (stats)
+      self.wall_step_counter += 1
+      self.wall_offset = self.wall_step_offset
+      self.wall_step_since = None
+
+
+  ##### TEENSY CLOCK #####
+
+  def reset_teensy(self):
+    self.teensy_update_counter = 0
+    self.teensy_drift = 0.0
+    # First heartbeat (teensy time, host time), the fit is relative to it to keep the sums small
+    self.teensy_origin = None
+    # Offset of the host clock to the Teensy clock at the first heartbeat
+    self.teensy_offset = 0.0
+    self.teensy_samples = deque(maxlen=self.OFFSET_WINDOW)
+    # Weighted sums of the drift fit: weight, t, d, t*t, t*d
+    self.fit = [0.0, 0.0, 0.0, 0.0, 0.0]
+
+
+  def update_teensy(self, teensy_time, host_time):
+    """
+    Called for every heartbeat with the Teensy time it carries and the host time it was received
+    """
+    if self.teensy_origin is not None and teensy_time < self.teensy_origin[0]:
+      # The Teensy restarted
+      self.reset_teensy()
+    if self.teensy_origin is None:
+      self.teensy_origin = (teensy_time, host_time)
+
+    # Fit host - teensy = offset + drift * teensy
+    t = teensy_time - self.teensy_origin[0]
+    d = host_time - self.teensy_origin[1] - t
+
+    f = self.DRIFT_FORGETTING
+    fit = self.fit
+    fit[0] = fit[0] * f + 1
+    fit[1] = fit[1] * f + t
+    fit[2] = fit[2] * f + d
+    fit[3] = fit[3] * f + t * t
+    fit[4] = fit[4] * f + t * d
+    denominator = fit[0] * fit[3] - fit[1] * fit[1]
+    if denominator > 1e-9:
+      self.teensy_drift = (fit[0] * fit[4] - fit[1] * fit[2]) / denominator
+
+    # Every heartbeat is delayed by the transport, the least delayed one gives the offset
+    self.teensy_samples.append((t, d))
+    self.teensy_offset = min(d - self.teensy_drift * t for t, d in self.teensy_samples)
+    self.teensy_update_counter += 1
+
+
+  def teensy_to_host(self, teensy_time):
+    """
+    Host time of a Teensy timestamp, teensy_time itself before the first heartbeat
+    """
+    if self.teensy_origin is None:
+      return teensy_time
+    t = teensy_time - self.teensy_origin[0]
+    return self.teensy_origin[1] + t + self.teensy_offset + self.teensy_drift * t
+
+
+  def stats(self):
+    return {
+      'teensy_heartbeats': self.teensy_update_counter,
+      # host time - Teensy time, at the first heartbeat
+      'teensy_offset_sec': self.teensy_origin[1] + self.teensy_offset - self.teensy_origin[0] if self.teensy_origin is not None else None,
+      'teensy_drift_ppm': self.teensy_drift * 1e6,
+      'wall_offset_sec': self.wall_offset,
+      'wall_steps': self.wall_step_counter,
+    }
+
+
+
+clock = Clock()
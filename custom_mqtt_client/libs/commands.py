@@ -1,5 +1,6 @@
 from libs.services.mqtt_service import mqtt_service
 from modules.line_follower.line_follower import line_follower
+from modules.line_follower.manoeuvre_engine import manoeuvre_engine
 from time import sleep, time
 # from threading import Thread
 
@@ -9,7 +10,7 @@ def LED_set_color(number: int, r: int, g: int, b: int):
     Sets the desired led to the desired color.
     Example: set_led(LED_MISSION, 30, 30, 0), sets the LED 16 to yellow
     """
-    mqtt_service.send_cmd("T0/leds", f"{number} {r} {g} {b}")
+    mqtt_service.send_cmd("T0/leds", (number, r, g, b))
 
 
 def LED_off(number):
@@ -64,6 +65,8 @@ def ROBOT_set_movement(forward_velocity: float, turnrate: float, time: float = 0
 
 def ROBOT_stop_movement():
     print("[!] Stopped robot movement")
+    # No manoeuvre step may drive after the stop
+    manoeuvre_engine.cancel()
     ROBOT_set_movement(0, 0)
     line_follower.set_line_control(0)
 
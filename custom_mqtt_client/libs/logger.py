@@ -1,56 +1,181 @@
 from loguru import logger
 from libs.args import arg_parser
+from time import monotonic
 import os
 
 
 
 class Logger():
+  """
+  Logger('name') returns a loguru logger writing to <log_dir>/name.log.
+
+  Loggers are kept in a registry: asking for the same name again returns the same logger,
+  without truncating its file. All names share one loguru sink, which routes every record
+  to its file with a dict lookup, optionally from a background thread (ENQUEUE).
+  """
   LOG_DIR = "/home/local/custom_mqtt_client/logs/"
   LOG_LEVEL = arg_parser.get('log_level')
   FORMAT = "{time:YYYY-MM-DD HH:mm:ss.SSS} | {level} | {message}"
+  ROTATION_BYTES = 500 * 1024 * 1024
+  ENQUEUE = arg_parser.get('log_enqueue') # write the log files from a background thread
+
+  __loggers = {}  # name -> bound logger
+  __files = {}    # name -> [file, path, minimum level number]
+  __sink_id = None
+  __sink_level = None
+
+
+  @staticmethod
+  def is_rpi():
+    return os.uname().machine.startswith("arm") or os.uname().machine.startswith("aarch64")
+
 
-  __logger_initialized = False
+  @classmethod
+  def log_dir(cls):
+    """
+    Folder the log files are written to: LOG_DIR on the Raspberry Pi, logs/ next to the repository elsewhere
+    """
+    if cls.is_rpi():
+      return cls.LOG_DIR
+    return os.path.join(os.path.dirname(__file__), "../../logs/")
 
 
   def __new__(cls, name, log_dir=None, log_level=None):
-    if not cls.__logger_initialized:
+    if name in cls.__loggers:
+      return cls.__loggers[name]
+
+    if cls.__sink_id is None:
       print("Logger:: Initialized for the first time")
       # Remove default stdout handler
       logger.remove()
-      cls.__logger_initialized = True
 
     if log_dir is None:
       log_dir = cls.LOG_DIR
     if log_level is None:
       log_level = cls.LOG_LEVEL
 
+    level = logger.level(log_level).no
+    if cls.__sink_level is None or level < cls.__sink_level:
+      cls.__add_sink(level)
+
     # Check if running on Raspberry Pi
-    is_rpi = os.uname().machine.startswith("arm") or os.uname().machine.startswith("aarch64")
-    if not is_rpi:
+    if not cls.is_rpi():
       print("Logger:: Non-Raspberry Pi environment detected")
-      log_dir = os.path.join(os.path.dirname(__file__), "../../logs/")
+      log_dir = cls.log_dir()
 
     # Define the main log folder
     os.makedirs(log_dir, exist_ok=True)  # Ensure the directory exists
-    
+
     # Set the log path
     log_path = os.path.join(log_dir, name + '.log')
 
     # This will clear the file
-    with open(log_path, 'w'):
-      pass
+    cls.__files[name] = [open(log_path, 'w', buffering=1, encoding="utf-8"), log_path, level]
+
+    my_logger = logger.bind(name=name)
+    cls.__loggers[name] = my_logger
+    my_logger.info("Logger started")
+    return my_logger
+
 
-    def __make_filter(name):
-      def filter(record):
-        return record["extra"].get("name") == name
-      return filter
+  @classmethod
+  def __add_sink(cls, level):
+    """
+    One sink serves every name. Its level is the lowest level of all names, so loguru
+    still drops the records below it before formatting them. The level per name is checked by __dispatch
+    """
+    if cls.__sink_id is not None:
+      logger.remove(cls.__sink_id)
 
-    # logger.add(log_path, colorize=True, filter=__make_filter(name), rotation="500 MB")
     if cls.FORMAT is not None:
-      logger.add(log_path, format=cls.FORMAT, level=log_level, filter=__make_filter(name), rotation="500 MB")
+      cls.__sink_id = logger.add(cls.__dispatch, format=cls.FORMAT, level=level, enqueue=cls.ENQUEUE)
     else:
-      logger.add(log_path, level=log_level, filter=__make_filter(name), rotation="500 MB")
+      cls.__sink_id = logger.add(cls.__dispatch, level=level, enqueue=cls.ENQUEUE)
+    cls.__sink_level = level
 
-    my_logger = logger.bind(name=name)
-    my_logger.info("Logger started")
-    return my_logger
+
+  @classmethod
+  def __dispatch(cls, message):
+    target = cls.__files.get(message.record["extra"].get("name"))
+    if target is None or message.record["level"].no < target[2]:
+      return
+
+    file = target[0]
+    file.write(message)
+    if file.tell() > cls.ROTATION_BYTES:
+      cls.__rotate(target)
+
+
+  @classmethod
+  def __rotate(cls, target):
+    file, log_path, _ = target
+    file.close()
+    os.replace(log_path, log_path + ".1")
+    target[0] = open(log_path, 'w', buffering=1, encoding="utf-8")
+
+
+  @classmethod
+  def complete(cls):
+    """
+    Wait until the queued records are written (only needed with ENQUEUE)
+    and print the pending console suppressed counts
+    """
+    console.flush()
+    logger.complete()
+
+
+
+class Console:
+  """
+  Console output for code running on every tick. A message printed again within INTERVAL_SEC
+  is only counted, the next time it is printed it shows "message (xN suppressed)".
+  The counts of messages that stopped recurring are printed with the next message, or by flush().
+  The message is formatted (str.format with args) only when it is printed.
+  """
+  INTERVAL_SEC = 1.0
+
+
+  def __init__(self, interval=INTERVAL_SEC):
+    self.interval = interval
+    self.last = {} # message -> [last print time, suppressed counter, last args]
+
+
+  def print(self, message, *args):
+    now = monotonic()
+    last = self.last.get(message)
+    if last is not None and now - last[0] < self.interval:
+      last[1] += 1
+      last[2] = args
+      return
+
+    self.__flush_expired(now, message)
+    suppressed = last[1] if last is not None else 0
+    self.last[message] = [now, 0, args]
+    self.__print(message, args, suppressed)
+
+
+  def flush(self):
+    """
+    Print the suppressed counts that are still pending
+    """
+    self.__flush_expired(None)
+
+
+  def __flush_expired(self, now, skip=None):
+    # Only on the printing path, a suppressed print returns before this
+    for message, last in self.last.items():
+      if last[1] > 0 and message != skip and (now is None or now - last[0] >= self.interval):
+        self.__print(message, last[2], last[1])
+        last[1] = 0
+
+
+  @staticmethod
+  def __print(message, args, suppressed):
+    text = message.format(*args) if args else message
+    if suppressed > 0:
+      text = f"{text} (x{suppressed} suppressed)"
+    print(text, flush=True)
+
+
+
+console = Console()
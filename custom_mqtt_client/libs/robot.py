@@ -1,8 +1,10 @@
-from datetime import datetime
+from libs.clock import clock
 
 
 class Robot:
-  hbt_time = datetime.now()
+  hbt_time = clock.now()
+  hbt_recv_time = clock.now()
+  teensy_time = 0.0
   sampling_time = 30.0
   update_counter = 0
   robot_name = "unknown"
@@ -12,27 +14,42 @@ class Robot:
     """
     Update sampling rate estimation
     """
-    delta_t = (self.hbt_time - prev_time).total_seconds()
-    if self.update_counter == 2:
+    if self.update_counter == 0:
+      # First heartbeat, there is no previous one to compare with
+      return
+
+    delta_t = self.hbt_time - prev_time
+    if self.update_counter == 1:
       self.sampling_time = delta_t
     else:
       # Use exponential moving average to update delta_t
       self.sampling_time = (self.sampling_time * 99 + delta_t) / 100
 
 
-  def decode(self, topic, msg):
-    parts = msg.split(" ")
+  def register(self, router):
+    router.register("T0/hbt", self._decode_hbt)
+    router.register("T0/dname", self._decode_dname, qos=1)
+
+
+  def _decode_hbt(self, payload):
+    values = payload.values
+
+    prev_time = self.hbt_time
+    self.hbt_time = values[0]
+    self.hbt_recv_time = payload.recv_time
+    self.teensy_time = values[1]
+    # The heartbeats carry the Teensy clock, used to estimate its offset and drift to the host
+    clock.update_teensy(self.teensy_time, self.hbt_recv_time)
+    # and a step of the wall clock the samples are stamped with
+    clock.update_wall(payload.wall_time, self.hbt_recv_time)
 
-    if topic == "T0/hbt" and len(parts) >= 4:
-      prev_time = self.hbt_time
-      self.hbt_time = datetime.fromtimestamp(float(parts[0]))
+    self.__update_sampling_time(prev_time)
+    self.update_counter += 1
 
-      self.__update_sampling_time(prev_time)
-      self.update_counter += 1
 
-    elif topic == "T0/dname":
-      if len(parts) >= 2:
-        self.robot_name = parts[1]
+  def _decode_dname(self, parts):
+    if len(parts) >= 2:
+      self.robot_name = parts[1]
 
 
 robot = Robot()
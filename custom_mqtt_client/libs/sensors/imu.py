@@ -1,88 +1,232 @@
-from datetime import datetime
+from collections import namedtuple
+import math
 from libs.base.sensor import Sensor
+from libs.base.running_stats import RunningStats
+from libs.clock import clock
+
+
+ImuSnapshot = namedtuple('ImuSnapshot', ['gyro', 'gyro_time', 'gyro_recv_time', 'acc', 'acc_time', 'acc_recv_time', 'orientation'])
+
+
+class ComplementaryFilter:
+  """
+  Orientation [roll, pitch, heading] (rad) integrated from the gyro and pulled towards the references:
+  roll and pitch from the gravity seen by the accelerometer, heading from the Teensy pose.
+  The gyro gives the fast changes, the references remove its drift. The heading is not wrapped.
+  """
+  TILT_TIME_CONSTANT = 0.5    # sec
+  HEADING_TIME_CONSTANT = 2.0 # sec
+  MAX_DT = 0.5                # sec, longer gaps are not integrated
+
+  __slots__ = ('roll', 'pitch', 'heading', 'time', 'acc_roll', 'acc_pitch', 'heading_reference')
+
+  def __init__(self):
+    self.reset()
+
+
+  def reset(self):
+    self.roll = 0.0
+    self.pitch = 0.0
+    self.heading = 0.0
+    self.time = None
+    self.acc_roll = None
+    self.acc_pitch = None
+    self.heading_reference = None
+
+
+  def update_gyro(self, time, wx, wy, wz):
+    """
+    Angular velocities in rad/sec, time in sec
+    """
+    prev_time = self.time
+    self.time = time
+    if prev_time is None:
+      return
+    dt = time - prev_time
+    if dt <= 0 or dt > self.MAX_DT:
+      return
+
+    self.roll += wx * dt
+    self.pitch += wy * dt
+    self.heading += wz * dt
+
+    if self.acc_roll is not None:
+      a = dt / (self.TILT_TIME_CONSTANT + dt)
+      self.roll += a * (self.acc_roll - self.roll)
+      self.pitch += a * (self.acc_pitch - self.pitch)
+
+    if self.heading_reference is not None:
+      a = dt / (self.HEADING_TIME_CONSTANT + dt)
+      self.heading += a * wrap_angle(self.heading_reference - self.heading)
+
+
+  def update_acc(self, ax, ay, az):
+    self.acc_roll = math.atan2(ay, az)
+    self.acc_pitch = math.atan2(-ax, math.sqrt(ay * ay + az * az))
+    if self.time is None:
+      self.roll = self.acc_roll
+      self.pitch = self.acc_pitch
+
+
+  def update_heading(self, heading):
+    if self.heading_reference is None:
+      self.heading = heading
+    self.heading_reference = heading
+
+
+
+def wrap_angle(angle):
+  """
+  Angle wrapped to [-pi, pi)
+  """
+  return (angle + math.pi) % (2 * math.pi) - math.pi
+
 
-import time
 
 class Imu(Sensor):
   gyro = [0.0, 0.0, 0.0]
   gryo_update_counter = 0
-  gyro_time = datetime.now()
+  gyro_time = clock.now()
+  gyro_recv_time = clock.now()
   gyro_sampling_time = 1
 
   acc  = [0.0, 0.0, 0.0]
-  acc_time = datetime.now()
+  acc_time = clock.now()
+  acc_recv_time = clock.now()
   acc_update_counter = 0
   acc_sampling_time = 1
 
+
+  GYRO_UNIT = math.pi / 180 # the Teensy sends deg/sec
+
+
+  def __init__(self):
+    super().__init__('imu')
+    # Corrected by the calibration, like gyro and acc
+    self.gyro_history = self._create_history("T0/gyro")
+    self.acc_history = self._create_history("T0/acc")
+
+    # Streaming calibration, from the first sample until calibrate()
+    self.gyro_calibration = RunningStats(3)
+    self.acc_calibration = RunningStats(3)
+
+    # Fused orientation [roll, pitch, heading] (rad), next to odometry.pose
+    self.fusion = ComplementaryFilter()
+    self.orientation = [0.0, 0.0, 0.0]
+
   ######################################################
   # CALIBRATION
 
+  gyro_bias = [0.0, 0.0, 0.0]         # deg/sec, subtracted from the gyro
   acc_scale_factor = [1.0, 1.0, 1.0]  # Scaling factors for each axis
   is_calibrated = False
-  
-  
-  def calibrate_accelerometer(self, gravity_axis=2, samples=10, expected_gravity=9.81):
+
+  CALIBRATION_SAMPLES = 10       # minimum samples before the sensor is ready
+  MAX_CALIBRATION_GYRO_STD = 1.0 # deg/sec, more means the robot moved while calibrating
+
+
+  def calibrate(self, expected_gravity=9.81):
     """
-    Calibrate the accelerometer using gravity as reference
-    
+    Finish the streaming calibration, the robot must stand still since the first sample:
+    the gyro bias is the mean gyro, the accelerometer scale makes the mean acceleration expected_gravity.
+
     Parameters:
-    - gravity_axis: which axis (0=x, 1=y, 2=z) is aligned with gravity
-    - samples: number of readings to average
     - expected_gravity: the expected gravity value (typically 9.81 m/s²)
-    """ 
-    # Collect samples
-    acc_sum = [0.0, 0.0, 0.0]
-    for _ in range(samples):
-      for i in range(3):
-        acc_sum[i] += self.acc[i]
-      time.sleep(0.01)  # Small delay between readings
-    
-    # Calculate averages
-    acc_avg = [sum_val / samples for sum_val in acc_sum]
-    
-    # Calculate scaling factor for gravity axis
-    self.acc_scale_factor[gravity_axis] = expected_gravity / abs(acc_avg[gravity_axis])
-    
+    """
+    gyro = self.gyro_calibration
+    acc = self.acc_calibration
+    if gyro.count < 2 or acc.count < 2:
+      self.logger.error("Not enough samples to calibrate the IMU")
+      return
+
+    if max(gyro.std(i) for i in range(3)) > self.MAX_CALIBRATION_GYRO_STD:
+      self.logger.warning(f"The robot moved while calibrating, gyro std {[round(gyro.std(i), 3) for i in range(3)]} deg/s")
+
+    self.gyro_bias = list(gyro.mean)
+    gravity = math.sqrt(sum(a * a for a in acc.mean))
+    self.acc_scale_factor = [expected_gravity / gravity] * 3
     self.is_calibrated = True
-  
+    self.logger.info(f"Calibrated from {gyro.count} gyro and {acc.count} acc samples: gyro bias {self.gyro_bias}, acc scale {self.acc_scale_factor[0]:.4f}")
+
   ####################################################################
 
-  def wait_for_data(self):
-    super().wait_for_data('imu')
-    self.calibrate_accelerometer()
+  def _after_ready(self):
+    self.calibrate()
 
 
   def _is_no_data(self):
-    return self.gryo_update_counter == 0 or self.acc_update_counter == 0
+    # Enough accelerometer samples to calibrate
+    return self.gryo_update_counter == 0 or self.acc_update_counter < self.CALIBRATION_SAMPLES
+
+
+  def _snapshot(self):
+    return ImuSnapshot(tuple(self.gyro), self.gyro_time, self.gyro_recv_time, tuple(self.acc), self.acc_time, self.acc_recv_time, tuple(self.orientation))
+
+
+  def _handlers(self):
+    return {
+      "T0/gyro": self._decode_gyro,
+      "T0/acc": self._decode_acc,
+      # Heading reference of the fusion
+      "T0/pose": self._decode_pose_heading,
+    }
+
+
+  def _decode_gyro(self, payload):
+    values = payload.values
+    self._print_mqtt_debug("T0/gyro", values)
+
+    prev_time = self.gyro_time
+    self.gyro_time = values[0]
+    self.gyro_recv_time = payload.recv_time
+    if not self.is_calibrated:
+      self.gyro_calibration.update(values, 1)
+
+    bias = self.gyro_bias
+    gyro = self.gyro
+    gyro[0] = values[1] - bias[0]
+    gyro[1] = values[2] - bias[1]
+    gyro[2] = values[3] - bias[2]
+
+    k = self.GYRO_UNIT
+    self.fusion.update_gyro(self.gyro_time, gyro[0] * k, gyro[1] * k, gyro[2] * k)
+    self.__update_orientation()
+
+    self.gyro_history.append((self.gyro_time, gyro[0], gyro[1], gyro[2]))
+    self.gyro_sampling_time = self._update_sampling_time(self.gyro_time, prev_time, self.gryo_update_counter, self.gyro_sampling_time)
+    self.gryo_update_counter += 1
+
 
+  def _decode_acc(self, payload):
+    values = payload.values
+    self._print_mqtt_debug("T0/acc", values)
 
-  def decode(self, topic, msg):
-    parts = super().decode(topic, msg)
+    prev_time = self.acc_time
+    self.acc_time = values[0]
+    self.acc_recv_time = payload.recv_time
+    if not self.is_calibrated:
+      self.acc_calibration.update(values, 1)
 
-    if topic == "T0/gyro" and len(parts) >= 4:
-      self._print_mqtt_debug(topic, msg)
+    self.acc[0] = values[1] * self.acc_scale_factor[0]
+    self.acc[1] = values[2] * self.acc_scale_factor[1]
+    self.acc[2] = values[3] * self.acc_scale_factor[2]
+    self.fusion.update_acc(self.acc[0], self.acc[1], self.acc[2])
+    self.acc_history.append((self.acc_time, self.acc[0], self.acc[1], self.acc[2]))
 
-      prev_time = self.gyro_time
-      self.gyro_time = datetime.fromtimestamp(float(parts[0]))
-      self.gyro[0] = float(parts[1])
-      self.gyro[1] = float(parts[2])
-      self.gyro[2] = float(parts[3])
+    self.acc_sampling_time = self._update_sampling_time(self.acc_time, prev_time, self.acc_update_counter, self.acc_sampling_time)
+    self.acc_update_counter += 1
 
-      self.gyro_sampling_time = self._update_sampling_time(self.gyro_time, prev_time, self.gryo_update_counter, self.gyro_sampling_time)
-      self.gryo_update_counter += 1
 
-    elif topic == "T0/acc" and len(parts) >= 4:
-      self._print_mqtt_debug(topic, msg)
+  def _decode_pose_heading(self, payload):
+    self.fusion.update_heading(payload.values[4])
 
-      prev_time = self.acc_time
-      self.acc_time = datetime.fromtimestamp(float(parts[0]))
-      self.acc[0] = float(parts[1]) * self.acc_scale_factor[0]
-      self.acc[1] = float(parts[2]) * self.acc_scale_factor[1]
-      self.acc[2] = float(parts[3]) * self.acc_scale_factor[2]
-      #print(self.acc)
 
-      self.acc_sampling_time = self._update_sampling_time(self.acc_time, prev_time, self.acc_update_counter, self.acc_sampling_time)
-      self.acc_update_counter += 1
+  def __update_orientation(self):
+    fusion = self.fusion
+    orientation = self.orientation
+    orientation[0] = fusion.roll
+    orientation[1] = fusion.pitch
+    orientation[2] = fusion.heading
 
 
 
@@ -1,18 +1,24 @@
-from datetime import datetime
+from collections import namedtuple
 from typing import Literal
 from libs.base.sensor import Sensor
+from libs.clock import clock
+
+
+IrSnapshot = namedtuple('IrSnapshot', ['ir', 'time', 'recv_time'])
 
 
 class IrSensor(Sensor):
   ir = [0.0, 0.0]
   ir_update_counter = 0
-  ir_time = datetime.now()
+  ir_time = clock.now()
+  ir_recv_time = clock.now()
   ir_sampling_time = 0
   OBJECT_DETECTION_THRESHOLD = 0.3  #actually 27 cm
 
 
-  def wait_for_data(self):
-    super().wait_for_data('ir')
+  def __init__(self):
+    super().__init__('ir')
+    self.history = self._create_history("T0/ird")
 
 
   def _is_no_data(self):
@@ -33,19 +39,27 @@ class IrSensor(Sensor):
     return self.ir[0] < self.OBJECT_DETECTION_THRESHOLD
 
 
-  def decode(self, topic, msg):
-    parts = super().decode(topic, msg)
+  def _snapshot(self):
+    return IrSnapshot(tuple(self.ir), self.ir_time, self.ir_recv_time)
+
+
+  def _handlers(self):
+    return {"T0/ird": self._decode_ir}
+
 
-    if topic == "T0/ird" and len(parts) >= 3:
-      self._print_mqtt_debug(topic, msg)
+  def _decode_ir(self, payload):
+    values = payload.values
+    self._print_mqtt_debug("T0/ird", values)
 
-      prev_time = self.ir_time
-      self.ir_time = datetime.fromtimestamp(float(parts[0]))
-      self.ir[0] = float(parts[1])
-      self.ir[1] = float(parts[2])
+    prev_time = self.ir_time
+    self.ir_time = values[0]
+    self.ir_recv_time = payload.recv_time
+    self.ir[0] = values[1]
+    self.ir[1] = values[2]
 
-      self.ir_sampling_time = self._update_sampling_time(self.ir_time, prev_time, self.ir_update_counter, self.ir_sampling_time)
-      self.ir_update_counter += 1
+    self.history.append(values)
+    self.ir_sampling_time = self._update_sampling_time(self.ir_time, prev_time, self.ir_update_counter, self.ir_sampling_time)
+    self.ir_update_counter += 1
 
 
 ir = IrSensor()
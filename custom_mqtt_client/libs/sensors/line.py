@@ -1,5 +1,10 @@
-from datetime import datetime
+from array import array
+from collections import namedtuple
 from libs.base.sensor import Sensor
+from libs.clock import clock
+
+
+LineSnapshot = namedtuple('LineSnapshot', ['values', 'time', 'recv_time', 'update_count'])
 
 
 class Line(Sensor):
@@ -7,39 +12,45 @@ class Line(Sensor):
   CALIBRATED_WHITE_LEVEL = 1000
 
   # Normalized values after calibration (black=0 - white=1000)
-  values = [0] * NUM_OF_SENSORS
+  values = array('d', [0.0]) * NUM_OF_SENSORS
   update_count = 0
-  sensor_time = datetime.now()
+  sensor_time = clock.now()
+  sensor_recv_time = clock.now()
   sampling_time = 0
 
 
-  def wait_for_data(self):
-    super().wait_for_data('line')
+  def __init__(self):
+    super().__init__('line')
+    self.history = self._create_history("T0/livn")
 
 
   def _is_no_data(self):
     return self.update_count == 0
 
 
-  def decode(self, topic, msg):
-    parts = super().decode(topic, msg)
+  def _snapshot(self):
+    return LineSnapshot(tuple(self.values), self.sensor_time, self.sensor_recv_time, self.update_count)
 
-    # Line sensor with normalized values
-    if topic == "T0/livn" and len(parts) >= 4:
-      self._print_mqtt_debug(topic, msg)
 
-      prev_time = self.sensor_time
-      self.sensor_time = datetime.fromtimestamp(float(parts[0]))
+  def _handlers(self):
+    return {"T0/livn": self._decode_line}
 
-      for i in range(self.NUM_OF_SENSORS):
-        self.values[i] = int(parts[i+1])
 
-      self.sampling_time = self._update_sampling_time(self.sensor_time, prev_time, self.update_count, self.sampling_time)
-      self.update_count += 1
+  def _decode_line(self, payload):
+    # Line sensor with normalized values
+    values = payload.values
+    self._print_mqtt_debug("T0/livn", values)
+
+    prev_time = self.sensor_time
+    self.sensor_time = values[0]
+    self.sensor_recv_time = payload.recv_time
 
-      return True
+    for i in range(self.NUM_OF_SENSORS):
+      self.values[i] = values[i+1]
 
-    return False
+    self.history.append(values)
+    self.sampling_time = self._update_sampling_time(self.sensor_time, prev_time, self.update_count, self.sampling_time)
+    self.update_count += 1
 
 
 
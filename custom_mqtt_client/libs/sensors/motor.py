@@ -1,38 +1,52 @@
-from datetime import datetime
+from collections import namedtuple
 from libs.base.sensor import Sensor
+from libs.clock import clock
+
+
+MotorSnapshot = namedtuple('MotorSnapshot', ['data', 'time', 'recv_time'])
 
 
 class Motor(Sensor):
   data = [0.0, 0.0, 0.0, 0.0, 0.0]
   update_counter = 0
-  time= datetime.now()
+  time = clock.now()
+  recv_time = clock.now()
   sampling_time = 0
 
 
-  def wait_for_data(self):
-    super().wait_for_data('mot')
+  def __init__(self):
+    super().__init__('mot')
+    self.history = self._create_history("T0/mot")
 
 
   def _is_no_data(self):
     return self.update_counter == 0
 
 
-  def decode(self, topic, msg):
-    parts = super().decode(topic, msg)
+  def _snapshot(self):
+    return MotorSnapshot(tuple(self.data), self.time, self.recv_time)
+
+
+  def _handlers(self):
+    return {"T0/mot": self._decode_motor}
+
 
-    if topic == "T0/mot" and len(parts) >= 6:
-      self._print_mqtt_debug(topic, msg)
+  def _decode_motor(self, payload):
+    values = payload.values
+    self._print_mqtt_debug("T0/mot", values)
 
-      prev_time = self.time
-      self.time= datetime.fromtimestamp(float(parts[0]))
-      self.data[0] = float(parts[1])
-      self.data[1] = float(parts[2])
-      self.data[2] = float(parts[3])
-      self.data[3] = float(parts[4])
-      self.data[4] = float(parts[5])
+    prev_time = self.time
+    self.time = values[0]
+    self.recv_time = payload.recv_time
+    self.data[0] = values[1]
+    self.data[1] = values[2]
+    self.data[2] = values[3]
+    self.data[3] = values[4]
+    self.data[4] = values[5]
 
-      self.sampling_time = self._update_sampling_time(self.time, prev_time, self.update_counter, self.sampling_time)
-      self.update_counter += 1
+    self.history.append(values)
+    self.sampling_time = self._update_sampling_time(self.time, prev_time, self.update_counter, self.sampling_time)
+    self.update_counter += 1
 
   
   def get_voltages(self):
@@ -1,41 +1,157 @@
-from datetime import datetime
+from collections import namedtuple
+import math
 import numpy as np
-from datetime import datetime
 from libs.base.sensor import Sensor
+from libs.clock import clock
+from libs.sensors.imu import imu
 from libs.services.mqtt_service import mqtt_service
 
 
+OdometrySnapshot = namedtuple('OdometrySnapshot', [
+  'pose', 'pose_time', 'pose_recv_time',
+  'wheel_velocities', 'wheel_velocity_time',
+  'motor_velocities', 'motor_velocity_time',
+  'total_dist', 'total_heading', 'trip_dist', 'trip_heading',
+  'fused_pose', 'fused_pose_covariance', 'fused_pose_time',
+])
+
+
+class PoseEkf:
+  """
+  Extended Kalman filter of the planar pose, state [x (m), y (m), heading (rad), velocity (m/s), turnrate (rad/s)].
+
+  The state is predicted with constant velocity and turnrate to the timestamp of every measurement.
+  The wheel velocities (T0/vel) measure velocity and turnrate, the gyro (T0/gyro) measures turnrate.
+  Every measurement is one state, so the updates are scalar and need no matrix inversion.
+  The heading is not wrapped.
+  """
+  STATE_SIZE = 5
+
+  # Process noise (standard deviation per sqrt(sec))
+  POSITION_NOISE = 0.005  # m, wheel slip
+  HEADING_NOISE = 0.005   # rad
+  ACCELERATION = 1.0      # m/s², change of velocity
+  TURN_ACCELERATION = 5.0 # rad/s², change of turnrate
+
+  # Measurement noise (standard deviation)
+  VELOCITY_NOISE = 0.02       # m/s
+  WHEEL_TURNRATE_NOISE = 0.2  # rad/s, the wheels slip when turning
+  GYRO_NOISE = 0.02           # rad/s
+
+
+  def __init__(self):
+    self.q = np.diag([self.POSITION_NOISE, self.POSITION_NOISE, self.HEADING_NOISE, self.ACCELERATION, self.TURN_ACCELERATION]) ** 2
+    self.jacobian = np.eye(self.STATE_SIZE)
+    self.reset()
+
+
+  def reset(self, time=None):
+    """
+    Pose (0, 0, 0) with no uncertainty, unknown velocity and turnrate
+    """
+    self.state = np.zeros(self.STATE_SIZE)
+    self.covariance = np.diag([0.0, 0.0, 0.0, 1.0, 1.0])
+    self.time = time
+    self.update_counter = 0
+
+
+  def predict(self, time):
+    """
+    Move the state to time (sec). A sample older than the state is used as if it was taken now
+    """
+    if self.time is None:
+      self.time = time
+      return
+    dt = time - self.time
+    if dt <= 0:
+      return
+    self.time = time
+
+    state = self.state
+    heading = state[2]
+    v = state[3]
+    c = math.cos(heading)
+    s = math.sin(heading)
+    state[0] += v * c * dt
+    state[1] += v * s * dt
+    state[2] += state[4] * dt
+
+    f = self.jacobian
+    f[0, 2] = -v * s * dt
+    f[0, 3] = c * dt
+    f[1, 2] = v * c * dt
+    f[1, 3] = s * dt
+    f[2, 4] = dt
+    self.covariance = f @ self.covariance @ f.T + self.q * dt
+
+
+  def update(self, index, value, noise):
+    """
+    Measurement of state[index], noise is its standard deviation
+    """
+    p = self.covariance
+    gain = p[:, index] / (p[index, index] + noise * noise)
+    self.state += gain * (value - self.state[index])
+    self.covariance = p - np.outer(gain, p[index])
+    self.update_counter += 1
+
+
+  def update_wheels(self, time, left, right, wheel_base):
+    self.predict(time)
+    self.update(3, (left + right) / 2, self.VELOCITY_NOISE)
+    self.update(4, (right - left) / wheel_base, self.WHEEL_TURNRATE_NOISE)
+
+
+  def update_gyro(self, time, turnrate):
+    self.predict(time)
+    self.update(4, turnrate, self.GYRO_NOISE)
+
+
 class Odometry(Sensor):
+  # The configuration is rarely published and must not be lost
+  QOS = {"T0/conf": 1}
+
   # Motor velocities [left (rad/sec), right (rad/sec)]
   motor_velocities = [0.0, 0.0] # in radians/sec
-  motor_velocity_time = datetime.now()
+  motor_velocity_time = clock.now()
+  motor_velocity_recv_time = clock.now()
   motor_velocity_update_counter = 0
   motor_velocity_sampling_time = 1000 # sec
 
   # Wheel velocities [left (m/sec), right (m/sec)]
   wheel_velocities = [0.0, 0.0] # in m/sec - if gearing and wheel radius is correct
-  wheel_velocity_time = datetime.now()
+  wheel_velocity_time = clock.now()
+  wheel_velocity_recv_time = clock.now()
+  wheel_velocity_teensy_time = clock.now()
   wheel_velocity_update_counter = 0
   wheel_velocity_sampling_time = 1000 # sec
 
   # Pose [x (m), y (m), heading (rad), tilt (rad - if available)]
   pose = [0.0, 0.0, 0.0, 0.0]
-  pose_time = datetime.now()
+  pose_time = clock.now()
+  pose_recv_time = clock.now()
+  pose_teensy_time = clock.now()
   pose_update_counter = 0
   pose_sampling_time = 1000 # sec
 
+  # Pose fused by the EKF [x (m), y (m), heading (rad, not wrapped)] and its covariance
+  fused_pose = [0.0, 0.0, 0.0]
+  fused_pose_covariance = np.zeros((3, 3))
+  fused_pose_time = clock.now()
+
   # Total trip data
   total_dist = 0
   total_heading = 0
-  total_time = datetime.now()
+  total_time = clock.now()
 
   # Partial trip data (can be reset to track parts of the track)
   trip_dist = 0
   trip_heading = 0
-  trip_time = datetime.now()
+  trip_time = clock.now()
 
   # Teensy configuration
-  info_time = datetime.now()
+  info_time = clock.now()
+  info_recv_time = clock.now()
   info_update_counter = 0
   tick_per_revolution = 68
   wheel_radius_left = 0.1
@@ -44,12 +160,23 @@ class Odometry(Sensor):
   wheel_base = 0.1
   encoder_reversed = False
 
+  MAX_INTEGRATION_INTERVAL = 0.5 # sec, a longer gap between wheel velocities is not integrated
+
+
+  def __init__(self):
+    super().__init__('odometry')
+    self.wheel_velocity_history = self._create_history("T0/vel")
+    self.motor_velocity_history = self._create_history("T0/mvel")
+    self.pose_history = self._create_history("T0/pose")
+    self.ekf = PoseEkf()
+    self.fused_pose = [0.0, 0.0, 0.0]
+    self.fused_pose_covariance = np.zeros((3, 3))
 
-  def wait_for_data(self):
-    super().wait_for_data('odometry')
 
+  def _after_ready(self):
     # Reset pose
     mqtt_service.send_cmd("T0/enc0", "")
+    self.ekf.reset()
     # Send robot configuration: radius_left (m), radius_right (m), gear, encoder_tick, wheel_base (m)
     mqtt_service.send_cmd("T0/confw" ,"0.075 0.075 19 68 0.23")
     # Set encoder reversed
@@ -62,72 +189,126 @@ class Odometry(Sensor):
     return self.wheel_velocity_update_counter == 0 or self.motor_velocity_update_counter == 0 or self.pose_update_counter == 0
 
 
-  def decode(self, topic, msg):
-    parts = super().decode(topic, msg)
-
-    if topic == "T0/vel" and len(parts) > 3:
-      self._print_mqtt_debug(topic, msg)
-      prev_time = self.wheel_velocity_time
-
-      # Teensy time (parts[1]) is ignored
-      self.wheel_velocity_time = datetime.fromtimestamp(float(parts[0]))
-      self.wheel_velocities[0] = float(parts[2])
-      self.wheel_velocities[1] = float(parts[3])
-
-      self.wheel_velocity_sampling_time = self._update_sampling_time(self.wheel_velocity_time, prev_time, self.wheel_velocity_update_counter, self.wheel_velocity_sampling_time)
-      self.wheel_velocity_update_counter += 1
-
-      ds = (self.wheel_velocities[0] + self.wheel_velocities[1]) * self.wheel_velocity_sampling_time/2
+  def _snapshot(self):
+    return OdometrySnapshot(
+      tuple(self.pose), self.pose_time, self.pose_recv_time,
+      tuple(self.wheel_velocities), self.wheel_velocity_time,
+      tuple(self.motor_velocities), self.motor_velocity_time,
+      self.total_dist, self.total_heading, self.trip_dist, self.trip_heading,
+      tuple(self.fused_pose), self.fused_pose_covariance.copy(), self.fused_pose_time,
+    )
+
+
+  def _handlers(self):
+    return {
+      "T0/vel": self._decode_wheel_velocity,
+      "T0/mvel": self._decode_motor_velocity,
+      "T0/pose": self._decode_pose,
+      "T0/conf": self._decode_conf,
+      # Turnrate measurement of the EKF
+      "T0/gyro": self._decode_gyro,
+    }
+
+
+  def _decode_wheel_velocity(self, payload):
+    values = payload.values
+    self._print_mqtt_debug("T0/vel", values)
+    prev_time = self.wheel_velocity_time
+    prev_teensy_time = self.wheel_velocity_teensy_time
+
+    self.wheel_velocity_time = values[0]
+    self.wheel_velocity_recv_time = payload.recv_time
+    # Time the Teensy took the sample, on the host time base
+    self.wheel_velocity_teensy_time = clock.teensy_to_host(values[1])
+    self.wheel_velocities[0] = values[2]
+    self.wheel_velocities[1] = values[3]
+
+    self.wheel_velocity_history.append(values)
+    self.wheel_velocity_sampling_time = self._update_sampling_time(self.wheel_velocity_time, prev_time, self.wheel_velocity_update_counter, self.wheel_velocity_sampling_time)
+
+    # Distance over the real interval between the samples, skipped after a gap in the stream
+    dt = self.wheel_velocity_teensy_time - prev_teensy_time
+    if self.wheel_velocity_update_counter > 0 and 0 < dt < self.MAX_INTEGRATION_INTERVAL:
+      ds = (self.wheel_velocities[0] + self.wheel_velocities[1]) * dt / 2
       self.total_dist += ds
       self.trip_dist += ds
-
-    elif topic == "T0/mvel" and len(parts) > 2:
-      self._print_mqtt_debug(topic, msg)
-      prev_time = self.motor_velocity_time
-
-      self.motor_velocity_time = datetime.fromtimestamp(float(parts[0]))
-      self.motor_velocities[0] = float(parts[1])
-      self.motor_velocities[1] = float(parts[2])
-
-      self.motor_velocity_sampling_time = self._update_sampling_time(self.motor_velocity_time, prev_time, self.motor_velocity_update_counter, self.motor_velocity_sampling_time)
-      self.motor_velocity_update_counter += 1
-
-    elif topic == "T0/pose" and len(parts) > 5:
-      self._print_mqtt_debug(topic, msg)
-      prev_time = self.pose_time
-
-      # Teensy time (parts[1]) is ignored
-      self.pose_time = datetime.fromtimestamp(float(parts[0]))
-      self.pose[0] = float(parts[2])
-      self.pose[1] = float(parts[3])
-
-      # Calculate heading
-      h = float(parts[4])
-      dh = h - self.pose[2]
-      # Saturate between +- 2pi
-      if (dh > 2.0 * np.pi):
-        dh -= 2.0 * np.pi
-      elif (dh < -2.0 * np.pi):
-        dh += 2.0 * np.pi
-      self.trip_heading += dh
-      self.total_heading += dh
-      self.pose[2] = h
-      # Tilt
-      self.pose[3] = float(parts[5])
-
-      self.pose_sampling_time = self._update_sampling_time(self.pose_time, prev_time, self.pose_update_counter, self.pose_sampling_time)
-      self.pose_update_counter += 1
-
-    elif topic == "T0/conf" and len(parts) > 7:
-      self._print_mqtt_debug(topic, msg)
-      self.info_time = datetime.fromtimestamp(float(parts[0]))
-      self.wheel_radius_left = float(parts[1])
-      self.wheel_radius_right = float(parts[2])
-      self.gear = float(parts[3])
-      self.tick_per_revolution = float(parts[4])
-      self.wheel_base = float(parts[5])
-      self.encoder_reversed = float(parts[7])
-      self.info_update_counter += 1
+    self.wheel_velocity_update_counter += 1
+
+    # Both EKF streams use the teensy_interface timestamp, the Teensy time is not in T0/gyro
+    self.ekf.update_wheels(self.wheel_velocity_time, values[2], values[3], self.wheel_base)
+    self.__update_fused_pose()
+
+
+  def _decode_gyro(self, payload):
+    values = payload.values
+    turnrate = (values[3] - imu.gyro_bias[2]) * imu.GYRO_UNIT
+    self.ekf.update_gyro(values[0], turnrate)
+    self.__update_fused_pose()
+
+
+  def __update_fused_pose(self):
+    x, y, heading = self.ekf.state[:3].tolist()
+    self.fused_pose[0] = x
+    self.fused_pose[1] = y
+    self.fused_pose[2] = heading
+    self.fused_pose_covariance[:] = self.ekf.covariance[:3, :3]
+    self.fused_pose_time = self.ekf.time
+
+
+  def _decode_motor_velocity(self, payload):
+    values = payload.values
+    self._print_mqtt_debug("T0/mvel", values)
+    prev_time = self.motor_velocity_time
+
+    self.motor_velocity_time = values[0]
+    self.motor_velocity_recv_time = payload.recv_time
+    self.motor_velocities[0] = values[1]
+    self.motor_velocities[1] = values[2]
+
+    self.motor_velocity_history.append(values)
+    self.motor_velocity_sampling_time = self._update_sampling_time(self.motor_velocity_time, prev_time, self.motor_velocity_update_counter, self.motor_velocity_sampling_time)
+    self.motor_velocity_update_counter += 1
+
+
+  def _decode_pose(self, payload):
+    values = payload.values
+    self._print_mqtt_debug("T0/pose", values)
+    prev_time = self.pose_time
+
+    self.pose_time = values[0]
+    self.pose_recv_time = payload.recv_time
+    # Time the Teensy took the sample, on the host time base
+    self.pose_teensy_time = clock.teensy_to_host(values[1])
+    self.pose[0] = values[2]
+    self.pose[1] = values[3]
+
+    # Heading change, the Teensy heading is wrapped to +- pi
+    h = values[4]
+    dh = h - self.pose[2]
+    dh = math.atan2(math.sin(dh), math.cos(dh))
+    self.trip_heading += dh
+    self.total_heading += dh
+    self.pose[2] = h
+    # Tilt
+    self.pose[3] = values[5]
+
+    self.pose_history.append(values)
+    self.pose_sampling_time = self._update_sampling_time(self.pose_time, prev_time, self.pose_update_counter, self.pose_sampling_time)
+    self.pose_update_counter += 1
+
+
+  def _decode_conf(self, payload):
+    values = payload.values
+    self._print_mqtt_debug("T0/conf", values)
+    self.info_time = values[0]
+    self.info_recv_time = payload.recv_time
+    self.wheel_radius_left = values[1]
+    self.wheel_radius_right = values[2]
+    self.gear = values[3]
+    self.tick_per_revolution = values[4]
+    self.wheel_base = values[5]
+    self.encoder_reversed = values[7]
+    self.info_update_counter += 1
 
 
   ####################################################################################################
@@ -136,15 +317,15 @@ class Odometry(Sensor):
   def reset_trip(self):
     self.trip_dist = 0
     self.trip_heading = 0
-    self.trip_time = datetime.now()
+    self.trip_time = clock.now()
 
 
   def total_time_passed(self):
-    return (datetime.now() - self.total_time).total_seconds()
+    return clock.now() - self.total_time
 
 
   def trip_time_passed(self):
-    return (datetime.now() - self.trip_time).total_seconds()
+    return clock.now() - self.trip_time
 
 
 
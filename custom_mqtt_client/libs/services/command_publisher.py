@@ -0,0 +1,180 @@
+from collections import OrderedDict
+from threading import Condition, Thread, current_thread
+from time import monotonic
+
+
+class CommandPublisher:
+  """
+  Publishes outbound commands from a dedicated thread, so callers never wait on the socket.
+
+  Coalesced topics only keep the newest value waiting to be sent (latest wins), all other
+  commands are published in the order they were submitted. Each topic can be limited to
+  a max publish rate.
+  """
+
+  # topic: number of leading fields that select the target, commands to different targets are not merged
+  COALESCED_TOPICS = {
+    "robobot/cmd/ti/rc": 0,
+    "robobot/cmd/T0/leds": 1,  # one pending value per led number
+  }
+  MAX_PUBLISH_RATE_HZ = {
+    "robobot/cmd/ti/rc": 100,
+    "robobot/cmd/T0/leds": 50,
+  }
+  STOP_TIMEOUT_SEC = 1.0
+
+
+  def __init__(self, publish, coalesced_topics=None, max_publish_rate_hz=None):
+    """
+    publish(topic, data) -> bool: does the actual publishing, called from the publisher thread
+    """
+    self.publish = publish
+    self.coalesced_topics = self.COALESCED_TOPICS if coalesced_topics is None else coalesced_topics
+    self.min_interval = {}
+    for topic, rate in (self.MAX_PUBLISH_RATE_HZ if max_publish_rate_hz is None else max_publish_rate_hz).items():
+      self.min_interval[topic] = 1 / rate
+
+    self.condition = Condition()
+    self.pending = OrderedDict()
+    self.last_publish_time = {}
+    self.sequence = 0
+    self.in_flight = 0
+    self.running = False
+    self.thread = None
+
+    # Statistics
+    self.submitted_counter = 0
+    self.coalesced_counter = 0
+    self.published_counter = 0
+    self.max_depth = 0
+    self.latency_sum = 0.0
+    self.latency_max = 0.0
+
+
+  def start(self):
+    self.running = True
+    self.thread = Thread(target=self.__handle, name="command_publisher", daemon=True)
+    self.thread.start()
+
+
+  def submit(self, topic, data):
+    """
+    Queue data (a string, or a tuple of values formatted on the publisher thread) for topic
+    """
+    with self.condition:
+      fields = self.coalesced_topics.get(topic)
+      if fields is None:
+        key = self.sequence
+        self.sequence += 1
+      elif fields == 0:
+        key = topic
+      else:
+        key = (topic, self.__target(data, fields))
+
+      if key in self.pending:
+        self.coalesced_counter += 1
+      self.pending[key] = (topic, data, monotonic())
+      self.submitted_counter += 1
+
+      depth = len(self.pending)
+      if depth > self.max_depth:
+        self.max_depth = depth
+      self.condition.notify()
+
+
+  def depth(self):
+    return len(self.pending)
+
+
+  def flush(self, timeout=STOP_TIMEOUT_SEC):
+    """
+    Wait until all submitted commands have been published, returns False on timeout
+    """
+    if current_thread() is self.thread:
+      return False
+    with self.condition:
+      return self.condition.wait_for(lambda: not self.running or (not self.pending and self.in_flight == 0), timeout)
+
+
+  def stop(self):
+    """
+    Publish what is still pending and stop the thread
+    """
+    if not self.running:
+      return
+    self.flush()
+
+    with self.condition:
+      self.running = False
+      self.condition.notify_all()
+
+    if current_thread() is not self.thread:
+      self.thread.join(self.STOP_TIMEOUT_SEC)
+
+
+  def stats(self):
+    return {
+      'depth': len(self.pending),
+      'max_depth': self.max_depth,
+      'submitted': self.submitted_counter,
+      'coalesced': self.coalesced_counter,
+      'published': self.published_counter,
+      'latency_avg_ms': self.latency_sum / self.published_counter * 1000 if self.published_counter > 0 else 0,
+      'latency_max_ms': self.latency_max * 1000,
+    }
+
+
+  def __target(self, data, fields):
+    if isinstance(data, str):
+      return tuple(data.split(" ", fields)[:fields])
+    return tuple(data[:fields])
+
+
+  def __take_due(self):
+    """
+    Remove and return the pending commands allowed to be published now,
+    and the time to wait for the next one (None if nothing else is pending)
+    """
+    now = monotonic()
+    due = []
+    wait = None
+
+    for key, (topic, data, submit_time) in list(self.pending.items()):
+      next_time = self.last_publish_time.get(topic, 0) + self.min_interval.get(topic, 0)
+      if next_time <= now:
+        del self.pending[key]
+        due.append((topic, data, submit_time))
+        self.last_publish_time[topic] = now
+      elif wait is None or next_time - now < wait:
+        wait = next_time - now
+
+    return due, wait
+
+
+  def __handle(self):
+    while True:
+      with self.condition:
+        self.condition.wait_for(lambda: self.pending or not self.running)
+        if not self.running:
+          break
+
+        due, wait = self.__take_due()
+        if not due:
+          self.condition.wait(wait)
+          continue
+        self.in_flight = len(due)
+
+      for topic, data, submit_time in due:
+        if not isinstance(data, str):
+          data = " ".join(map(str, data))
+        self.publish(topic, data)
+
+        latency = monotonic() - submit_time
+        self.latency_sum += latency
+        if latency > self.latency_max:
+          self.latency_max = latency
+        self.published_counter += 1
+
+      with self.condition:
+        self.in_flight = 0
+        self.condition.notify_all()
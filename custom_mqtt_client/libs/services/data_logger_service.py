@@ -1,66 +1,73 @@
 from libs.logger import Logger
-from time import time
+from libs.services.recorder import Recorder
+from libs.clock import clock
 from libs.sensors.imu import imu
 from libs.sensors.ir import ir
 from libs.sensors.odometry import odometry
+from libs.base.sensor import snapshot
 from modules.line_follower.line_follower import line_follower
 
 
 class DataLoggerService:
   """
-  Creates a csv file useful for debugging and data analysis.
+  Records the robot state for debugging and data analysis, convert the recording with scripts/convert_recording.py
   """
 
-  COMMENT_SIMBOL = "#"
+  COLUMNS = ("timestamp_sec", "state", "x", "y", "heading_rad", "gyro_x", "gyro_y", "gyro_z", "acc_x", "acc_y", "acc_z",
+             "ir0", "ir1", "line_pos", "total_dist", "total_heading", "trip_dist", "trip_heading")
   state = 0
+  # None when the recording could not be opened, the robot keeps running without it
+  recorder = None
 
 
   def setup(self):
     self.logger = Logger('data_logger')
 
     try:
-      self.file = open('logs/data_log.csv', 'w', encoding="utf-8")
+      self.recorder = Recorder('logs/data_log', self.COLUMNS)
       self.logger.info("Data logger file opened")
-    except:
-      self.logger.error("Failed to open file for writing")
-
-    self.file.write("timestamp_sec, state, x, y, heading_rad, gyro_x, gyro_y, gyro_z, acc_x, acc_y, acc_z, ir0, ir1, line_pos, total_dist, total_heading, trip_dist, trip_heading\n")
+    except Exception as e:
+      self.recorder = None
+      self.logger.exception(f"Failed to open file for writing, data logging disabled: {e}")
 
 
   def write_comment(self, data):
-    self.file.write(f"{self.COMMENT_SIMBOL} [INFO] {time()} {data}\n")
+    if self.recorder is None:
+      return
+    self.recorder.comment(clock.now(), f"[INFO] {data}")
 
 
   def write(self, state = None):
+    if self.recorder is None:
+      return
     if state is not None:
-      self.state = state
-
-    self.logger.debug("Writing data to file")
-
-    # Timestamp and state  
-    self.file.write(f"{time()},{self.state},")
-    # Pose (x, y, h)
-    self.file.write(f"{odometry.pose[0]:.3f},{odometry.pose[1]:.3f},{odometry.pose[2]:.3f},")
-    # Gyro data
-    self.file.write(f"{imu.gyro[0]:.3f},{imu.gyro[1]:.3f},{imu.gyro[2]:.3f},")
-    # Accelerometer data
-    self.file.write(f"{imu.acc[0]:.3f},{imu.acc[1]:.3f},{imu.acc[2]:.3f},")
-    # IR sensor data
-    self.file.write(f"{ir.ir[0]:.3f},{ir.ir[1]:.3f},")
-    # Line sensor detected position
-    self.file.write(f"{line_follower.position:.2f},")
-    # Trip A distance and heading change
-    self.file.write(f"{odometry.total_dist:.3f},{odometry.total_heading:.3f},")
-    # Trip B distance and heading change
-    self.file.write(f"{odometry.trip_dist:.4f},{odometry.trip_heading:.4f}\n")
-
-    self.file.flush()
+      self.state = self.recorder.label("state", state)
+
+    # Consistent copy, the sensors are updated by the MQTT thread while we read
+    odometry_state, imu_state, ir_state = snapshot(odometry, imu, ir)
+    pose = odometry_state.pose
+    gyro = imu_state.gyro
+    acc = imu_state.acc
+    self.recorder.append(
+      clock.now(), self.state,
+      pose[0], pose[1], pose[2],
+      gyro[0], gyro[1], gyro[2],
+      acc[0], acc[1], acc[2],
+      ir_state.ir[0], ir_state.ir[1],
+      line_follower.position,
+      # Trip A distance and heading change
+      odometry_state.total_dist, odometry_state.total_heading,
+      # Trip B distance and heading change
+      odometry_state.trip_dist, odometry_state.trip_heading,
+    )
 
 
   def terminate(self):
-    self.file.close()
+    if self.recorder is None:
+      return
+    self.recorder.close()
     self.logger.info("Data logger file closed")
 
 
 
-data_logger_service = DataLoggerService()
\ No newline at end of file
+data_logger_service = DataLoggerService()
@@ -0,0 +1,317 @@
+import json
+import os
+from collections import deque, namedtuple
+from enum import IntEnum
+from threading import Event, Thread
+import numpy as np
+from libs.clock import clock
+from libs.logger import Logger
+
+
+class StreamStatus(IntEnum):
+  """
+  Health of one stream, a higher value is worse
+  """
+  OK = 0
+  JITTERY = 1
+  LATE = 2
+  SLOW = 3
+  STALE = 4
+
+
+class HealthAction(IntEnum):
+  """
+  What the state machine should do about the streams
+  """
+  NONE = 0
+  DEGRADE = 1
+  STOP = 2
+
+
+# max_age: sec since the newest sample, older is STALE
+# max_interval: mean sample interval (sec), longer is SLOW, None: derived from the stream rate
+# max_jitter: standard deviation of the sample intervals (sec), more is JITTERY, None: derived from the stream rate
+# max_latency: teensy_interface to handler (sec), more is LATE
+# critical: a stale critical stream stops the robot, every other problem degrades it
+StreamBudget = namedtuple('StreamBudget', ['max_age', 'max_interval', 'max_jitter', 'max_latency', 'critical'])
+
+
+class StreamHealth:
+  """
+  Latest check of one stream and its open incident
+  """
+
+  def __init__(self, subtopic, history, budget):
+    self.subtopic = subtopic
+    self.history = history
+    self.budget = budget
+    self.status = StreamStatus.OK
+    # Nominal sample interval (sec) the budget was derived from, None until known
+    self.nominal_interval = None
+    self.age = 0.0
+    self.interval = 0.0
+    self.jitter = 0.0
+    self.latency = 0.0
+    self.incident = None
+    self.incident_counter = 0
+
+
+  def as_dict(self):
+    return {
+      'status': self.status.name,
+      'age_ms': self.age * 1000,
+      'interval_ms': self.interval * 1000,
+      'jitter_ms': self.jitter * 1000,
+      'latency_ms': self.latency * 1000,
+      'incidents': self.incident_counter,
+    }
+
+
+
+class HealthMonitor:
+  """
+  Checks the sample timestamps of the sensor streams against their budgets from a background thread:
+  the age of the newest sample, the mean and jitter of the sample intervals (from the sensor history)
+  and the latency of the newest message (from the router statistics).
+
+  action() tells the state machine to stop or degrade. Every period a stream spends outside its budget
+  is kept as an incident, and saved to INCIDENT_FILE in the log folder for post-run analysis.
+
+  The stream rates are configured in teensy_interface, not here. So the interval and jitter budgets are
+  derived from the rate given to watch(), or else from the first RATE_LEARN_SEC of samples after setup():
+  INTERVAL_TOLERANCE times the nominal interval, and the larger of JITTER_TOLERANCE times the nominal
+  interval and JITTER_MARGIN times the jitter measured then. Age and latency budgets are absolute.
+  """
+  CHECK_INTERVAL_SEC = 0.05
+  WINDOW_SEC = 1.0 # sample intervals are measured over this window
+  INCIDENT_HISTORY = 1000
+  INCIDENT_FILE = "health_incidents.json"
+
+  RATE_LEARN_SEC = 1.0
+  INTERVAL_TOLERANCE = 1.5
+  JITTER_TOLERANCE = 0.5
+  JITTER_MARGIN = 2.0
+
+  BUDGETS = {
+    "T0/livn": StreamBudget(max_age=0.25, max_interval=None, max_jitter=None, max_latency=0.05, critical=True),
+    "T0/vel":  StreamBudget(max_age=0.25, max_interval=None, max_jitter=None, max_latency=0.05, critical=True),
+    "T0/pose": StreamBudget(max_age=0.25, max_interval=None, max_jitter=None, max_latency=0.05, critical=True),
+    "T0/gyro": StreamBudget(max_age=0.25, max_interval=None, max_jitter=None, max_latency=0.05, critical=False),
+    "T0/acc":  StreamBudget(max_age=0.5,  max_interval=None, max_jitter=None, max_latency=0.1,  critical=False),
+    "T0/ird":  StreamBudget(max_age=0.5,  max_interval=None, max_jitter=None, max_latency=0.1,  critical=False),
+    "T0/mot":  StreamBudget(max_age=1.0,  max_interval=None, max_jitter=None, max_latency=0.1,  critical=False),
+  }
+
+
+  def __init__(self):
+    self.streams = {}
+    self.router = None
+    self.incidents = deque(maxlen=self.INCIDENT_HISTORY)
+    self.stop_event = Event()
+    self.thread = None
+    self.start_time = None
+    self.action_value = HealthAction.NONE
+
+
+  def watch(self, subtopic, history, budget=None, rate_hz=None):
+    """
+    Monitor the stream of subtopic from its sensor history (RingBuffer, time first),
+    the budget defaults to BUDGETS[subtopic]. rate_hz: nominal rate, measured when not given
+    """
+    stream = StreamHealth(subtopic, history, budget if budget is not None else self.BUDGETS[subtopic])
+    if rate_hz is not None:
+      self.__derive_budget(stream, 1 / rate_hz, 0.0)
+    self.streams[subtopic] = stream
+
+
+  def setup(self, router=None):
+    """
+    router: MqttRouter whose statistics give the latency, not measured without it
+    """
+    self.logger = Logger('health_monitor')
+    self.router = router
+    self.start_time = clock.now()
+    self.stop_event.clear()
+    self.thread = Thread(target=self.__handle, name="health_monitor", daemon=True)
+    self.thread.start()
+    self.logger.info(f"Monitoring {', '.join(self.streams)}")
+
+
+  def terminate(self):
+    self.stop_event.set()
+    if self.thread is not None:
+      self.thread.join()
+      self.thread = None
+
+    now = clock.now()
+    for stream in self.streams.values():
+      if stream.incident is not None:
+        self.__close_incident(stream, now)
+    self.save_incidents()
+    self.logger.info(f"Terminated, {len(self.incidents)} incidents")
+
+
+  def action(self):
+    return self.action_value
+
+
+  def unhealthy(self):
+    """
+    Returns {subtopic: status} of the streams outside their budget
+    """
+    return {subtopic: stream.status for subtopic, stream in self.streams.items() if stream.status != StreamStatus.OK}
+
+
+  ##### CHECK #####
+
+  def __handle(self):
+    while not self.stop_event.wait(self.CHECK_INTERVAL_SEC):
+      self.check()
+
+
+  def check(self, now=None):
+    """
+    Check every stream, returns the action
+    """
+    if now is None:
+      now = clock.now()
+
+    action = HealthAction.NONE
+    learned = self.start_time is not None and now - self.start_time >= self.RATE_LEARN_SEC
+    for stream in self.streams.values():
+      self.__measure(stream, now)
+      if stream.nominal_interval is None and learned:
+        self.__learn_budget(stream)
+      status = self.__status(stream)
+      stream.status = status
+
+      if status != StreamStatus.OK:
+        if stream.incident is None:
+          self.__open_incident(stream, status, now)
+        self.__update_incident(stream, status)
+        if status == StreamStatus.STALE and stream.budget.critical:
+          action = HealthAction.STOP
+        elif action == HealthAction.NONE:
+          action = HealthAction.DEGRADE
+      elif stream.incident is not None:
+        incident = self.__close_incident(stream, now)
+        self.logger.info(f"{stream.subtopic} is OK again after {incident['duration'] * 1000:.0f} ms ({incident['status']})")
+
+    if action != self.action_value:
+      self.logger.warning(f"Action changed from {self.action_value.name} to {action.name}")
+    self.action_value = action
+    return action
+
+
+  def __measure(self, stream, now):
+    history = stream.history
+    if len(history) == 0:
+      stream.age = float('inf')
+      return
+
+    times = history.window(self.WINDOW_SEC)[:, 0]
+    stream.age = now - float(times[-1])
+    if len(times) >= 3:
+      intervals = np.diff(times)
+      stream.interval = float(intervals.mean())
+      stream.jitter = float(intervals.std())
+
+    stats = self.router.stats.get(stream.subtopic) if self.router is not None else None
+    if stats is not None and stats.last_sample_time is not None:
+      stream.latency = stats.last_recv_time - stats.last_sample_time
+
+
+  def __learn_budget(self, stream):
+    times = stream.history.window(self.WINDOW_SEC)[:, 0]
+    if len(times) < 3:
+      # No rate to learn from yet, the stream is STALE anyway
+      return
+    intervals = np.diff(times)
+    self.__derive_budget(stream, float(np.median(intervals)), float(intervals.std()))
+
+
+  def __derive_budget(self, stream, nominal_interval, jitter):
+    budget = stream.budget
+    if budget.max_interval is None:
+      budget = budget._replace(max_interval=self.INTERVAL_TOLERANCE * nominal_interval)
+    if budget.max_jitter is None:
+      budget = budget._replace(max_jitter=max(self.JITTER_TOLERANCE * nominal_interval, self.JITTER_MARGIN * jitter))
+    stream.budget = budget
+    stream.nominal_interval = nominal_interval
+    if hasattr(self, 'logger'):
+      self.logger.info(f"{stream.subtopic} at {1 / nominal_interval:.1f} Hz (jitter {jitter * 1000:.1f} ms): "
+                       f"max interval {budget.max_interval * 1000:.1f} ms, max jitter {budget.max_jitter * 1000:.1f} ms")
+
+
+  def __status(self, stream):
+    budget = stream.budget
+    if stream.age > budget.max_age:
+      return StreamStatus.STALE
+    if budget.max_interval is not None and stream.interval > budget.max_interval:
+      return StreamStatus.SLOW
+    if stream.latency > budget.max_latency:
+      return StreamStatus.LATE
+    if budget.max_jitter is not None and stream.jitter > budget.max_jitter:
+      return StreamStatus.JITTERY
+    return StreamStatus.OK
+
+
+  ##### INCIDENTS #####
+
+  def __open_incident(self, stream, status, now):
+    stream.incident = {
+      'stream': stream.subtopic,
+      'status': status.name,
+      'start': now,
+      'end': None,
+      'duration': None,
+      'max_age': 0.0,
+      'max_interval': 0.0,
+      'max_jitter': 0.0,
+      'max_latency': 0.0,
+    }
+    stream.incident_counter += 1
+    self.logger.warning(f"{stream.subtopic} is {status.name}: {stream.as_dict()}")
+
+
+  def __update_incident(self, stream, status):
+    incident = stream.incident
+    # Keep the worst status of the incident
+    if status > StreamStatus[incident['status']]:
+      incident['status'] = status.name
+      self.logger.warning(f"{stream.subtopic} is {status.name}: {stream.as_dict()}")
+    incident['max_age'] = max(incident['max_age'], stream.age)
+    incident['max_interval'] = max(incident['max_interval'], stream.interval)
+    incident['max_jitter'] = max(incident['max_jitter'], stream.jitter)
+    incident['max_latency'] = max(incident['max_latency'], stream.latency)
+
+
+  def __close_incident(self, stream, now):
+    incident = stream.incident
+    incident['end'] = now
+    incident['duration'] = now - incident['start']
+    self.incidents.append(incident)
+    stream.incident = None
+    return incident
+
+
+  def save_incidents(self, path=None):
+    if path is None:
+      path = os.path.join(Logger.log_dir(), self.INCIDENT_FILE)
+    directory = os.path.dirname(path)
+    if directory:
+      os.makedirs(directory, exist_ok=True)
+    with open(path, 'w', encoding="utf-8") as file:
+      json.dump(list(self.incidents), file, indent=2)
+
+
+  def stats(self):
+    return {
+      'action': self.action_value.name,
+      'streams': {subtopic: stream.as_dict() for subtopic, stream in self.streams.items()},
+      'incidents': len(self.incidents),
+    }
+
+
+
+health_monitor = HealthMonitor()
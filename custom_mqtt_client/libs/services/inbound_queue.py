@@ -0,0 +1,117 @@
+from collections import deque
+from threading import Condition, Thread
+
+
+class InboundQueue:
+  """
+  Optional stage between the paho thread and the message handlers, handled by its own thread.
+
+  State topics are conflated: while a sample waits to be handled, a newer one replaces it,
+  so a slow handler never works through stale samples. Event topics keep every message in order.
+  Topics with a higher priority (lower number) are always handled first.
+  """
+  CONFLATED_TOPICS = ("T0/pose", "T0/vel", "T0/gyro")
+  PRIORITIES = {
+    "T0/livn": 0,
+    "T0/info": 2,
+    "T0/mot": 2,
+  }
+  DEFAULT_PRIORITY = 1
+
+
+  def __init__(self, dispatch, conflated_topics=CONFLATED_TOPICS, priorities=PRIORITIES):
+    """
+    dispatch(subtopic, payload, recv_time): called from the queue thread for every message
+    """
+    self.dispatch = dispatch
+    self.conflated_topics = frozenset(conflated_topics)
+    self.priorities = priorities
+    self.levels = [deque() for _ in range(max(list(priorities.values()) + [self.DEFAULT_PRIORITY]) + 1)]
+    self.latest = {}
+    self.condition = Condition()
+    self.running = False
+    self.thread = None
+
+    # Statistics
+    self.queued_counter = 0
+    self.handled_counter = 0
+    self.conflated_counter = {subtopic: 0 for subtopic in self.conflated_topics}
+    self.max_depth = 0
+
+
+  def start(self):
+    self.running = True
+    self.thread = Thread(target=self.__handle, name="inbound_queue", daemon=True)
+    self.thread.start()
+
+
+  def stop(self):
+    with self.condition:
+      self.running = False
+      self.condition.notify()
+    if self.thread is not None:
+      self.thread.join()
+
+
+  def put(self, subtopic, payload, recv_time):
+    """
+    Called from the paho thread
+    """
+    with self.condition:
+      if subtopic in self.conflated_topics:
+        if subtopic in self.latest:
+          # Replace the waiting sample, it keeps its place in the queue
+          self.latest[subtopic] = (payload, recv_time)
+          self.conflated_counter[subtopic] += 1
+          return
+        self.latest[subtopic] = (payload, recv_time)
+        entry = (subtopic, None, None)
+      else:
+        entry = (subtopic, payload, recv_time)
+
+      level = self.levels[self.priorities.get(subtopic, self.DEFAULT_PRIORITY)]
+      level.append(entry)
+      self.queued_counter += 1
+
+      depth = self.depth()
+      if depth > self.max_depth:
+        self.max_depth = depth
+      self.condition.notify()
+
+
+  def depth(self):
+    return sum(len(level) for level in self.levels)
+
+
+  def __next(self):
+    for level in self.levels:
+      if level:
+        subtopic, payload, recv_time = level.popleft()
+        if payload is None:
+          payload, recv_time = self.latest.pop(subtopic)
+        return subtopic, payload, recv_time
+    return None
+
+
+  def __handle(self):
+    while True:
+      with self.condition:
+        entry = self.__next()
+        while entry is None and self.running:
+          self.condition.wait()
+          entry = self.__next()
+        if entry is None:
+          break
+
+      self.dispatch(*entry)
+      self.handled_counter += 1
+
+
+  def stats(self):
+    return {
+      'depth': self.depth(),
+      'max_depth': self.max_depth,
+      'queued': self.queued_counter,
+      'handled': self.handled_counter,
+      'conflated': dict(self.conflated_counter),
+    }
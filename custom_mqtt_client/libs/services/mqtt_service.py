@@ -1,16 +1,115 @@
-
 import time
+from time import perf_counter_ns
+import json
 from paho.mqtt import client as mqtt_client
 from datetime import datetime
-from threading import Thread
+from threading import Event
 from libs.args import arg_parser
 from libs.robot import robot
+from libs.clock import clock
 from libs.logger import Logger
+from libs.services.payload_parser import create_payloads
+from libs.services.command_publisher import CommandPublisher
+from libs.services.telemetry import TelemetryReporter, TopicStats
+from libs.services.inbound_queue import InboundQueue
+
+
+class MqttRouter:
+  """
+  Dispatches inbound messages to the handlers registered for their exact subtopic,
+  so every message is split once and only reaches the code that owns it
+  """
+
+  def __init__(self, payloads=None):
+    self.payloads = payloads if payloads is not None else {}
+    self.handlers = {}
+    self.qos = {}
+    self.stats = {}
+    self.unrouted_counter = 0
+    self.malformed_counter = 0
+
+
+  def register(self, subtopic, handler, qos=0):
+    """
+    Register a handler for every message on subtopic (e.g. "T0/livn").
+    Subtopics with a declared schema call handler(payload) with the parsed TopicPayload,
+    the others call handler(parts) with the whitespace separated strings.
+    Handlers of the same subtopic are called in registration order.
+    The subtopic is subscribed with the highest qos of its handlers
+    """
+    self.handlers[subtopic] = self.handlers.get(subtopic, ()) + (handler,)
+    self.qos[subtopic] = max(self.qos.get(subtopic, 0), qos)
+    if subtopic not in self.stats:
+      self.stats[subtopic] = TopicStats(subtopic)
+
+
+  def unregister(self, subtopic, handler=None):
+    """
+    Remove one handler of subtopic, or all of them. Returns True when nobody is left on the subtopic
+    """
+    handlers = tuple(h for h in self.handlers.get(subtopic, ()) if handler is not None and h != handler)
+    if handlers:
+      self.handlers[subtopic] = handlers
+      return False
+
+    self.handlers.pop(subtopic, None)
+    self.qos.pop(subtopic, None)
+    return True
+
+
+  def subscriptions(self):
+    """
+    Returns [(subtopic, qos)] of every subtopic with a handler
+    """
+    return list(self.qos.items())
+
+
+  def dispatch(self, subtopic, payload, recv_time=None):
+    """
+    Dispatch the raw payload bytes, returns False when nobody registered for the subtopic.
+    recv_time is the host time the message was received, if it was queued before being dispatched
+    """
+    handlers = self.handlers.get(subtopic)
+    if handlers is None:
+      self.unrouted_counter += 1
+      return False
+
+    if recv_time is None:
+      recv_time = clock.now()
+    start_ns = perf_counter_ns()
+    parsed = self.payloads.get(subtopic)
+    if parsed is None:
+      parsed = payload.decode().split()
+      sample_time = None
+    elif not parsed.parse(payload):
+      self.malformed_counter += 1
+      return True
+    else:
+      # Samples carry the teensy_interface time and the receive time, both on the host time base
+      parsed.wall_time = parsed.values[0]
+      sample_time = clock.wall_to_host(parsed.wall_time)
+      parsed.values[0] = sample_time
+      parsed.recv_time = recv_time
+
+    for handler in handlers:
+      handler(parsed)
+
+    self.stats[subtopic].record(recv_time, perf_counter_ns() - start_ns, sample_time)
+    return True
+
+
+  def telemetry(self):
+    """
+    Returns {subtopic: statistics} of every registered subtopic
+    """
+    return {subtopic: stats.as_dict() for subtopic, stats in self.stats.items()}
+
 
 
 class MqttService:
-  SLEEP_WAIT_SEC = 0.1
-  PRINT_CYCLES = 0.5/SLEEP_WAIT_SEC
+  CONNECT_TIMEOUT_SEC = 10
+  SUBSCRIBE_TIMEOUT_SEC = 2
+  RECONNECT_DELAY_SEC = (1, 8) # min, max (doubles on every failed attempt)
 
   port = 1883
   topic = "robobot/drive/"
@@ -25,6 +124,14 @@ class MqttService:
   is_confirmed_master = False
   is_not_master = False
   host = 'localhost'
+  client = None
+  client_factory = mqtt_client.Client # replaced by FakeBroker.client when simulating
+  publisher = None
+  inbound_queue = None
+  telemetry_reporter = None
+  connected_event = Event()
+  subscribed_event = Event()
+  router = MqttRouter(create_payloads())
 
 
   def setup(self, on_custom_message = None, mqtt_host = 'localhost'):
@@ -33,51 +140,55 @@ class MqttService:
 
     self.on_custom_message = on_custom_message
     self.host = mqtt_host
+
+    self.router.register("master", self.__decode_master, qos=1)
+    if arg_parser.get('print_teensy_info'):
+      self.enable_topic("T0/info", self.__decode_teensy_info)
+
     self.connect_mqtt()
 
-    # start listening to incomming
-    self.mqtt_thread = Thread(target=self.handle_mqtt)
-    self.mqtt_thread.start()
+    # Outbound commands are published from their own thread
+    self.publisher = CommandPublisher(self.__publish)
+    self.publisher.start()
+
+    # Optionally hand the messages over to a conflating queue, so slow handlers never block the paho thread
+    if arg_parser.get('conflate'):
+      self.inbound_queue = InboundQueue(self.dispatch)
+      self.inbound_queue.start()
+
+    # Paho runs the network loop in its own thread, it wakes up on socket activity and reconnects on its own
+    self.client.loop_start()
 
-    # Wait for connection to be established
-    self.__wait_for_data()
+    # Wait for the broker to acknowledge the connection and the subscription
+    if not self.connected_event.wait(self.CONNECT_TIMEOUT_SEC):
+      self.logger.error(f"No connection to {self.host} on {self.port} after {self.CONNECT_TIMEOUT_SEC}s. Won't work without MQTT connection, terminating...")
+      self.client.loop_stop()
+      self.publisher.stop()
+      raise Exception("Failed to connect to MQTT server")
+
+    if not self.subscribed_event.wait(self.SUBSCRIBE_TIMEOUT_SEC):
+      self.logger.error(f"Subscription to {self.topic} topics not acknowledged after {self.SUBSCRIBE_TIMEOUT_SEC}s")
 
     # Do the setup and check of data streams, enable/disable interface logging (into teensy_interface/build/log_2025...)
     self.send("robobot/cmd/ti/log", "0")
 
-    self.logger.info(f"Setup finished, connected = {self.connected}")
-
+    # Publish the telemetry on the diagnostics topic
+    self.telemetry_reporter = TelemetryReporter(self.telemetry, self.send)
+    self.telemetry_reporter.start()
 
-  def __wait_for_data(self):
-    # Wait for data
-    loops = 0
-    while not self.connected:
-      time.sleep(self.SLEEP_WAIT_SEC)
+    self.logger.info(f"Setup finished, connected = {self.connected}")
 
-      if loops % self.PRINT_CYCLES == 0:
-        self.logger.error(f"No data received after {loops*self.SLEEP_WAIT_SEC:.2f}s (continues...)")
-      loops += 1
 
-  
   def connect_mqtt(self):
-    self.client = mqtt_client.Client()
+    self.client = self.client_factory()
     self.client.on_connect = self.on_connect
-
-    try:
-      self.client.connect(self.host, self.port)
-    except:
-      self.logger.error(f"Failed to connect to {self.host} on {self.port}. Won't work without MQTT connection, terminating...")
-      raise Exception("Failed to connect to MQTT server")
-
-
-  def handle_mqtt(self):
-    self.client.subscribe(self.topic + "#")
+    self.client.on_disconnect = self.on_disconnect
+    self.client.on_subscribe = self.on_subscribe
     self.client.on_message = self.on_message
+    self.client.reconnect_delay_set(*self.RECONNECT_DELAY_SEC)
 
-    while not self.stopped:
-      self.client.loop()
-
-    self.logger.error("Thread stopped")
+    # The connection is established (and retried) by the network loop
+    self.client.connect_async(self.host, self.port)
 
 
 
@@ -86,64 +197,161 @@ class MqttService:
   def on_connect(self, client, userdata, flags, rc):
     if rc == 0:
       self.logger.info(f"Connected to MQTT Broker {self.host} on {self.port}")
+      # Subscribe here, so the subscriptions are renewed after every reconnect
+      subscriptions = self.subscriptions()
+      self.logger.info(f"Subscribing to {len(subscriptions)} topics: {', '.join(topic for topic, _ in subscriptions)}")
+      self.client.subscribe(subscriptions)
       self.connected = True
+      self.connected_event.set()
+    else:
+      self.logger.error(f"Connection to MQTT Broker refused: {mqtt_client.connack_string(rc)}")
+
+
+  def on_disconnect(self, client, userdata, rc):
+    self.connected = False
+    self.connected_event.clear()
+    self.subscribed_event.clear()
+
+    if rc != 0 and not self.terminating:
+      self.logger.error(f"Lost connection to MQTT Broker ({mqtt_client.error_string(rc)}), reconnecting...")
+
+
+  def on_subscribe(self, client, userdata, mid, granted_qos):
+    if 0x80 in granted_qos:
+      self.logger.error(f"Broker refused a subscription, granted qos {granted_qos}")
+    self.subscribed_event.set()
 
 
   def on_message(self, client, userdata, msg):
-    msg_decoded = msg.payload.decode()
-    self.decode(msg.topic, msg_decoded)
+    self.decode(msg.topic, msg.payload)
     self.recv_msg_counter += 1
 
 
 
   ##### METHODS #####   
 
-  def decode(self, topic, msg):
+  def subscriptions(self):
+    """
+    Returns [(topic, qos)] to subscribe to: the subtopics with a registered handler,
+    or everything when a custom message handler wants the unrouted messages too
+    """
+    if self.on_custom_message is not None:
+      return [(self.topic + "#", 0)]
+    return [(self.topic + subtopic, qos) for subtopic, qos in self.router.subscriptions()]
+
+
+  def enable_topic(self, subtopic, handler, qos=0):
+    """
+    Register a handler at runtime and subscribe to its subtopic if the client is already connected
+    """
+    subscribed = subtopic in self.router.handlers
+    self.router.register(subtopic, handler, qos)
+    if self.connected and not subscribed and self.on_custom_message is None:
+      self.client.subscribe(self.topic + subtopic, qos)
+
+
+  def disable_topic(self, subtopic, handler=None):
+    """
+    Remove a handler registered with enable_topic, unsubscribes when nobody is left on the subtopic
+    """
+    if self.router.unregister(subtopic, handler) and self.connected and self.on_custom_message is None:
+      self.client.unsubscribe(self.topic + subtopic)
+
+
+  def decode(self, topic, payload):
     if not topic.startswith(self.topic):
       return
 
     subtopic = topic[len(self.topic):]
 
-    if subtopic == "T0/info" and arg_parser.get('print_teensy_info'):
-      print(f"mqtt_service - Teensy info {msg}", end="")
-
-    elif subtopic == "master":
-      # skip timestamp to get real masters starttime
-      real_master_time = msg[msg.find(" ")+1:]
+    if self.inbound_queue is not None:
+      self.inbound_queue.put(subtopic, payload, clock.now())
+    else:
+      self.dispatch(subtopic, payload)
 
-      if str(self.start_time) == real_master_time:
-        if not self.is_confirmed_master:
-          self.logger.info(f"This mqtt client is the the only master for this robot {robot.robot_name.rstrip()}, good :)")
-        self.is_confirmed_master = True
-      else:
-        self.is_not_master = True
-        self.logger.error("This mqtt client is not the master, quitting!")
 
-    elif self.on_custom_message is not None:
-      self.logger.debug(f"Decoding custom MQTT message: topic={subtopic}, msg={msg.rstrip()}")
+  def dispatch(self, subtopic, payload, recv_time=None):
+    if not self.router.dispatch(subtopic, payload, recv_time) and self.on_custom_message is not None:
+      msg = payload.decode()
+      self.logger.debug("Decoding custom MQTT message: topic={}, msg={}", subtopic, msg)
       self.on_custom_message(subtopic, msg)
 
 
+  def __decode_teensy_info(self, parts):
+    print(f"mqtt_service - Teensy info {' '.join(parts)}")
+
+
+  def __decode_master(self, parts):
+    # skip timestamp to get real masters starttime
+    real_master_time = " ".join(parts[1:])
+
+    if str(self.start_time) == real_master_time:
+      if not self.is_confirmed_master:
+        self.logger.info(f"This mqtt client is the the only master for this robot {robot.robot_name.rstrip()}, good :)")
+      self.is_confirmed_master = True
+    else:
+      self.is_not_master = True
+      self.logger.error("This mqtt client is not the master, quitting!")
+
+
+  def telemetry(self):
+    """
+    Per topic statistics of the received messages, and the counters of the service
+    """
+    return {
+      'topics': self.router.telemetry(),
+      'subscriptions': [topic for topic, _ in self.subscriptions()],
+      'received': self.recv_msg_counter,
+      'unrouted': self.router.unrouted_counter,
+      'malformed': self.router.malformed_counter,
+      'sent': self.sent_msg_counter,
+      'failed': self.failed_msg_counter,
+      'publisher': self.publisher.stats() if self.publisher is not None else {},
+      'inbound_queue': self.inbound_queue.stats() if self.inbound_queue is not None else {},
+      'clock': clock.stats(),
+    }
+
+
+  def dump_telemetry(self):
+    telemetry = self.telemetry()
+    self.logger.info(f"Telemetry: {json.dumps(telemetry, indent=2)}")
+    return telemetry
+
+
   def send(self, topic, data):
+    """
+    Queue data for topic, data can be a string or a tuple of values (joined by spaces when published).
+    Returns False if the message could not be queued
+    """
     if not self.client:
-      return
+      return False
 
     if self.is_not_master:
       self.logger.error("Tried to send but I'm not master, terminating...")
       self.terminate()
       return False
 
+    # Publish directly when the publisher is not running (e.g. after terminate)
+    if self.publisher is None or not self.publisher.running:
+      if not isinstance(data, str):
+        data = " ".join(map(str, data))
+      return self.__publish(topic, data)
+
+    self.publisher.submit(topic, data)
+    return True
+
+
+  def __publish(self, topic, data):
     if len(data) == 0:
       data = " "
 
     res = self.client.publish(topic, data)
     is_success = res[0] == 0
 
-    self.logger.debug(f"SENDING {topic} {data}")
+    self.logger.debug("SENDING {} {}", topic, data)
 
     if is_success:
       self.sent_msg_counter += 1
-      self.logger.debug(f"mqtt_service:: SENT")
       if self.sent_msg_counter > 100 and self.recv_msg_counter < 2:
         self.logger.error(f"Seems like there is no connection to Teensy (tx:{self.sent_msg_counter}, rx:{self.recv_msg_counter}); is Teensy_interface running?")
         self.stopped = True
@@ -168,6 +376,8 @@ class MqttService:
       return
 
     self.logger.info("Shutting down")
+    if self.telemetry_reporter is not None:
+      self.telemetry_reporter.stop()
 
     if self.connected and not self.is_not_master:
       self.send_cmd("T0/stop")
@@ -182,13 +392,23 @@ class MqttService:
       self.send("robobot/cmd/ti/log", "0")
 
     self.terminating = True
+
+    # Publish what is still queued before stopping
+    if self.publisher is not None:
+      self.publisher.stop()
+    self.dump_telemetry()
+
     self.stopped = True
 
-    # Wait for the thread to finish
+    # Stop the network loop
     try:
-      self.mqtt_thread.join()
+      self.client.disconnect()
+      self.client.loop_stop()
     except:
       pass
+
+    if self.inbound_queue is not None:
+      self.inbound_queue.stop()
    
 
 
@@ -0,0 +1,66 @@
+from array import array
+
+
+class TopicPayload:
+  """
+  Declared field schema of a topic and the preallocated buffer its messages are parsed into.
+  The buffer is overwritten by every message, handlers must copy what they want to keep.
+  recv_time is the host time (libs.clock) the message was received,
+  wall_time the teensy_interface stamp before it was moved onto the host time base
+  """
+  __slots__ = ('subtopic', 'fields', 'values', 'recv_time', 'wall_time')
+
+  def __init__(self, subtopic, fields):
+    self.subtopic = subtopic
+    self.fields = fields
+    self.values = array('d', [0.0]) * len(fields)
+    self.recv_time = 0.0
+    self.wall_time = 0.0
+
+
+  def index(self, field):
+    return self.fields.index(field)
+
+
+  def parse(self, payload):
+    """
+    Parse the raw payload bytes into values, extra trailing fields are ignored.
+    Returns False when the message has fewer fields than the schema or a field is not a number
+    """
+    parts = payload.split()
+    n = len(self.values)
+    if len(parts) < n:
+      return False
+
+    values = self.values
+    try:
+      for i in range(n):
+        values[i] = float(parts[i])
+    except ValueError:
+      return False
+    return True
+
+
+
+# Field schemas of the Teensy topics (as published by teensy_interface), 'time' is always the
+# timestamp added by teensy_interface, moved onto the host time base (libs.clock) by the MqttRouter.
+# 'teensy_time' is the Teensy clock (sec since boot)
+TEENSY_SCHEMAS = {
+  "T0/hbt":  ('time', 'teensy_time', 'data_0', 'data_1'),
+  "T0/livn": ('time',) + tuple(f"line_{i}" for i in range(8)),
+  "T0/pose": ('time', 'teensy_time', 'x', 'y', 'heading', 'tilt'),
+  "T0/vel":  ('time', 'teensy_time', 'left', 'right'),
+  "T0/mvel": ('time', 'left', 'right'),
+  "T0/gyro": ('time', 'x', 'y', 'z'),
+  "T0/acc":  ('time', 'x', 'y', 'z'),
+  "T0/ird":  ('time', 'side', 'front'),
+  "T0/mot":  ('time', 'data_0', 'data_1', 'data_2', 'data_3', 'data_4'),
+  "T0/conf": ('time', 'wheel_radius_left', 'wheel_radius_right', 'gear', 'tick_per_revolution', 'wheel_base', 'unused', 'encoder_reversed'),
+}
+
+
+def create_payloads(schemas=TEENSY_SCHEMAS):
+  """
+  Returns {subtopic: TopicPayload} with one preallocated buffer per topic
+  """
+  return {subtopic: TopicPayload(subtopic, fields) for subtopic, fields in schemas.items()}
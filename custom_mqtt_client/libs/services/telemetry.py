@@ -0,0 +1,158 @@
+import json
+from bisect import bisect_left
+from threading import Event, Thread
+
+
+class TopicStats:
+  """
+  Message statistics of one topic: count, rate, inter-arrival histogram, decode time
+  and gaps detected from the sample timestamps. Updated from the MQTT thread without allocations.
+  """
+  # Upper bounds of the inter-arrival histogram buckets (sec), the last one catches everything above
+  BUCKETS_SEC = (0.0005, 0.001, 0.002, 0.003, 0.005, 0.0075, 0.01, 0.015, 0.02, 0.03, 0.05, 0.075,
+                 0.1, 0.15, 0.2, 0.3, 0.5, 0.75, 1.0, 2.0, 5.0, float('inf'))
+  GAP_FACTOR = 2.5      # a sample interval longer than GAP_FACTOR expected periods is a gap
+  WARMUP_SAMPLES = 10   # samples used to learn the expected period before detecting gaps
+  EMA_WEIGHT = 0.01
+
+  __slots__ = ('subtopic', 'count', 'first_recv_time', 'last_recv_time', 'histogram', 'interval_max',
+               'decode_ns_sum', 'decode_ns_max', 'last_sample_time', 'sample_period',
+               'gaps', 'missed', 'lag', 'lag_max')
+
+  def __init__(self, subtopic):
+    self.subtopic = subtopic
+    self.reset()
+
+
+  def reset(self):
+    self.count = 0
+    self.first_recv_time = 0.0
+    self.last_recv_time = 0.0
+    self.histogram = [0] * len(self.BUCKETS_SEC)
+    self.interval_max = 0.0
+    self.decode_ns_sum = 0
+    self.decode_ns_max = 0
+    self.last_sample_time = None
+    self.sample_period = 0.0
+    self.gaps = 0
+    self.missed = 0
+    self.lag = 0.0
+    self.lag_max = 0.0
+
+
+  def record(self, recv_time, decode_ns, sample_time=None):
+    """
+    recv_time: host time (sec, libs.clock) the message was received
+    decode_ns: time spent in the handlers
+    sample_time: timestamp added by teensy_interface on the same time base, if the topic has one
+    """
+    if self.count == 0:
+      self.first_recv_time = recv_time
+    else:
+      interval = recv_time - self.last_recv_time
+      self.histogram[bisect_left(self.BUCKETS_SEC, interval)] += 1
+      if interval > self.interval_max:
+        self.interval_max = interval
+    self.last_recv_time = recv_time
+    self.count += 1
+
+    self.decode_ns_sum += decode_ns
+    if decode_ns > self.decode_ns_max:
+      self.decode_ns_max = decode_ns
+
+    if sample_time is not None:
+      self.__record_sample_time(recv_time, sample_time)
+
+
+  def __record_sample_time(self, recv_time, sample_time):
+    # How long the message took from teensy_interface to us
+    lag = recv_time - sample_time
+    self.lag = lag if self.count == 1 else self.lag + (lag - self.lag) * self.EMA_WEIGHT
+    if lag > self.lag_max:
+      self.lag_max = lag
+
+    if self.last_sample_time is not None:
+      dt = sample_time - self.last_sample_time
+      if self.count <= self.WARMUP_SAMPLES or self.sample_period <= 0:
+        # Average of the first intervals
+        self.sample_period += (dt - self.sample_period) / (self.count - 1)
+      elif dt > self.GAP_FACTOR * self.sample_period:
+        self.gaps += 1
+        self.missed += round(dt / self.sample_period) - 1
+      else:
+        self.sample_period += (dt - self.sample_period) * self.EMA_WEIGHT
+    self.last_sample_time = sample_time
+
+
+  def percentile(self, p):
+    """
+    Inter-arrival time (sec) below which p percent of the messages arrived: the bucket upper bound,
+    at most the longest interval seen (the last bucket is unbounded, json has no Infinity)
+    """
+    total = sum(self.histogram)
+    if total == 0:
+      return 0.0
+
+    target = total * p / 100
+    cumulative = 0
+    for bound, count in zip(self.BUCKETS_SEC, self.histogram):
+      cumulative += count
+      if cumulative >= target:
+        return min(bound, self.interval_max)
+    return self.interval_max
+
+
+  def as_dict(self):
+    elapsed = self.last_recv_time - self.first_recv_time
+    return {
+      'count': self.count,
+      'rate_hz': (self.count - 1) / elapsed if elapsed > 0 else 0.0,
+      'inter_arrival_ms': {f"p{p}": self.percentile(p) * 1000 for p in (50, 90, 99)},
+      'decode_us': {
+        'avg': self.decode_ns_sum / self.count / 1000 if self.count > 0 else 0.0,
+        'max': self.decode_ns_max / 1000,
+      },
+      'sample_period_ms': self.sample_period * 1000,
+      'gaps': self.gaps,
+      'missed_samples': self.missed,
+      'lag_ms': {'avg': self.lag * 1000, 'max': self.lag_max * 1000},
+    }
+
+
+
+class TelemetryReporter:
+  """
+  Publishes the MQTT telemetry periodically as json on a diagnostics topic
+  """
+  TOPIC = "robobot/diag/mqtt_client"
+  PUBLISH_INTERVAL_SEC = 5.0
+
+
+  def __init__(self, collect, send, interval=PUBLISH_INTERVAL_SEC):
+    """
+    collect() -> dict: telemetry to publish
+    send(topic, data): publishes a message
+    """
+    self.collect = collect
+    self.send = send
+    self.interval = interval
+    self.stop_event = Event()
+    self.thread = None
+
+
+  def start(self):
+    if self.interval <= 0:
+      return
+    self.thread = Thread(target=self.__handle, name="telemetry_reporter", daemon=True)
+    self.thread.start()
+
+
+  def stop(self):
+    self.stop_event.set()
+    if self.thread is not None:
+      self.thread.join()
+
+
+  def __handle(self):
+    while not self.stop_event.wait(self.interval):
+      self.send(self.TOPIC, json.dumps(self.collect()))
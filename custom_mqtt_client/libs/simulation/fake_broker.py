@@ -0,0 +1,149 @@
+from queue import SimpleQueue
+from threading import Lock, Thread
+from paho.mqtt.client import topic_matches_sub
+
+
+class FakeMessage:
+  __slots__ = ('topic', 'payload', 'qos', 'retain')
+
+  def __init__(self, topic, payload, qos=0, retain=False):
+    self.topic = topic
+    self.payload = payload
+    self.qos = qos
+    self.retain = retain
+
+
+
+class FakeBroker:
+  """
+  In-process stand-in for the mosquitto broker, routes messages between FakeClients
+  """
+
+  def __init__(self):
+    self.clients = []
+    self.lock = Lock()
+
+
+  def client(self, *args, **kwargs):
+    """
+    Creates a new client connected to this broker (same signature as the paho Client constructor)
+    """
+    client = FakeClient(self)
+    with self.lock:
+      self.clients.append(client)
+    return client
+
+
+  def publish(self, topic, payload, qos=0, retain=False):
+    with self.lock:
+      clients = list(self.clients)
+
+    for client in clients:
+      if client.is_subscribed(topic):
+        client.deliver(FakeMessage(topic, payload, qos, retain))
+
+
+
+class FakeClient:
+  """
+  Implements the part of the paho Client API used by MqttService and the scripts.
+  Like paho, callbacks are called from the network loop thread started by loop_start()
+  """
+  on_connect = None
+  on_disconnect = None
+  on_subscribe = None
+  on_message = None
+
+  def __init__(self, broker):
+    self.broker = broker
+    self.subscriptions = {}
+    self.events = SimpleQueue()
+    self.thread = None
+    self.mid = 0
+
+
+  def __next_mid(self):
+    self.mid += 1
+    return self.mid
+
+
+  def reconnect_delay_set(self, min_delay=1, max_delay=120):
+    pass
+
+
+  def connect(self, host, port=1883, keepalive=60):
+    self.events.put(lambda: self.on_connect and self.on_connect(self, None, {}, 0))
+    return 0
+
+
+  connect_async = connect
+
+
+  def disconnect(self):
+    self.events.put(lambda: self.on_disconnect and self.on_disconnect(self, None, 0))
+    return 0
+
+
+  def loop_start(self):
+    if self.thread is None:
+      self.thread = Thread(target=self.__loop, name="fake_mqtt_loop", daemon=True)
+      self.thread.start()
+    return 0
+
+
+  def loop_stop(self):
+    if self.thread is None:
+      return 0
+    self.events.put(None)
+    self.thread.join()
+    self.thread = None
+    return 0
+
+
+  def subscribe(self, topic, qos=0):
+    topics = topic if isinstance(topic, list) else [(topic, qos)]
+    for sub, sub_qos in topics:
+      self.subscriptions[sub] = sub_qos
+
+    mid = self.__next_mid()
+    granted_qos = tuple(sub_qos for _, sub_qos in topics)
+    self.events.put(lambda: self.on_subscribe and self.on_subscribe(self, None, mid, granted_qos))
+    return (0, mid)
+
+
+  def unsubscribe(self, topic):
+    topics = topic if isinstance(topic, list) else [topic]
+    for sub in topics:
+      self.subscriptions.pop(sub, None)
+    return (0, self.__next_mid())
+
+
+  def publish(self, topic, payload=None, qos=0, retain=False):
+    if payload is None:
+      payload = b""
+    elif isinstance(payload, str):
+      payload = payload.encode()
+    elif not isinstance(payload, bytes):
+      payload = str(payload).encode()
+
+    self.broker.publish(topic, payload, qos, retain)
+    return (0, self.__next_mid())
+
+
+  def is_subscribed(self, topic):
+    for sub in list(self.subscriptions):
+      if topic_matches_sub(sub, topic):
+        return True
+    return False
+
+
+  def deliver(self, message):
+    self.events.put(lambda: self.on_message and self.on_message(self, None, message))
+
+
+  def __loop(self):
+    while True:
+      event = self.events.get()
+      if event is None:
+        break
+      event()
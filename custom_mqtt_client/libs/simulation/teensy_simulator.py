@@ -0,0 +1,294 @@
+import math
+import random
+from collections import deque
+from threading import Event, Thread
+from time import monotonic, time
+
+
+class DifferentialDrive:
+  """
+  Differential drive robot, the wheel velocities follow their reference with a first order response
+  """
+  WHEEL_BASE = 0.23           # m
+  WHEEL_RADIUS = 0.075        # m
+  GEAR = 19
+  TICK_PER_REVOLUTION = 68
+  TIME_CONSTANT = 0.05        # s
+  VELOCITY_PER_VOLT = 0.1     # m/s per V at steady state
+
+
+  def __init__(self):
+    self.reset()
+    self.left = 0.0
+    self.right = 0.0
+    self.left_ref = 0.0
+    self.right_ref = 0.0
+    self.voltages = (0.0, 0.0)
+
+
+  def reset(self):
+    self.x = 0.0
+    self.y = 0.0
+    self.heading = 0.0
+
+
+  def set_velocity(self, velocity, turnrate):
+    """
+    ti/rc: forward velocity (m/s) and turnrate (rad/s, positive is left)
+    """
+    self.left_ref = velocity - turnrate * self.WHEEL_BASE / 2
+    self.right_ref = velocity + turnrate * self.WHEEL_BASE / 2
+    self.voltages = (self.left_ref / self.VELOCITY_PER_VOLT, self.right_ref / self.VELOCITY_PER_VOLT)
+
+
+  def set_voltages(self, left, right):
+    """
+    T0/motv: raw motor voltages
+    """
+    self.voltages = (left, right)
+    self.left_ref = left * self.VELOCITY_PER_VOLT
+    self.right_ref = right * self.VELOCITY_PER_VOLT
+
+
+  def velocity(self):
+    return (self.left + self.right) / 2
+
+
+  def turnrate(self):
+    return (self.right - self.left) / self.WHEEL_BASE
+
+
+  def step(self, dt):
+    a = min(1.0, dt / self.TIME_CONSTANT)
+    self.left += (self.left_ref - self.left) * a
+    self.right += (self.right_ref - self.right) * a
+
+    v = self.velocity()
+    self.heading += self.turnrate() * dt
+    self.x += v * math.cos(self.heading) * dt
+    self.y += v * math.sin(self.heading) * dt
+
+
+  def wrapped_heading(self):
+    return math.atan2(math.sin(self.heading), math.cos(self.heading))
+
+
+
+class TeensySimulator:
+  """
+  Stand-in for the Teensy and teensy_interface: publishes the robobot/drive/T0/* topics at
+  configurable rates from a differential drive model driven by ti/rc and T0/motv commands.
+
+  The track is a straight white line along the x axis (y = 0), seen by the simulated line sensor.
+  Works with a paho Client connected to a broker, or with a FakeBroker client.
+  """
+  DRIVE_TOPIC = "robobot/drive/"
+  CMD_TOPIC = "robobot/cmd/"
+
+  RATES_HZ = {
+    "T0/hbt": 1,
+    "T0/dname": 1,
+    "T0/conf": 0.2,
+    "T0/livn": 100,
+    "T0/pose": 100,
+    "T0/vel": 100,
+    "T0/mvel": 50,
+    "T0/gyro": 100,
+    "T0/acc": 100,
+    "T0/ird": 20,
+    "T0/mot": 20,
+  }
+  PHYSICS_HZ = 500
+  ROBOT_NAME = "simulated"
+
+  # Line sensor geometry and response
+  LINE_SENSOR_OFFSET = 0.2    # m ahead of the wheel axis
+  LINE_SENSOR_SPACING = 0.012 # m between sensors, sensor 0 is the leftmost
+  LINE_WIDTH_SIGMA = 0.01     # m
+  LINE_NOISE = 15
+  FLOOR_LEVEL = 60
+
+  IR_MAX_DISTANCE = 2.0       # m
+  LATENCY_SAMPLES = 10000
+
+
+  def __init__(self, client, rate_scale=1.0, rates_hz=None, seed=None):
+    """
+    rate_scale multiplies every publish rate (e.g. 10 for a stress test)
+    """
+    self.client = client
+    self.robot = DifferentialDrive()
+    self.random = random.Random(seed)
+    self.periods = {}
+    for topic, rate in (self.RATES_HZ if rates_hz is None else rates_hz).items():
+      self.periods[topic] = 1 / (rate * rate_scale)
+
+    self.start_time = monotonic()
+    self.stop_event = Event()
+    self.thread = None
+    self.obstacle_distance = self.IR_MAX_DISTANCE
+
+    # Statistics
+    self.published_counter = {topic: 0 for topic in self.periods}
+    self.command_counter = {}
+    self.last_livn_time = None
+    self.control_latencies = deque(maxlen=self.LATENCY_SAMPLES)
+
+
+  def start(self):
+    self.client.on_message = self.on_message
+    self.client.subscribe(self.CMD_TOPIC + "#")
+    self.client.loop_start()
+
+    self.start_time = monotonic()
+    self.thread = Thread(target=self.__handle, name="teensy_simulator", daemon=True)
+    self.thread.start()
+
+
+  def stop(self):
+    self.stop_event.set()
+    if self.thread is not None:
+      self.thread.join()
+
+
+  ##### COMMANDS #####
+
+  def on_message(self, client, userdata, msg):
+    subtopic = msg.topic[len(self.CMD_TOPIC):]
+    parts = msg.payload.decode().split()
+    self.command_counter[subtopic] = self.command_counter.get(subtopic, 0) + 1
+
+    if subtopic == "ti/rc" and len(parts) >= 2:
+      # Latency from the newest line sample to the control command it produced
+      if self.last_livn_time is not None:
+        self.control_latencies.append(monotonic() - self.last_livn_time)
+      self.robot.set_velocity(float(parts[0]), float(parts[1]))
+
+    elif subtopic == "T0/motv" and len(parts) >= 2:
+      self.robot.set_voltages(float(parts[0]), float(parts[1]))
+
+    elif subtopic == "T0/stop":
+      self.robot.set_velocity(0, 0)
+
+    elif subtopic == "T0/enc0":
+      self.robot.reset()
+
+    elif subtopic == "T0/confi":
+      self.__publish("T0/conf")
+
+    elif subtopic == "ti/alive":
+      # teensy_interface tells who is the master client
+      self.client.publish(self.DRIVE_TOPIC + "master", f"{time()} {' '.join(parts)}")
+
+
+  ##### TOPICS #####
+
+  def teensy_time(self):
+    return monotonic() - self.start_time
+
+
+  def line_values(self):
+    robot = self.robot
+    cos_h = math.cos(robot.heading)
+    sin_h = math.sin(robot.heading)
+    # Lateral position of the sensor bar centre relative to the line (y = 0)
+    y_centre = robot.y + self.LINE_SENSOR_OFFSET * sin_h
+
+    values = []
+    for i in range(8):
+      lateral = (3.5 - i) * self.LINE_SENSOR_SPACING
+      distance = y_centre + lateral * cos_h
+      v = self.FLOOR_LEVEL + (1000 - self.FLOOR_LEVEL) * math.exp(-distance**2 / (2 * self.LINE_WIDTH_SIGMA**2))
+      v += self.random.gauss(0, self.LINE_NOISE)
+      values.append(int(min(max(v, 0), 1000)))
+    return values
+
+
+  def payload(self, topic):
+    t = time()
+    robot = self.robot
+
+    if topic == "T0/hbt":
+      return f"{t} {self.teensy_time():.4f} 1 1 12.0 2"
+    elif topic == "T0/dname":
+      return f"{t} {self.ROBOT_NAME}"
+    elif topic == "T0/conf":
+      return f"{t} {robot.WHEEL_RADIUS} {robot.WHEEL_RADIUS} {robot.GEAR} {robot.TICK_PER_REVOLUTION} {robot.WHEEL_BASE} 0 1"
+    elif topic == "T0/livn":
+      return f"{t} " + " ".join(map(str, self.line_values()))
+    elif topic == "T0/pose":
+      return f"{t} {self.teensy_time():.4f} {robot.x:.4f} {robot.y:.4f} {robot.wrapped_heading():.4f} 0.0"
+    elif topic == "T0/vel":
+      return f"{t} {self.teensy_time():.4f} {robot.left:.4f} {robot.right:.4f}"
+    elif topic == "T0/mvel":
+      k = robot.GEAR / robot.WHEEL_RADIUS
+      return f"{t} {robot.left * k:.3f} {robot.right * k:.3f}"
+    elif topic == "T0/gyro":
+      gz = math.degrees(robot.turnrate()) + self.random.gauss(0, 0.3)
+      return f"{t} {self.random.gauss(0, 0.3):.3f} {self.random.gauss(0, 0.3):.3f} {gz:.3f}"
+    elif topic == "T0/acc":
+      return f"{t} {self.random.gauss(0, 0.01):.4f} {self.random.gauss(0, 0.01):.4f} {1 + self.random.gauss(0, 0.01):.4f}"
+    elif topic == "T0/ird":
+      return f"{t} {self.IR_MAX_DISTANCE:.3f} {self.obstacle_distance:.3f}"
+    elif topic == "T0/mot":
+      return f"{t} {robot.voltages[0]:.2f} {robot.voltages[1]:.2f} 0.0 0.0 0.0"
+    return None
+
+
+  def __publish(self, topic):
+    payload = self.payload(topic)
+    if payload is None:
+      return
+    self.client.publish(self.DRIVE_TOPIC + topic, payload)
+    self.published_counter[topic] = self.published_counter.get(topic, 0) + 1
+    if topic == "T0/livn":
+      self.last_livn_time = monotonic()
+
+
+  def __handle(self):
+    physics_period = 1 / self.PHYSICS_HZ
+    last_step = monotonic()
+    next_physics = last_step
+    next_publish = {topic: last_step for topic in self.periods}
+
+    while not self.stop_event.is_set():
+      now = monotonic()
+
+      if now >= next_physics:
+        self.robot.step(now - last_step)
+        last_step = now
+        next_physics += physics_period
+
+      for topic, next_time in next_publish.items():
+        if now >= next_time:
+          self.__publish(topic)
+          period = self.periods[topic]
+          # Do not try to catch up when falling behind
+          next_publish[topic] = next_time + period if now - next_time < period else now + period
+
+      wake_up = min(next_physics, min(next_publish.values()))
+      self.stop_event.wait(max(0.0, wake_up - monotonic()))
+
+
+  def stats(self):
+    elapsed = monotonic() - self.start_time
+    rates = {topic: count / elapsed for topic, count in self.published_counter.items()} if elapsed > 0 else {}
+
+    latencies = sorted(self.control_latencies)
+    latency_ms = {}
+    if latencies:
+      latency_ms = {
+        'count': len(latencies),
+        'mean': sum(latencies) / len(latencies) * 1000,
+        'p50': latencies[len(latencies) // 2] * 1000,
+        'p95': latencies[int(len(latencies) * 0.95)] * 1000,
+        'max': latencies[-1] * 1000,
+      }
+
+    return {
+      'elapsed_sec': elapsed,
+      'published': dict(self.published_counter),
+      'rates_hz': rates,
+      'commands': dict(self.command_counter),
+      'control_latency_ms': latency_ms,
+    }
@@ -8,7 +8,9 @@ from libs.commands import *
 from libs.args import arg_parser
 from libs.services.mqtt_service import mqtt_service
 from libs.services.data_logger_service import data_logger_service
+from libs.services.health_monitor import health_monitor, HealthAction
 from libs.sensors.odometry import odometry
+from modules.line_follower.line_follower import line_follower
 from threading import Thread
 
 
@@ -33,6 +35,7 @@ class StateMachine:
         self.logger = Logger('state_machine')
         self.state: State = State.WAITING
         self.old_state: State = State.NONE
+        self.health_action = HealthAction.NONE
         self.handle_going_state = handle_going_state
         self.logger.info("State machine initialized")
 
@@ -90,6 +93,19 @@ class StateMachine:
         ROBOT_stop_movement()
 
 
+    def __check_health(self) -> HealthAction:
+        """
+        Stop on a stale critical stream, drive slower while any stream is outside its budget
+        """
+        action = health_monitor.action()
+        if action != self.health_action:
+            self.logger.warning(f"Stream health changed from {self.health_action.name} to {action.name}: {health_monitor.unhealthy()}")
+            data_logger_service.write_comment(f"STATE_MACHINE - Stream health {action.name}")
+            line_follower.set_speed_limit(line_follower.DEGRADED_SPEED if action == HealthAction.DEGRADE else None)
+            self.health_action = action
+        return action
+
+
     def __handle_extra_buttons(self) -> None:
         # Check for auto-pulling git
         if gpio.pin(self.AUTO_PULL_BTN).get():
@@ -120,6 +136,12 @@ class StateMachine:
                 self.__handle_extra_buttons()
 
         elif self.state == State.GOING:
+            # Do not keep driving on frozen sensor data
+            if self.__check_health() == HealthAction.STOP:
+                self.logger.error(f"Stopping, stale sensor streams: {health_monitor.unhealthy()}")
+                self.__stop_robot()
+                return
+
             # Delegate the main logic to the handle_going_state function
             finished = self.handle_going_state()
 
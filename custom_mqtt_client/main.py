@@ -3,10 +3,14 @@ import signal
 import os
 import glob
 from modules.line_follower.line_follower import line_follower
+from modules.line_follower.intersection_detector import intersection_detector
+from modules.line_follower.line_control import line_control
+from modules.line_follower.manoeuvre_engine import manoeuvre_engine
 from libs.services.gpio_service import gpio
 from libs.services.mqtt_service import mqtt_service
 from libs.args import arg_parser
 from libs.services.data_logger_service import data_logger_service
+from libs.services.health_monitor import health_monitor
 from libs.robot import robot
 from libs.commands import *
 from libs.state_machine import StateMachine
@@ -15,11 +19,15 @@ from libs.sensors.odometry import odometry
 from libs.sensors.ir import ir
 from libs.sensors.line import line_sensor
 from libs.sensors.motor import motor
+from libs.base.sensor import wait_for_sensors
+from libs.clock import clock
 from modules.path.path import Path
 from libs.logger import Logger
 from modules.camera.camera_service import camera_service
 from modules.golf_ball.golf_ball_follower import golf_ball_follower
 from modules.hole.hole_follower import hole_follower
+from libs.simulation.fake_broker import FakeBroker
+from libs.simulation.teensy_simulator import TeensySimulator
 
 
 # Set title of process, so that it is not just called Python
@@ -40,55 +48,103 @@ def clean_log_folder():
 
 clean_log_folder()
 main_logger = Logger('main')
+teensy_simulator = None
 
 
 ############################################################
 
 
-def on_mqtt_message(topic, msg):
-  imu.decode(topic, msg)
-  odometry.decode(topic, msg)
-  ir.decode(topic, msg)
-  robot.decode(topic, msg)
-  motor.decode(topic, msg)
-  if line_sensor.decode(topic, msg):
-    line_follower.update()
+def register_mqtt_handlers():
+  router = mqtt_service.router
+
+  robot.register(router)
+  imu.register(router)
+  odometry.register(router)
+  ir.register(router)
+  motor.register(router)
+  line_sensor.register(router)
+  # Registered after the line sensor, so it runs on the freshly decoded values
+  router.register("T0/livn", lambda parts: line_control.notify())
+  # The closed-loop manoeuvre steps run on every odometry sample
+  router.register("T0/pose", lambda parts: manoeuvre_engine.notify())
+  router.register("T0/vel", lambda parts: manoeuvre_engine.notify())
+
+
+def setup_simulation():
+  global teensy_simulator
+
+  main_logger.info("Simulating the Teensy with an in-process broker")
+  broker = FakeBroker()
+  mqtt_service.client_factory = broker.client
+  teensy_simulator = TeensySimulator(broker.client())
+  teensy_simulator.start()
+
+
+def setup_health_monitor():
+  health_monitor.watch("T0/livn", line_sensor.history)
+  health_monitor.watch("T0/vel", odometry.wheel_velocity_history)
+  health_monitor.watch("T0/pose", odometry.pose_history)
+  health_monitor.watch("T0/gyro", imu.gyro_history)
+  health_monitor.watch("T0/acc", imu.acc_history)
+  health_monitor.watch("T0/ird", ir.history)
+  health_monitor.watch("T0/mot", motor.history)
+  health_monitor.setup(mqtt_service.router)
+
+
+def log_phase(name, phase_start):
+  """
+  Logs how long a setup phase took, returns the start of the next phase
+  """
+  now = clock.now()
+  main_logger.info(f"{name} done in {(now - phase_start) * 1000:.0f} ms")
+  return now
 
 
 def setup():
   main_logger.info("Starting")
+  setup_start = phase_start = clock.now()
+
+  if arg_parser.get('simulate'):
+    setup_simulation()
 
   line_follower.setup()
+  intersection_detector.setup(line_follower.line_detector)
+  line_control.start(line_follower, intersection_detector)
+  manoeuvre_engine.setup(line_follower)
   # Set location of MQTT data server
-  mqtt_service.setup(on_mqtt_message)
+  register_mqtt_handlers()
+  mqtt_service.setup()
   ROBOT_stop_movement()
+  phase_start = log_phase("MQTT", phase_start)
 
   # Allow close down on ctrl-C
   signal.signal(signal.SIGINT, lambda sig, frame: (print('[!] You pressed Ctrl+C! Shutting down...'), mqtt_service.terminate(), ROBOT_stop_movement(), exit()))
+  # Dump the MQTT telemetry to the log with: kill -USR1 <pid>
+  signal.signal(signal.SIGUSR1, lambda sig, frame: mqtt_service.dump_telemetry())
 
   # Services
   main_logger.info("Setting up services...")
   data_logger_service.setup()
   gpio.setup()
   camera_service.setup()
-  main_logger.info("Services done!")
+  phase_start = log_phase("Services", phase_start)
 
-  # Sensors
+  # Sensors, waiting for all of them at once
   main_logger.info("Setting up sensors...")
-  ir.wait_for_data()
-  odometry.wait_for_data()
-  imu.wait_for_data() 
-  motor.wait_for_data()
-  line_sensor.wait_for_data()
-  main_logger.info("Sensors done!")
+  missing = wait_for_sensors([ir, odometry, imu, motor, line_sensor])
+  if missing:
+    main_logger.error(f"No data from sensors: {', '.join(missing)}")
+    raise Exception(f"No data from sensors: {', '.join(missing)}")
+  setup_health_monitor()
+  phase_start = log_phase("Sensors", phase_start)
 
   # Modules
   main_logger.info("Setting up modules...")
   golf_ball_follower.setup(camera_service)
   #hole_follower.setup(camera_service)
-  main_logger.info("Modules done!")
+  log_phase("Modules", phase_start)
 
-  main_logger.info("Everything was successfully setup")
+  main_logger.info(f"Everything was successfully setup in {(clock.now() - setup_start) * 1000:.0f} ms")
   LED_mission_restarting()
 
   if not arg_parser.get('now'):
@@ -108,11 +164,19 @@ def teardown():
   ROBOT_stop_movement() # Stop moving
 
   mqtt_service.terminate()
+  health_monitor.terminate()
   data_logger_service.terminate()
+  manoeuvre_engine.terminate()
+  line_control.stop()
   line_follower.terminate()
   camera_service.terminate()
 
+  if teensy_simulator is not None:
+    teensy_simulator.stop()
+    main_logger.info(f"Simulator stats: {teensy_simulator.stats()}")
+
   main_logger.info("TERMINATED, now I'm dead, good job >:(")
+  Logger.complete()
 
 
 ############################################################
@@ -138,6 +202,7 @@ if __name__ == "__main__":
 
     main_logger.error(f"ERROR! {e}")
     main_logger.error("Main Terminated (should not happen, unless robot is shut down)")
+    Logger.complete()
 
     raise
 
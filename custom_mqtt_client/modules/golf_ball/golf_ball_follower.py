@@ -1,7 +1,8 @@
-from statistics import median
 from time import time
-from libs.logger import Logger
+import numpy as np
+from libs.logger import Logger, console
 from libs.services.mqtt_service import mqtt_service
+from libs.base.ring_buffer import RingBuffer
 
 
 class GolfBallFollower:
@@ -14,12 +15,12 @@ class GolfBallFollower:
         self.last_error = 0.0  # For derivative control
         self.velocity = 0.0    # Forward speed of the robot
         self.turn_speed = 0.0  # Initial turn speed
-        self.z_history = []    # Store last 10 z_mm positions
+        self.z_history = RingBuffer(("time", "z_mm"), 10)    # Store last 10 z_mm positions
 
     def follow_ball(self):
         self.calculate_turn_speed()
-        mqtt_service.send_cmd("ti/rc", f"{self.velocity} {-self.turn_speed} {time()}")
-        self.logger.info(f"Following ball: velocity={self.velocity}, turn_speed={self.turn_speed}")
+        mqtt_service.send_cmd("ti/rc", (self.velocity, -self.turn_speed, time()))
+        self.logger.info("Following ball: velocity={}, turn_speed={}", self.velocity, self.turn_speed)
 
     def stop_ball_follower(self):
         mqtt_service.send_cmd("ti/rc", f"{0} {0} {time()}")
@@ -40,24 +41,22 @@ class GolfBallFollower:
         ball_z_mm = self.camera_service.ball['z_mm']
 
 
-        print(f'Calculating turn speed x:{ball_x}; z_mm:{ball_z_mm}')
+        console.print('Calculating turn speed x:{}; z_mm:{}', ball_x, ball_z_mm)
         if not ball_detected:
-            print('Not detecting the ball')
+            console.print('Not detecting the ball')
             self.logger.info("No ball detected, stopping rotation.")
             self.turn_speed = 0.0
             self.velocity = 0.0
             return
         
         # Update z_history with latest z_mm value
-        self.z_history.append(ball_z_mm)
-        if len(self.z_history) > 10:
-            self.z_history.pop(0)
+        self.z_history.append((time(), ball_z_mm))
 
         # If we have 10 frames, use median to validate stability
         if len(self.z_history) == 10:
-            z_median = median(self.z_history)
-            if any(abs(z - z_median) > 10 for z in self.z_history):
-                print("Z_mm values too inconsistent, skipping update.")
+            z = self.z_history.last(10)[:, 1]
+            if np.any(np.abs(z - np.median(z)) > 10):
+                console.print("Z_mm values too inconsistent, skipping update.")
                 return
             
 
@@ -80,7 +79,7 @@ class GolfBallFollower:
         self.KP = 1.5
         self.KD = 0.0
         self.gamma = 2.0
-        self.z_history = []
+        self.z_history.clear()
 
     def set_ball_follower(self, velocity):
         if self.velocity == 0 and velocity != 0:
@@ -1,7 +1,8 @@
-from statistics import median
 from time import time
-from libs.logger import Logger
+import numpy as np
+from libs.logger import Logger, console
 from libs.services.mqtt_service import mqtt_service
+from libs.base.ring_buffer import RingBuffer
 
 class HoleFollower:
 
@@ -14,7 +15,7 @@ class HoleFollower:
         self.last_error = 0.0  # For derivative control
         self.velocity = 0.0    # Forward speed of the robot
         self.turn_speed = 0.0  # Initial turn speed
-        self.z_history = []    # Store last 10 z_mm positions
+        self.z_history = RingBuffer(("time", "z_mm"), 10)    # Store last 10 z_mm positions
 
     def setup(self, camera_service):
         self.logger = Logger('hole_follower')
@@ -33,8 +34,8 @@ class HoleFollower:
 
     def follow_hole(self):
         self.calculate_turn_speed()
-        mqtt_service.send_cmd("ti/rc", f"{self.velocity} {-self.turn_speed} {time()}")
-        self.logger.info(f"Following hole: velocity={self.velocity}, turn_speed={-self.turn_speed}")
+        mqtt_service.send_cmd("ti/rc", (self.velocity, -self.turn_speed, time()))
+        self.logger.info("Following hole: velocity={}, turn_speed={}", self.velocity, -self.turn_speed)
 
     def calculate_turn_speed(self):
 
@@ -42,24 +43,22 @@ class HoleFollower:
         hole_x = self.camera_service.hole['x']
         hole_z_mm = self.camera_service.hole['z_mm']
 
-        print(f'Calculating turn speed x:{hole_x}; z_mm:{hole_z_mm}')
+        console.print('Calculating turn speed x:{}; z_mm:{}', hole_x, hole_z_mm)
 
         if not hole_detected:
-            print('Not detecting the hole')
+            console.print('Not detecting the hole')
             self.logger.info("No hole detected, rotating.")
             self.turn_speed = 0.05
             return
         
         # Update z_history with latest z_mm value
-        self.z_history.append(hole_z_mm)
-        if len(self.z_history) > 10:
-            self.z_history.pop(0)
+        self.z_history.append((time(), hole_z_mm))
 
         # If we have 10 frames, use median to validate stability
         if len(self.z_history) == 10:
-            z_median = median(self.z_history)
-            if any(abs(z - z_median) > 10 for z in self.z_history):
-                print("Z_mm values too inconsistent, skipping update.")
+            z = self.z_history.last(10)[:, 1]
+            if np.any(np.abs(z - np.median(z)) > 10):
+                console.print("Z_mm values too inconsistent, skipping update.")
                 return
             
 
@@ -82,7 +81,7 @@ class HoleFollower:
         self.KP = 1.5
         self.KD = 0.0
         self.gamma = 2.0
-        self.z_history = []
+        self.z_history.clear()
 
     def set_hole_follower(self, velocity):
         if self.velocity == 0 and velocity != 0:
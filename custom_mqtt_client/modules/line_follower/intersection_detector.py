@@ -0,0 +1,148 @@
+from collections import deque, namedtuple
+from enum import Enum, auto
+from libs.logger import Logger
+from libs.sensors.odometry import odometry
+
+
+# kind: 'intersection' or '90', time: sample time (sec, libs.clock), distance: odometry total_dist (m)
+IntersectionEvent = namedtuple('IntersectionEvent', ['kind', 'time', 'distance', 'update_count'])
+
+
+class DetectorState(Enum):
+    CLEAR = auto()
+    ENTERING = auto()
+    ON_INTERSECTION = auto()
+    LEAVING = auto()
+
+
+class IntersectionDetector:
+    """
+    Turns the intersection flags of every line sample into one event per intersection.
+
+    Runs on the line control thread (line_control.py) for every new line sample, after the line follower so the
+    detection is cached and the detector is only used from that thread.
+    An intersection starts after ENTER_SAMPLES samples with a flag and ends after EXIT_SAMPLES samples
+    without (hysteresis). Its event is latched when it starts, unless the robot travelled less than
+    MIN_TRAVEL_DISTANCE since the previous event. Events wait in a queue until Path pops them.
+    """
+    ENTER_SAMPLES = 2
+    EXIT_SAMPLES = 5
+    MIN_TRAVEL_DISTANCE = 0.05 # m
+    MAX_EVENTS = 32
+
+
+    def __init__(self):
+        self.line_detector = None
+        self.events = deque(maxlen=self.MAX_EVENTS)
+        self.event_counter = 0
+        self.rejected_counter = 0
+        self.last_event_distance = None
+        self.reset()
+
+
+    def setup(self, line_detector):
+        """
+        line_detector: the detector of the line follower, its result is shared
+        """
+        self.logger = Logger('intersection_detector')
+        self.line_detector = line_detector
+
+
+    def reset(self):
+        self.state = DetectorState.CLEAR
+        self.counter = 0
+        self.kind = None
+
+
+    def update(self):
+        """
+        Called by the line control thread for every new line sample
+        """
+        if self.line_detector is None:
+            return
+
+        result = self.line_detector.detect()
+        detected = result.is_intersection or result.is_90_intersection
+
+        if self.state == DetectorState.CLEAR:
+            if detected:
+                self.state = DetectorState.ENTERING
+                self.counter = 1
+                self.kind = '90' if result.is_90_intersection else 'intersection'
+                self.__check_entered(result)
+
+        elif self.state == DetectorState.ENTERING:
+            if detected:
+                self.counter += 1
+                self.__check_entered(result)
+            else:
+                # A glitch, not an intersection
+                self.reset()
+
+        elif self.state == DetectorState.ON_INTERSECTION:
+            if not detected:
+                self.state = DetectorState.LEAVING
+                self.counter = 1
+                self.__check_left()
+
+        elif self.state == DetectorState.LEAVING:
+            if detected:
+                self.state = DetectorState.ON_INTERSECTION
+            else:
+                self.counter += 1
+                self.__check_left()
+
+
+    def __check_entered(self, result):
+        if self.counter < self.ENTER_SAMPLES:
+            return
+        self.state = DetectorState.ON_INTERSECTION
+
+        distance = odometry.total_dist
+        if self.last_event_distance is not None and abs(distance - self.last_event_distance) < self.MIN_TRAVEL_DISTANCE:
+            self.rejected_counter += 1
+            self.logger.debug("Rejected {} intersection, {:.3f} m from the previous one", self.kind, abs(distance - self.last_event_distance))
+            return
+
+        event = IntersectionEvent(self.kind, result.time, distance, result.update_count)
+        self.last_event_distance = distance
+        self.events.append(event)
+        self.event_counter += 1
+        self.logger.info("Intersection event {}: {}", self.event_counter, event)
+
+
+    def __check_left(self):
+        if self.counter >= self.EXIT_SAMPLES:
+            self.reset()
+
+
+    ##### EVENTS #####
+
+    def pop_event(self):
+        """
+        Oldest event not handled yet, None if there is none
+        """
+        try:
+            return self.events.popleft()
+        except IndexError:
+            return None
+
+
+    def clear(self):
+        """
+        Drop the waiting events, e.g. the lines crossed while turning at an intersection
+        """
+        self.events.clear()
+
+
+    def stats(self):
+        return {
+            'events': self.event_counter,
+            'rejected': self.rejected_counter,
+            'waiting': len(self.events),
+            'state': self.state.name,
+        }
+
+
+
+intersection_detector = IntersectionDetector()
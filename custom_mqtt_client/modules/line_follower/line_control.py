@@ -0,0 +1,129 @@
+from threading import Event, Thread
+from libs.base.running_stats import RunningStats
+from libs.clock import clock
+from libs.logger import Logger
+from libs.sensors.line import line_sensor
+
+
+class LineControlExecutor:
+    """
+    Runs the line follower (detection, PID, ti/rc command) and then the intersection detector on its own thread,
+    the only thread running the line detection and the PID.
+
+    The MQTT thread only calls notify() for every line sample, it never copies the sample or waits for
+    the controller: the executor reads the newest sample itself (lock-free line_sensor snapshot). It runs once per new sample, or at a fixed rate when
+    rate_hz is given. Measures the jitter of the runs and the latency from the sample to the command.
+    """
+    RATE_HZ = None          # None: run on every new sample
+    IDLE_TIMEOUT_SEC = 0.1  # wake up without samples, to notice stop()
+
+
+    def __init__(self, rate_hz=RATE_HZ):
+        self.rate_hz = rate_hz
+        self.wakeup = Event()
+        self.running = False
+        self.thread = None
+        self.line_follower = None
+        self.intersection_detector = None
+        self.reset_stats()
+
+
+    def reset_stats(self):
+        self.last_update_count = -1
+        self.last_run_time = None
+        self.run_counter = 0
+        self.skipped_counter = 0   # runs without a new sample
+        self.dropped_counter = 0   # samples never controlled on (more than one arrived between runs)
+        self.interval = RunningStats(1)
+        self.interval_max = 0.0
+        self.latency = RunningStats(1)
+        self.latency_max = 0.0
+
+
+    def start(self, line_follower, intersection_detector=None):
+        self.logger = Logger('line_control')
+        self.line_follower = line_follower
+        self.intersection_detector = intersection_detector
+        self.running = True
+        self.thread = Thread(target=self.__handle, name="line_control", daemon=True)
+        self.thread.start()
+        self.logger.info(f"Started, {'every sample' if self.rate_hz is None else f'{self.rate_hz} Hz'}")
+
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+            self.logger.info(f"Stopped: {self.stats()}")
+
+
+    def notify(self):
+        """
+        Called by the MQTT thread for every line sample
+        """
+        if self.rate_hz is None:
+            self.wakeup.set()
+
+
+    def __handle(self):
+        period = 1 / self.rate_hz if self.rate_hz is not None else self.IDLE_TIMEOUT_SEC
+        next_run = clock.now() + period
+
+        while self.running:
+            if self.rate_hz is None:
+                self.wakeup.wait(period)
+                self.wakeup.clear()
+            else:
+                self.wakeup.wait(max(0.0, next_run - clock.now()))
+                next_run += period
+            if not self.running:
+                break
+            self.__run()
+
+
+    def __run(self):
+        # Consistent with the sample the detector will read
+        sample = line_sensor.snapshot()
+        update_count = sample.update_count
+        if update_count == self.last_update_count:
+            self.skipped_counter += 1
+            return
+        if self.last_update_count >= 0 and update_count - self.last_update_count > 1:
+            self.dropped_counter += update_count - self.last_update_count - 1
+        self.last_update_count = update_count
+
+        start = clock.now()
+        if self.last_run_time is not None:
+            interval = start - self.last_run_time
+            self.interval.update((interval,))
+            self.interval_max = max(self.interval_max, interval)
+        self.last_run_time = start
+
+        self.line_follower.update()
+        self.run_counter += 1
+
+        # From receiving the sample to the command handed to the publisher
+        if self.line_follower.velocity > 0 and not self.line_follower.suspended:
+            latency = clock.now() - sample.recv_time
+            self.latency.update((latency,))
+            self.latency_max = max(self.latency_max, latency)
+
+        # Reads the detection cached by the line follower for this sample
+        if self.intersection_detector is not None:
+            self.intersection_detector.update()
+
+
+    def stats(self):
+        return {
+            'runs': self.run_counter,
+            'skipped': self.skipped_counter,
+            'dropped_samples': self.dropped_counter,
+            'interval_ms': {'mean': self.interval.mean[0] * 1000, 'std': self.interval.std(0) * 1000, 'max': self.interval_max * 1000},
+            'latency_ms': {'mean': self.latency.mean[0] * 1000, 'std': self.latency.std(0) * 1000, 'max': self.latency_max * 1000},
+        }
+
+
+
+line_control = LineControlExecutor()
@@ -1,8 +1,106 @@
-from time import time
+from collections import namedtuple
 import numpy as np
+from libs.clock import clock
 from libs.sensors.line import line_sensor
 
 
+class DetectionResult:
+  """
+  Everything derived from one line sample, computed in one pass and shared by every consumer.
+  time is the timestamp of that sample (sec, libs.clock), None before the first one
+  """
+  __slots__ = ('update_count', 'time', 'position', 'is_line_valid', 'is_crossing_line', 'active_sensors',
+               'is_intersection', 'is_90_intersection')
+
+  def __init__(self, update_count=-1, time=None, position=0, is_line_valid=False, is_crossing_line=False,
+               active_sensors=(0,) * line_sensor.NUM_OF_SENSORS, is_intersection=False, is_90_intersection=False):
+    self.update_count = update_count
+    self.time = time
+    self.position = position
+    self.is_line_valid = is_line_valid
+    self.is_crossing_line = is_crossing_line
+    self.active_sensors = active_sensors
+    self.is_intersection = is_intersection
+    self.is_90_intersection = is_90_intersection
+
+
+# Results of detect_batch, one row per sample
+DetectionBatch = namedtuple('DetectionBatch', [
+  'positions',          # (N,) position as returned by detect: held while the line is not valid, nan without a peak
+  'raw_positions',      # (N,) position of the sample itself, nan when not valid or without a peak
+  'is_line_valid',      # (N,) bool
+  'is_crossing_line',   # (N,) bool
+  'active_sensors',     # (N, 8) bool
+  'is_intersection',    # (N,) bool
+  'is_90_intersection', # (N,) bool
+  'time_since_valid',   # (N,) sec since the latest valid sample, at the time of each sample
+])
+
+
+##### POSITION ESTIMATORS #####
+# Line position from the values of samples with a line, estimate() takes (N, 8) values and returns (N,) positions:
+# relative to the middle of the bar, normalized to +-1 (sensor 0 is -0.875, sensor 7 is +0.875), nan when unknown.
+
+NUM_OF_SENSORS = line_sensor.NUM_OF_SENSORS
+# Position of every sensor relative to the middle of the bar, normalized to +-1
+SENSOR_POSITIONS = (np.arange(NUM_OF_SENSORS) - (NUM_OF_SENSORS - 1) / 2) / (NUM_OF_SENSORS / 2)
+
+
+class CentroidEstimator:
+  """
+  Mean of the sensor positions, weighted by the values above the average of the sample
+  """
+  name = 'centroid'
+
+  def estimate(self, values):
+    weights = np.maximum(values - values.sum(axis=1, keepdims=True) / NUM_OF_SENSORS, 0.0)
+    weight_sum = weights.sum(axis=1)
+    positions = np.full(len(values), np.nan)
+    return np.divide(weights @ SENSOR_POSITIONS, weight_sum, out=positions, where=weight_sum > 0)
+
+
+class ParabolicEstimator:
+  """
+  Vertex of the parabola through the highest sensor and its two neighbours (closed form, no fit).
+  A peak on the outer sensor uses its inner neighbours
+  """
+  name = 'parabolic'
+  MAX_OFFSET = 1.0 # sensors from the highest one
+
+  def transform(self, values):
+    return values
+
+  def estimate(self, values):
+    rows = np.arange(len(values))
+    peak = np.clip(values.argmax(axis=1), 1, NUM_OF_SENSORS - 2)
+    y = self.transform(values)
+    left = y[rows, peak - 1]
+    centre = y[rows, peak]
+    right = y[rows, peak + 1]
+
+    # Flat or hollow: the highest sensor itself
+    curvature = left - 2 * centre + right
+    offset = np.zeros(len(values))
+    np.divide(0.5 * (left - right), curvature, out=offset, where=curvature < 0)
+    index = peak + np.clip(offset, -self.MAX_OFFSET, self.MAX_OFFSET)
+    return (index - (NUM_OF_SENSORS - 1) / 2) / (NUM_OF_SENSORS / 2)
+
+
+class GaussianEstimator(ParabolicEstimator):
+  """
+  Centre of the gaussian through the highest sensor and its two neighbours:
+  the parabolic vertex of the log of the values above the floor of the sample
+  """
+  name = 'gaussian'
+  MIN_VALUE = 1.0 # keeps the log finite
+
+  def transform(self, values):
+    return np.log(np.maximum(values - values.min(axis=1, keepdims=True), self.MIN_VALUE))
+
+
+ESTIMATORS = {estimator.name: estimator for estimator in (CentroidEstimator, ParabolicEstimator, GaussianEstimator)}
+
+
 class LineDetector:
   LINE_CROSSING_THRESHOLD = 800  # average above this is assumed to be crossing line
   LINE_VALID_THRESHOLD = 700      # 1000 is calibrated white
@@ -11,104 +109,94 @@ class LineDetector:
 
 
   position = 0
-  last_valid_timestamp = time()
+  last_valid_timestamp = clock.now()
 
 
-  def __init__(self, logger):
+  def __init__(self, logger, estimator=None):
+    """
+    estimator: position estimator (see ESTIMATORS), default CentroidEstimator
+    """
     self.logger = logger
+    self.estimator = estimator if estimator is not None else CentroidEstimator()
+    # Result of the latest line_sensor sample, detect() recomputes it once per update_count.
+    # detect() is only called from the line control thread, other threads read this result
+    self.result = DetectionResult()
 
 
   def reset(self):
     self.position = 0
-    self.last_valid_timestamp = time()
+    self.last_valid_timestamp = clock.now()
+    self.result = DetectionResult()
 
 
-  def time_passed_since_last_valid(self):
-    return time() - self.last_valid_timestamp
+  def time_passed_since_last_valid(self, now=None):
+    if now is None:
+      now = clock.now()
+    return now - self.last_valid_timestamp
 
 
-  def is_line_still_valid(self):
-    return self.time_passed_since_last_valid() < self.MAX_TIME_LINE_LOST
+  def is_line_still_valid(self, now=None):
+    return self.time_passed_since_last_valid(now) < self.MAX_TIME_LINE_LOST
   
 
   def activated_sensors(self, sensor_values=None):
+    """
+    1 for every sensor above the crossing threshold, 0 otherwise
+    """
     if sensor_values is None:
-      sensor_values = line_sensor.values
-    active_sensors = [1 if val >= self.LINE_CROSSING_THRESHOLD else 0 for val in sensor_values]
-    return active_sensors
-
-
-  def detect(self, sensor_values=None):
-    if sensor_values is None:
-      sensor_values = line_sensor.values
+      return list(self.detect().active_sensors)
+    return [1 if val >= self.LINE_CROSSING_THRESHOLD else 0 for val in sensor_values]
 
 
-    avg_val = np.mean(sensor_values)
+  def detect(self, sensor_values=None, timestamp=None):
+    """
+    DetectionResult of sensor_values taken at timestamp (sec, libs.clock, default now),
+    or of the latest line_sensor sample at its sample time (cached per sample).
+    The only state is the last valid position and its timestamp, so a replay gives the same results
+    """
+    if sensor_values is not None:
+      return self.__detect(sensor_values, -1, clock.now() if timestamp is None else timestamp)
 
-    # Count the number of sensors that exceed the threshold
-    #active_sensors = np.sum(sensor_values >= self.LINE_CROSSING_THRESHOLD)
+    result = self.result
+    if result.update_count == line_sensor.update_count:
+      return result
 
-    # Detect if more than 2 sensors are activated
-    #is_crossing_line = active_sensors > 2
+    # Values and update_count of the same sample, the MQTT thread may be writing a new one
+    sample = line_sensor.snapshot()
+    result = self.__detect(sample.values, sample.update_count, sample.time)
+    self.result = result
+    return result
 
-    # Update active sensor vector (1 if sensor is above threshold, 0 otherwise)
-    active_sensors = self.activated_sensors()
 
+  def __detect(self, sensor_values, update_count, timestamp):
+    values = np.asarray(sensor_values, dtype=float)
+    avg_val = values.sum() / len(values)
+    max_val = values.max()
+    min_val = values.min()
 
     # Detect if we have a crossing line
-    is_crossing_line = avg_val >= self.LINE_CROSSING_THRESHOLD
+    is_crossing_line = bool(avg_val >= self.LINE_CROSSING_THRESHOLD)
     # Is line valid (highest value above threshold)
-    is_line_valid = np.max(sensor_values) >= self.LINE_VALID_THRESHOLD
-    # Useful to check wether the value chart has a peak or not (no peak = no line or we're just on a white floor)
-    min_max_delta = np.abs(np.max(sensor_values) - np.min(sensor_values))    
-
-    if min_max_delta > self.MIN_MAX_DELTA_THRESHOLD:
-      # Weighted sum of the positions (by the sensor values)
-      sum = 0
-      pos_sum = 0
-      for i in range(line_sensor.NUM_OF_SENSORS):
-        v = sensor_values[i] - avg_val
-        if v > 0:
-          sum += v
-          pos_sum += (i + 1) * v  # do i+1, otherwise we get 0*sensor_values[i] = 0
-
-      # pos_sum/sum is the weighted mean of the indices of the sensors (1..8), weighted by the sensor values
-      # subtracting (1+line_sensor.NUM_OF_SENSORS)/2 gives us the position relative to the middle sensor, (min+max)/2
-      if sum > 0 and is_line_valid:
-        position = pos_sum / sum - (1+line_sensor.NUM_OF_SENSORS) / 2
-      else:
-        position = np.NAN
-
-      # Normalize position to +-1
-      position = position / (line_sensor.NUM_OF_SENSORS / 2)
-
-    else:
-      position = np.NAN
-
-    # sum = 0
-    # pos_sum = 0
-    # for i in range(line_sensor.NUM_OF_SENSORS):
-    #   v = sensor_values[i]
-    #   if v > 0:
-    #     sum += v
-    #     pos_sum += (i + 1) * v  # do i+1, otherwise we get 0*sensor_values[i] = 0
-    
-    # # pos_sum/sum is the weighted mean of the indices of the sensors (1..8), weighted by the sensor values
-    # # subtracting (1+line_sensor.NUM_OF_SENSORS)/2 gives us the position relative to the middle sensor, (min+max)/2
-    # if sum > 0 and is_line_valid:
-    #   position = pos_sum / sum - (1+line_sensor.NUM_OF_SENSORS) / 2
-    # else:
-    #   position = 0
-
+    is_line_valid = bool(max_val >= self.LINE_VALID_THRESHOLD)
 
+    # Useful to check wether the value chart has a peak or not (no peak = no line or we're just on a white floor)
+    position = np.nan
+    if max_val - min_val > self.MIN_MAX_DELTA_THRESHOLD and is_line_valid:
+      position = float(self.estimator.estimate(values[None, :])[0])
 
     if is_line_valid:
-        self.position = position
-        self.last_valid_timestamp = time()
+      self.position = position
+      self.last_valid_timestamp = timestamp
 
-    #self.logger.debug(f"is_crossing_line={is_crossing_line}, is_line_valid={is_line_valid}, position={position}, avg_sensor_values={avg_val}, max_sensor_values={np.max(sensor_values)}")
+    # Update active sensor vector (1 if sensor is above threshold, 0 otherwise)
+    a = tuple((values >= self.LINE_CROSSING_THRESHOLD).astype(int).tolist())
 
-    return { 'is_crossing_line': is_crossing_line, 'is_line_valid': is_line_valid, 'position': self.position, 'active_sensors': active_sensors}
+    # Intersection: center sensors (3, 4) not both on, a line on the left (0, 1) and on the right (5, 6)
+    is_intersection = (a[3] == 0 or a[4] == 0) and (a[0] == 1 or a[1] == 1) and (a[5] == 1 or a[6] == 1)
+    # 90 degree intersection: a line branching out on the left (0, 1) or on the right (5, 6)
+    is_90_intersection = (a[0] == 1 and a[1] == 1) or (a[5] == 1 and a[6] == 1)
+
+    return DetectionResult(update_count, timestamp, self.position, is_line_valid, is_crossing_line, a, is_intersection, is_90_intersection)
 
 
   def is_intersection_detected(self):
@@ -118,18 +206,8 @@ class LineDetector:
     - at least one sensor on the left (0, 1, 2) is active
     - at least one sensor on the right (5, 6, 7) is active    
     """
-    sensors = self.activated_sensors()
-    if len(sensors) < 8:
-        return False  
-
-    # central sensors
-    center_off = sensors[3] == 0 or sensors[4] == 0
-
-    # At least one right and one left sensor
-    left_on = any(sensors[i] == 1 for i in range(0, 2))
-    right_on = any(sensors[i] == 1 for i in range(5, 7))
+    return self.detect().is_intersection
 
-    return center_off and left_on and right_on
 
   def is_90_intersection_detected(self):
     """
@@ -138,15 +216,42 @@ class LineDetector:
     - And all sensors on the left side (indexes 0, 1, 2) or all sensors on the right side (indexes 5, 6, 7) are active,
     indicating the presence of a line branching out at 90 degrees.
     """
-    sensors = self.activated_sensors()
-    if len(sensors) < 8:
-        return False
+    return self.detect().is_90_intersection
+
+
+  def detect_batch(self, values, timestamps, position=0, last_valid_timestamp=None):
+    """
+    Detection of a whole recording at once, without changing the detector.
+
+    values: (N, 8) sensor values, timestamps: (N,) sample times (sec).
+    position and last_valid_timestamp are the state before the first sample
+    (default: position 0, valid at the first sample). Gives the same results as detect() called per sample
+    """
+    values = np.asarray(values, dtype=float)
+    timestamps = np.asarray(timestamps, dtype=float)
+    n = len(values)
+    if last_valid_timestamp is None:
+      last_valid_timestamp = timestamps[0]
+
+    avg_val = values.sum(axis=1) / values.shape[1]
+    max_val = values.max(axis=1)
+    min_val = values.min(axis=1)
+    is_crossing_line = avg_val >= self.LINE_CROSSING_THRESHOLD
+    is_line_valid = max_val >= self.LINE_VALID_THRESHOLD
 
+    has_peak = (max_val - min_val > self.MIN_MAX_DELTA_THRESHOLD) & is_line_valid
+    raw_positions = np.full(n, np.nan)
+    raw_positions[has_peak] = self.estimator.estimate(values[has_peak])
 
-    # Verifica se tutti i sensori a sinistra sono attivi
-    left_all = all(sensors[i] == 1 for i in range(0, 2))
-    # Verifica se tutti i sensori a destra sono attivi
-    right_all = all(sensors[i] == 1 for i in range(5, 7))
+    # Index of the latest valid sample at every sample, -1 before the first one
+    latest_valid = np.maximum.accumulate(np.where(is_line_valid, np.arange(n), -1))
+    before_first = latest_valid < 0
+    positions = np.where(before_first, position, raw_positions[latest_valid])
+    time_since_valid = timestamps - np.where(before_first, last_valid_timestamp, timestamps[latest_valid])
 
+    a = values >= self.LINE_CROSSING_THRESHOLD
+    is_intersection = (~a[:, 3] | ~a[:, 4]) & (a[:, 0] | a[:, 1]) & (a[:, 5] | a[:, 6])
+    is_90_intersection = (a[:, 0] & a[:, 1]) | (a[:, 5] & a[:, 6])
 
-    return (left_all or right_all)
\ No newline at end of file
+    return DetectionBatch(positions, raw_positions, is_line_valid, is_crossing_line, a,
+                          is_intersection, is_90_intersection, time_since_valid)
@@ -1,8 +1,12 @@
-from libs.logger import Logger
+from libs.logger import Logger, console
 from libs.services.mqtt_service import mqtt_service
-from time import time, sleep
+from libs.services.recorder import Recorder
+from time import time
+from threading import RLock
+import math
 import numpy as np
 from modules.line_follower.line_detector import LineDetector
+from modules.line_follower.manoeuvre_engine import manoeuvre_engine, Call, Drive, DriveFor, Repeat, Stop, TurnBy
 from modules.camera.camera_service import camera_service
 
 class LineFollower1:
@@ -18,36 +22,52 @@ class LineFollower1:
     #BASE_SPEED = 0.4
     # tune the velocity through path.py
     MIN_SPEED = 0
+    # Speed limit while the sensor streams are degraded (set by the state machine)
+    DEGRADED_SPEED = 0.15
+    
+    # Manoeuvres
+    TURN_RATE = 1.4  # rad/s, 90-degree turns
+    TURN_RATE_SLOW = 1.0  # rad/s, small turns
+    BACK_UP_DISTANCE = 0.05  # m, backed up before turning at an intersection
+    BACK_UP_SPEED = 0.1  # m/s
     
     # Anti-windup limits
     MAX_INTEGRAL = 2.0
 
     
     def __init__(self):
+        # Kept when the controller is reset
+        self.speed_limit = None
+        # Set while a manoeuvre drives the robot
+        self.suspended = False
+        # The control thread runs update(), the state machine changes the references
+        self.lock = RLock()
         self.reset()
     
     def setup(self):
         self.logger = Logger('line_follower')
         # active sensors variable from line detector
         self.line_detector = LineDetector('logger')
-        detect_results = self.line_detector.detect()
-        self.active_sensors = detect_results['active_sensors']
+        self.active_sensors = self.line_detector.detect().active_sensors
         self.set_line_control(0)
         
-        # Create log file
-        self.log_data_file = open('logs/line_follower.csv', 'w', encoding="utf-8")
-        self.log_data_file.write("timestamp_sec,position,error,p,i,d,u\n")
+        # Record every sample, convert with scripts/convert_recording.py
+        self.recorder = Recorder('logs/line_follower', ("timestamp_sec", "position", "error", "p", "i", "d", "u"))
         
         self.logger.info('Line follower started')
         
     def terminate(self):
         self.set_line_control(0)
         mqtt_service.send_cmd("ti/rc", f"0 0 {time()}")
-        if hasattr(self, 'log_data_file'):
-            self.log_data_file.close()
+        if hasattr(self, 'recorder'):
+            self.recorder.close()
         self.logger.info('Line follower terminated')
     
     def reset(self):
+        with self.lock:
+            self.__reset()
+
+    def __reset(self):
         self.position = 0
         self.position_ref = 0
         self.velocity = 0
@@ -75,17 +95,42 @@ class LineFollower1:
         return False
     
     def set_line_control(self, velocity, position_ref=0):
-        # Reset PID when activating line follower
-        if self.velocity == 0 and velocity != 0:
-            self.reset()
-        
-        #self.logger.info(f"SET vel={velocity}, position_ref={position_ref}")
-        self.velocity = velocity
-        self.position_ref = position_ref
+        with self.lock:
+            # Reset PID when activating line follower
+            if self.velocity == 0 and velocity != 0:
+                self.__reset()
+
+            #self.logger.info(f"SET vel={velocity}, position_ref={position_ref}")
+            self.velocity = velocity
+            self.position_ref = position_ref
+
+    def set_speed_limit(self, speed_limit):
+        """
+        Cap the forward velocity, None to remove the cap
+        """
+        self.speed_limit = speed_limit
+    
+    def suspend(self):
+        """
+        Stop sending commands while a manoeuvre drives, the detection keeps running
+        """
+        with self.lock:
+            self.suspended = True
+
+    def resume(self):
+        with self.lock:
+            self.suspended = False
     
     def update(self):
+        """
+        Detection and control of one line sample, called by the line control thread (line_control.py)
+        """
         if not self.line_detector:
             return
+        with self.lock:
+            self.__update()
+
+    def __update(self):
         
         # Calculate actual sampling time
         current_time = time()
@@ -97,26 +142,25 @@ class LineFollower1:
             self.sampling_time = real_dt
         
         # Detect line position
-        detect_results = self.line_detector.detect()
-        position = detect_results['position']
-        self.is_line_valid = detect_results['is_line_valid']
-        self.is_crossing_line = detect_results['is_crossing_line']
-        self.active_sensors = detect_results['active_sensors']
+        result = self.line_detector.detect()
+        position = result.position
+        self.is_line_valid = result.is_line_valid
+        self.is_crossing_line = result.is_crossing_line
+        self.active_sensors = result.active_sensors
         
         # Keep last known position in case of no data
         if not np.isnan(position):
             self.position = position
         
         # Use to control, if active
-        if self.velocity > 0:
+        if self.velocity > 0 and not self.suspended:
             self.follow_line()
         
         # Log data
-        if hasattr(self, 'log_data_file'):
-            p_term = self.LINE_KP * (self.position_ref - self.position)
-            i_term = self.LINE_KI * self.integral
-            d_term = self.LINE_KD * self.last_derivative
-            self.log_data_file.write(f"{current_time},{self.position},{self.position_ref - self.position},{p_term},{i_term},{d_term},{self.u}\n")
+        if hasattr(self, 'recorder'):
+            error = self.position_ref - self.position
+            self.recorder.append(current_time, self.position, error, self.LINE_KP * error,
+                                 self.LINE_KI * self.integral, self.LINE_KD * self.last_derivative, self.u)
     
     def follow_line(self):
         # Calculate error (reference - actual position)
@@ -158,9 +202,11 @@ class LineFollower1:
         
         # Adjust forward velocity based on line characteristics
         forward_velocity = self.calculate_adaptive_velocity()
+        if self.speed_limit is not None:
+            forward_velocity = min(forward_velocity, self.speed_limit)
         
-        # Send command to robot
-        mqtt_service.send_cmd("ti/rc", f"{forward_velocity} {self.u} {time()}")
+        # Send command to robot (formatted by the publisher thread)
+        mqtt_service.send_cmd("ti/rc", (forward_velocity, self.u, time()))
         
         # Debug output
         #self.logger.debug(f"Position: {self.position:.3f}, Error: {error:.3f}, Control: {self.u:.3f}, Velocity: {forward_velocity:.3f}")
@@ -182,232 +228,91 @@ class LineFollower1:
 
         return base_velocity * velocity_factor
     
-    def handle_intersection(self, direction=None):
+    def manoeuvre(self, direction):
         """
-        Handle intersection when a crossing line is detected.
+        Steps of the manoeuvre for direction (intersection_map of the path), run by the manoeuvre engine.
+        Turns and straights end on the odometry, the angles not named in the comments are the old rate x time.
         """
-        if direction is None:
-            return
-            
         if direction == 'left':
-            # Stop the robot
-            #mqtt_service.send_cmd("ti/rc", f"0 0 {time()}")
-            
-            turn_speed = 1.0 # Turn rate
-            turn_duration = 0.8 # Estimated time for a little left turn
-            mqtt_service.send_cmd("ti/rc", f"{0.1} {turn_speed} {time()}")
-            start_time = time()
-            while time() - start_time < turn_duration:
-                # Ensure the robot turns for at least the specified duration
-                pass
-            
-        
+            # A little left turn, on an arc
+            return [TurnBy(0.8, self.TURN_RATE_SLOW, velocity=0.1)]
+
         elif direction == 'right':
-            # Stop the robot
-            #mqtt_service.send_cmd("ti/rc", f"0 0 {time()}")
-            turn_speed = 1.0  # Turn rate
-            turn_duration = 0.8 # Estimated time for a small right turn
-            mqtt_service.send_cmd("ti/rc", f"{0.1} {-turn_speed} {time()}")
-            start_time = time()
-            while time() - start_time < turn_duration:
-                # Ensure the robot turns for at least the specified duration
-                pass
-            
+            # A small right turn, on an arc
+            return [TurnBy(-0.8, self.TURN_RATE_SLOW, velocity=0.1)]
 
         elif direction == '90left':
-            # Stop the robot
-            mqtt_service.send_cmd("ti/rc", f"{-0.1} 0 {time()}")
-            back_duration = 0.5
-            start_time = time()
-            while time() - start_time < back_duration:
-                # Ensure the robot turns for at least the specified duration
-                pass
+            return [
+                DriveFor(-self.BACK_UP_DISTANCE, self.BACK_UP_SPEED),
+                TurnBy(math.pi / 2, self.TURN_RATE),
+            ]
 
-            turn_speed = 1.4  # Turn rate
-            turn_duration = 1.1  # Estimated time for a 90-degree turn
-            mqtt_service.send_cmd("ti/rc", f"0 {turn_speed} {time()}")
-            start_time = time()
-            while time() - start_time < turn_duration:
-                # Ensure the robot turns for at least the specified duration
-                pass
-            
-        elif direction == '90right':
-            # Stop the robot
-            mqtt_service.send_cmd("ti/rc", f"{-0.1} 0 {time()}")
-            back_duration = 0.5
-            start_time = time()
-            while time() - start_time < back_duration:
-                # Ensure the robot turns for at least the specified duration
-                pass
-            
+        elif direction in ('90right', 'basket', 'axe'):
             # Perform a 90-degree right turn
-            turn_speed = 1.4  # Turn rate
-            turn_duration = 1.1  # Estimated time for a 90-degree turn
-            mqtt_service.send_cmd("ti/rc", f"0 {-turn_speed} {time()}")
-            start_time = time()
-            while time() - start_time < turn_duration:
-                pass
-
-        elif direction == 'basket':
-            # Stop the robot
-            mqtt_service.send_cmd("ti/rc", f"{-0.1} 0 {time()}")
-            back_duration = 0.5
-            start_time = time()
-            while time() - start_time < back_duration:
-                # Ensure the robot turns for at least the specified duration
-                pass
-            
-            # Perform a 90-degree right turn
-            turn_speed = 1.4  # Turn rate
-            turn_duration = 1.1  # Estimated time for a 90-degree turn
-            mqtt_service.send_cmd("ti/rc", f"0 {-turn_speed} {time()}")
-            start_time = time()
-            while time() - start_time < turn_duration:
-                pass
+            return [
+                DriveFor(-self.BACK_UP_DISTANCE, self.BACK_UP_SPEED),
+                TurnBy(-math.pi / 2, self.TURN_RATE),
+            ]
 
         elif direction == 'back':
             # going back
-            mqtt_service.send_cmd("ti/rc", f"{-0.1} 0 {time()}")
-            back_duration = 2.0
-            start_time = time()
-            while time() - start_time < back_duration:
-                pass
-   
+            return [DriveFor(-0.2, self.BACK_UP_SPEED)]
+
         elif direction == '180':
-            # Stop the robot
-            #mqtt_service.send_cmd("ti/rc", f"0 0 {time()}")
-            
             # Perform a 180-degree right turn
-            turn_speed = 1.7  # Turn rate
-            turn_duration = 1.8  # Estimated time for a 180-degree turn
-            mqtt_service.send_cmd("ti/rc", f"0 {-turn_speed} {time()}")
-            start_time = time()
-            while time() - start_time < turn_duration:
-                pass
+            return [TurnBy(-math.pi, 1.7)]
 
-
-        elif direction == 'axe':
-            # Stop the robot
-            mqtt_service.send_cmd("ti/rc", f"{-0.1} 0 {time()}")
-            back_duration = 0.5
-            start_time = time()
-            while time() - start_time < back_duration:
-                # Ensure the robot turns for at least the specified duration
-                pass
-            
-            # Perform a 90-degree right turn
-            turn_speed = 1.4  # Turn rate
-            turn_duration = 1.1  # Estimated time for a 90-degree turn
-            mqtt_service.send_cmd("ti/rc", f"0 {-turn_speed} {time()}")
-            start_time = time()
-            while time() - start_time < turn_duration:
-                pass
-        
         elif direction == 'search_ball':
-            # Stop the robot
-            mqtt_service.send_cmd("ti/rc", f"{-0.1} 0 {time()}")
-            back_duration = 0.5
-            start_time = time()
-            while time() - start_time < back_duration:
-                # Ensure the robot turns for at least the specified duration
-                pass
+            # 90-degree left turn
+            return [
+                DriveFor(-self.BACK_UP_DISTANCE, self.BACK_UP_SPEED),
+                TurnBy(math.pi / 2, 1.3),
+            ]
 
-            turn_speed = 1.3  # Turn rate
-            turn_duration = 1.1  # Estimated time for a 90-degree turn
-            mqtt_service.send_cmd("ti/rc", f"0 {turn_speed} {time()}")
-            start_time = time()
-            while time() - start_time < turn_duration:
-                # Ensure the robot turns for at least the specified duration
-                pass
-            
         elif direction == 'approach_hole':
-            # Stop the robot
-            mqtt_service.send_cmd("ti/rc", f"0 0 {time()}")
-            
-            # Go straight for turn_duration seconds
-            turn_speed = -0.03
-            straight_duration = 2.9
-            mqtt_service.send_cmd("ti/rc", f"{0.2} {turn_speed} {time()}")
-            start_time = time()
-            while time() - start_time < straight_duration:
-                # Ensure the robot moves for at least the specified duration
-                #print(time()-start_time)
-                pass
-            
+            # Stop, then go (almost) straight to the hole
+            return [Stop(), DriveFor(0.58, 0.2, turnrate=-0.03)]
+
         elif direction == 'wiggle':
-            #WIGGLE
+            # Wiggle left and right while the ball is still held
             turn_speed = 1.0 # Turn rate
-            mqtt_service.send_cmd("ti/rc", f"{0.06} {0} {time()}")
-            #start_time = time()
-            #toggle = True
-            while (camera_service.ball['is_ball_grabbed']):
-                print('wiggling')
-                # Wiggle direction
-                #wiggle_turn = -turn_speed if toggle else turn_speed
-                mqtt_service.send_cmd("ti/rc", f"{0.02} {turn_speed} {time()}")
-                turn_speed = -turn_speed
-                #toggle = not toggle
-                sleep(0.7)
-
-            # Finish wiggle with a compensatory rotation
-            # If the last wiggle was right (turn_speed positive), rotate left
-            #last_wiggle = -turn_speed if toggle else turn_speed
-            #mqtt_service.send_cmd("ti/rc", f"0 {-last_wiggle} {time()}")
-            #sleep(0.7)
-
-            # Stop completely before returning to next logic (e.g., line search)
-            #mqtt_service.send_cmd("ti/rc", f"0 0 {time()}")
-
+            wiggle_duration = 0.7
+            return [
+                Drive(0.06, 0),
+                Repeat([Drive(0.02, turn_speed, wiggle_duration), Drive(0.02, -turn_speed, wiggle_duration)],
+                       lambda: camera_service.ball['is_ball_grabbed']),
+            ]
 
         elif direction == 'turn_to_hole':
-            # Stop the robot
-            mqtt_service.send_cmd("ti/rc", f"0 0 {time()}")
-            
-            # Perform a 90-degree left turn
-            turn_speed = 1.5  # Turn rate
-            turn_duration = 1.5 # Estimated time for a 90-degree turn
-            mqtt_service.send_cmd("ti/rc", f"0 {-turn_speed} {time()}")
-            start_time = time()
-            while time() - start_time < turn_duration:
-                # Ensure the robot turns for at least the specified duration
-                pass
-        
+            # Stop, then turn right towards the hole
+            return [Stop(), TurnBy(-2.25, 1.5)]
+
         elif direction == 'back_to_line':
-            # going back
-            mqtt_service.send_cmd("ti/rc", f"{0.2} {0} {time()}")
-            centered = False
-            while not centered:
-                if self.active_sensors[3] == 1 or self.active_sensors[4] == 1:
-                    print('WE ARE ON THE LINE')
-                    # If the line is detected, break the loop
-                    centered = True
-                    mqtt_service.send_cmd("ti/rc", f"0 0 {time()}")
-                    #rotate a bit right
-                    mqtt_service.send_cmd("ti/rc", f"0 {-0.2} {time()}")
-                pass                
-            
+            # Forward until one of the central sensors sees the line (at most 1 m), then rotate a bit right
+            return [
+                DriveFor(1.0, 0.2, until=lambda: self.active_sensors[3] == 1 or self.active_sensors[4] == 1),
+                Call(console.print, 'WE ARE ON THE LINE'),
+                Drive(0, -0.2),
+            ]
 
         elif direction == 'big_int':
             # for processing big intercection near the stop
-            turn_speed = 1.5 # Turn rate
-            turn_duration = 1.6 # Estimated time 
-            mqtt_service.send_cmd("ti/rc", f"0 {turn_speed} {time()}")
-            start_time = time()
-            while time() - start_time < turn_duration:
-                # Ensure the robot turns for at least the specified duration
-                pass
+            return [
+                TurnBy(2.4, 1.5),
+                DriveFor(0.15, 0.15), # straight to avoid all the lines
+            ]
 
-            # straight to avoid all the lines 
-            str_duration = 1.0
-            mqtt_service.send_cmd("ti/rc", f"{0.15} {0} {time()}")
-            start_time = time()
-            while time() - start_time < str_duration:
-                # Ensure the robot turns for at least the specified duration
-                pass
-        
-        # Resume line following
-        self.reset()
-        self.set_line_control(self.velocity)
+        # e.g. 'straight': only restart the controller
+        return []
+
+    def handle_intersection(self, direction=None):
+        """
+        Start the manoeuvre for direction, returns its Future (None without direction).
+        The line following resumes when the path sets the line control again.
+        """
+        if direction is None:
+            return None
+        return manoeuvre_engine.run(direction, self.manoeuvre(direction))
 
 # Create the line follower instance
 line_follower = LineFollower1()
@@ -100,10 +100,10 @@ class LineFollower:
     #if not self.line_detector:
     #  return 
 
-    detect_results = self.line_detector.detect()
-    position = detect_results['position']
-    self.is_line_valid = detect_results['is_line_valid']
-    self.is_crossing_line = detect_results['is_crossing_line']
+    result = self.line_detector.detect()
+    position = result.position
+    self.is_line_valid = result.is_line_valid
+    self.is_crossing_line = result.is_crossing_line
 
     # Keep last known position is case of no data
     if not np.isnan(position):
@@ -166,8 +166,7 @@ class LineFollower:
       self.u = (self.scaled_error * self.tauZ2pT - self.scaled_error_old * self.tauZ2mT + self.u_old * self.tauP2mT) / self.tauP2pT
 
       # Adjust velocity: keep moving forward when sensors 4-5 are active
-      detect_results = self.line_detector.detect()
-      active_sensors = detect_results['active_sensors']
+      active_sensors = self.line_detector.detect().active_sensors
       print(f'Active sensors: {active_sensors}')
       print(f'Error: {error}')
    
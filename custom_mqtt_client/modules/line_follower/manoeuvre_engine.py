@@ -0,0 +1,497 @@
+import math
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import Future
+from threading import Event, RLock, Thread
+from time import time
+from libs.clock import clock
+from libs.logger import Logger
+from libs.sensors.odometry import odometry
+from libs.services.mqtt_service import mqtt_service
+
+
+##### STEPS #####
+
+class Step:
+    """
+    One step of a manoeuvre: started once, then polled by the engine thread until it is done.
+    end_time is when a timed step will be done, the engine sleeps until then instead of polling.
+    """
+    end_time = None
+
+    def start(self, engine, now):
+        pass
+
+    def poll(self, engine, now):
+        return True
+
+    def __repr__(self):
+        return self.__class__.__name__
+
+
+class Drive(Step):
+    """
+    Drive with a forward velocity (m/s) and turnrate (rad/s) for duration (sec), line control is suspended.
+    Without duration the command is only sent, the robot keeps it during the next steps.
+    """
+    def __init__(self, velocity, turnrate=0.0, duration=0.0):
+        self.velocity = velocity
+        self.turnrate = turnrate
+        self.duration = duration
+
+    def start(self, engine, now):
+        engine.drive(self.velocity, self.turnrate)
+        self.end_time = now + self.duration
+
+    def poll(self, engine, now):
+        return now >= self.end_time
+
+    def __repr__(self):
+        return f"Drive({self.velocity}, {self.turnrate}, {self.duration})"
+
+
+class Turn(Drive):
+    """
+    Turn on the spot with turnrate (rad/s, positive is left) for duration (sec)
+    """
+    def __init__(self, turnrate, duration):
+        super().__init__(0.0, turnrate, duration)
+
+
+class Stop(Drive):
+    def __init__(self):
+        super().__init__(0.0, 0.0, 0.0)
+
+
+class Wait(Step):
+    """
+    Keep the current command (or line following) for duration (sec)
+    """
+    def __init__(self, duration):
+        self.duration = duration
+
+    def start(self, engine, now):
+        self.end_time = now + self.duration
+
+    def poll(self, engine, now):
+        return now >= self.end_time
+
+    def __repr__(self):
+        return f"Wait({self.duration})"
+
+
+class WaitUntil(Step):
+    """
+    Keep the current command (or line following) until condition() is true, or timeout (sec) passed
+    """
+    def __init__(self, condition, timeout=None):
+        self.condition = condition
+        self.timeout = timeout
+
+    def start(self, engine, now):
+        self.start_time = now
+
+    def poll(self, engine, now):
+        if self.condition():
+            return True
+        if self.timeout is not None and now - self.start_time >= self.timeout:
+            engine.step_timed_out(self)
+            return True
+        return False
+
+    def __repr__(self):
+        return f"WaitUntil({getattr(self.condition, '__name__', self.condition)}, {self.timeout})"
+
+
+class Call(Step):
+    """
+    Call function(*args) once, e.g. to move the servo
+    """
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+
+    def start(self, engine, now):
+        self.function(*self.args)
+
+    def __repr__(self):
+        return f"Call({getattr(self.function, '__name__', self.function)})"
+
+
+class FollowLine(WaitUntil):
+    """
+    Follow the line with velocity (m/s) for duration (sec), or until condition() is true
+    """
+    def __init__(self, velocity, duration=None, until=None, timeout=None):
+        super().__init__(until, timeout)
+        self.velocity = velocity
+        self.duration = duration
+
+    def start(self, engine, now):
+        super().start(engine, now)
+        engine.follow_line(self.velocity)
+        if self.duration is not None:
+            self.end_time = now + self.duration
+
+    def poll(self, engine, now):
+        if self.end_time is not None and now >= self.end_time:
+            return True
+        return self.condition is not None and super().poll(engine, now)
+
+    def __repr__(self):
+        return f"FollowLine({self.velocity}, {self.duration})"
+
+
+class Repeat(Step):
+    """
+    Run steps over and over while condition() is true, it is checked before every step
+    """
+    def __init__(self, steps, condition):
+        self.steps = list(steps)
+        self.condition = condition
+
+    def start(self, engine, now):
+        self.index = 0
+        self.current = None
+        self.end_time = None
+
+    def poll(self, engine, now):
+        if self.current is not None and not self.current.poll(engine, now):
+            return False
+        if not self.condition():
+            return True
+        self.current = self.steps[self.index % len(self.steps)]
+        self.index += 1
+        self.current.start(engine, now)
+        self.end_time = self.current.end_time
+        return False
+
+    def __repr__(self):
+        return f"Repeat({self.steps})"
+
+
+class OdometryStep(Step, ABC):
+    """
+    Drives until the odometry moved target (from the start of the step) in the commanded direction,
+    or until() is true. Evaluated on every pose and wheel velocity sample (ManoeuvreEngine.notify).
+    When the odometry does not get there (e.g. blocked wheels, no data) it ends after timeout: by default
+    TIMEOUT_FACTOR times the time at the commanded rate plus TIMEOUT_MARGIN_SEC. The robot stops at the end.
+    """
+    TOLERANCE = 0.0
+    TIMEOUT_FACTOR = 2.0
+    TIMEOUT_MARGIN_SEC = 0.5
+
+    def __init__(self, target, rate, velocity, turnrate, until=None, timeout=None):
+        """
+        target: signed distance (m) or angle (rad), None to only stop on until(), rate: commanded speed toward it (> 0)
+        """
+        self.target = target
+        self.velocity = velocity
+        self.turnrate = turnrate
+        self.until = until
+        if timeout is None and target is not None:
+            timeout = abs(target) / rate * self.TIMEOUT_FACTOR + self.TIMEOUT_MARGIN_SEC
+        self.timeout = timeout
+        self.progress = 0.0
+
+    @abstractmethod
+    def value(self):
+        """
+        Should return the odometry value the target is measured on
+        """
+        pass
+
+    def start(self, engine, now):
+        self.start_time = now
+        self.start_value = self.value()
+        self.progress = 0.0
+        engine.drive(self.velocity, self.turnrate)
+
+    def poll(self, engine, now):
+        if self.target is not None:
+            self.progress = (self.value() - self.start_value) * math.copysign(1.0, self.target)
+            if self.progress >= abs(self.target) - self.TOLERANCE:
+                return self.__done(engine, now)
+        if self.until is not None and self.until():
+            return self.__done(engine, now)
+        if self.timeout is not None and now - self.start_time >= self.timeout:
+            engine.step_timed_out(self)
+            return self.__done(engine, now)
+        return False
+
+    def __done(self, engine, now):
+        engine.drive(0.0, 0.0)
+        engine.logger.debug(f"{self} done after {self.progress:.3f} in {now - self.start_time:.2f} s")
+        return True
+
+
+class TurnBy(OdometryStep):
+    """
+    Turn by angle (rad, positive is left) at turnrate (rad/s), on odometry.total_heading.
+    With a forward velocity (m/s) the turn is an arc.
+    """
+    TOLERANCE = 0.02 # rad
+
+    def __init__(self, angle, turnrate, velocity=0.0, until=None, timeout=None):
+        super().__init__(angle, abs(turnrate), velocity, math.copysign(turnrate, angle), until, timeout)
+
+    def value(self):
+        return odometry.total_heading
+
+    def __repr__(self):
+        return f"TurnBy({self.target:.3f}, {self.turnrate})"
+
+
+class DriveFor(OdometryStep):
+    """
+    Drive distance (m, negative is backwards) at velocity (m/s), on odometry.total_dist.
+    With distance None it only stops on until() (or timeout).
+    """
+    TOLERANCE = 0.005 # m
+
+    def __init__(self, distance, velocity, turnrate=0.0, until=None, timeout=None):
+        if distance is not None:
+            velocity = math.copysign(velocity, distance)
+        super().__init__(distance, abs(velocity), velocity, turnrate, until, timeout)
+
+    def value(self):
+        return odometry.total_dist
+
+    def __repr__(self):
+        return f"DriveFor({self.target}, {self.velocity})"
+
+
+##### ENGINE #####
+
+class Manoeuvre:
+    __slots__ = ('name', 'steps', 'future', 'index', 'start_time')
+
+    def __init__(self, name, steps):
+        self.name = name
+        self.steps = steps
+        self.future = Future()
+        self.index = 0
+        self.start_time = None
+
+
+class ManoeuvreEngine:
+    """
+    Runs manoeuvres (lists of steps) on its own thread, one after the other, instead of busy-waiting in the caller.
+
+    run() returns at once with a Future, done (result: duration in sec) when the last step is done. While a
+    manoeuvre runs the line control is suspended (Drive steps) or resumed (FollowLine steps), afterwards the line
+    follower is reset, like after the old blocking manoeuvres. The thread sleeps until the next timed step ends,
+    or the next odometry sample (notify()), conditions are polled every TICK_SEC.
+    """
+    TICK_SEC = 0.01
+    IDLE_TIMEOUT_SEC = 0.1
+
+
+    def __init__(self):
+        # Reentrant: a step callback may cancel() from the engine thread, e.g. through ROBOT_stop_movement
+        self.lock = RLock()
+        self.wakeup = Event()
+        self.queue = deque()
+        self.current = None
+        self.running = False
+        self.thread = None
+        self.line_follower = None
+
+        # Statistics
+        self.completed_counter = 0
+        self.cancelled_counter = 0
+        self.failed_counter = 0
+        self.timeout_counter = 0
+        self.tick_counter = 0
+
+
+    def setup(self, line_follower):
+        self.logger = Logger('manoeuvre_engine')
+        self.line_follower = line_follower
+        self.running = True
+        self.thread = Thread(target=self.__handle, name="manoeuvre_engine", daemon=True)
+        self.thread.start()
+        self.logger.info("Started")
+
+
+    def terminate(self):
+        self.cancel()
+        self.running = False
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+            self.logger.info(f"Stopped: {self.stats()}")
+
+
+    def run(self, name, steps):
+        """
+        Queue the manoeuvre, returns its Future
+        """
+        manoeuvre = Manoeuvre(name, list(steps))
+        with self.lock:
+            self.queue.append(manoeuvre)
+        self.wakeup.set()
+        return manoeuvre.future
+
+
+    def cancel(self):
+        """
+        Cancel the running and the queued manoeuvres, no step sends a command after this returns
+        """
+        with self.lock:
+            manoeuvres = list(self.queue)
+            self.queue.clear()
+            if self.current is not None:
+                manoeuvres.append(self.current)
+                self.current = None
+                self.__release_line_control()
+        for manoeuvre in manoeuvres:
+            if manoeuvre.future.cancel():
+                self.cancelled_counter += 1
+                self.logger.warning(f"Manoeuvre {manoeuvre.name} cancelled")
+
+
+    def notify(self):
+        """
+        Called by the MQTT thread for every pose and wheel velocity sample, the odometry steps are evaluated on it
+        """
+        if self.current is not None:
+            self.wakeup.set()
+
+
+    ##### USED BY THE STEPS #####
+
+    def drive(self, velocity, turnrate):
+        self.line_follower.suspend()
+        mqtt_service.send_cmd("ti/rc", (velocity, turnrate, time()))
+
+
+    def follow_line(self, velocity):
+        if self.line_follower.suspended:
+            # After a manoeuvre start, Drive or TurnBy the PID state is from before the turn, restart it
+            self.line_follower.reset()
+        self.line_follower.set_line_control(velocity)
+        self.line_follower.resume()
+
+
+    def step_timed_out(self, step):
+        self.timeout_counter += 1
+        name = self.current.name if self.current is not None else None
+        self.logger.warning(f"Manoeuvre {name}: {step} timed out, continuing")
+
+
+    ##### THREAD #####
+
+    def __handle(self):
+        while self.running:
+            timeout = self.__tick()
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
+
+
+    def __tick(self):
+        """
+        Advances the current manoeuvre, returns how long to sleep
+        """
+        with self.lock:
+            self.tick_counter += 1
+            now = clock.now()
+
+            if self.current is not None and self.current.future.cancelled():
+                # Cancelled through its future
+                self.cancelled_counter += 1
+                self.logger.warning(f"Manoeuvre {self.current.name} cancelled")
+                self.current = None
+                self.__release_line_control()
+                mqtt_service.send_cmd("ti/rc", (0, 0, time()))
+
+            if self.current is None:
+                if not self.queue:
+                    return self.IDLE_TIMEOUT_SEC
+                self.current = self.queue.popleft()
+                self.current.start_time = now
+                self.line_follower.suspend()
+                self.logger.info(f"Manoeuvre {self.current.name} started: {self.current.steps}")
+                if not self.__start_step(self.current, now):
+                    return 0
+
+            manoeuvre = self.current
+            try:
+                # Steps done at once (e.g. Call) are followed by the next one in the same tick
+                while manoeuvre.steps[manoeuvre.index].poll(self, now):
+                    if self.current is not manoeuvre:
+                        return 0
+                    manoeuvre.index += 1
+                    if not self.__start_step(manoeuvre, now):
+                        return 0
+            except Exception as e:
+                if self.current is manoeuvre:
+                    self.__fail(e)
+                return 0
+            # Cancelled by the step
+            if self.current is not manoeuvre:
+                return 0
+
+            end_time = manoeuvre.steps[manoeuvre.index].end_time
+            if end_time is None:
+                return self.TICK_SEC
+            return min(self.TICK_SEC, max(0.0, end_time - now))
+
+
+    def __start_step(self, manoeuvre, now):
+        """
+        Starts the step at the manoeuvre index, finishes the manoeuvre after the last one.
+        False when it is over, also when the step cancelled it.
+        """
+        if manoeuvre.index >= len(manoeuvre.steps):
+            self.__finish(now)
+            return False
+        try:
+            manoeuvre.steps[manoeuvre.index].start(self, now)
+        except Exception as e:
+            if self.current is manoeuvre:
+                self.__fail(e)
+            return False
+        return self.current is manoeuvre
+
+
+    def __finish(self, now):
+        manoeuvre = self.current
+        self.current = None
+        self.__release_line_control()
+        duration = now - manoeuvre.start_time
+        self.completed_counter += 1
+        self.logger.info(f"Manoeuvre {manoeuvre.name} done in {duration:.2f} s")
+        manoeuvre.future.set_result(duration)
+
+
+    def __fail(self, exception):
+        manoeuvre = self.current
+        self.current = None
+        mqtt_service.send_cmd("ti/rc", (0, 0, time()))
+        self.__release_line_control()
+        self.failed_counter += 1
+        self.logger.error(f"Manoeuvre {manoeuvre.name} failed at step {manoeuvre.index}: {exception}")
+        manoeuvre.future.set_exception(exception)
+
+
+    def __release_line_control(self):
+        # Like after the blocking manoeuvres: the controller restarts when the line control is set again
+        self.line_follower.reset()
+        self.line_follower.resume()
+
+
+    def stats(self):
+        return {
+            'completed': self.completed_counter,
+            'cancelled': self.cancelled_counter,
+            'failed': self.failed_counter,
+            'timeouts': self.timeout_counter,
+            'ticks': self.tick_counter,
+            'waiting': len(self.queue),
+        }
+
+
+
+manoeuvre_engine = ManoeuvreEngine()
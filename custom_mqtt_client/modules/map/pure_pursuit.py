@@ -3,8 +3,8 @@ import os
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib import patches
-from datetime import datetime
 from libs.logger import Logger
+from libs.clock import clock
 from libs.sensors.odometry import odometry
 from libs.commands import ROBOT_set_movement
 
@@ -23,7 +23,7 @@ class PurePursuit:
         self.logger = Logger('pure_pursuit')
 
         self.v_prev_error = 0.0
-        self.prev_time = datetime.now()
+        self.prev_time = clock.now()
         self.sampling_time = 1000
         self.update_counter = 0
         self.curr_waypoint_index = 0
@@ -35,7 +35,7 @@ class PurePursuit:
 
     def reset(self):
         self.stop = False
-        self.prev_time = datetime.now()
+        self.prev_time = clock.now()
         self.sampling_time = 1000
         self.update_counter = 0
         self.animation_pose = []
@@ -56,8 +56,9 @@ class PurePursuit:
         """
         Update sampling rate estimation
         """
-        delta_t = (datetime.now() - self.prev_time).total_seconds()
-        self.prev_time = datetime.now()
+        now = clock.now()
+        delta_t = now - self.prev_time
+        self.prev_time = now
 
         if self.update_counter == 2:
             res = delta_t
@@ -240,5 +241,5 @@ class PurePursuit:
             return
 
         velocity, turnrate = self.pure_pursuit()
-        self.logger.debug(f"OUTPUT: velocity = {velocity:.3f}, turnrate = {turnrate:.3f}")
+        self.logger.debug("OUTPUT: velocity = {:.3f}, turnrate = {:.3f}", velocity, turnrate)
         ROBOT_set_movement(velocity, turnrate)
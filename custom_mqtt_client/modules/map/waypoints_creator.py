@@ -1,7 +1,6 @@
-from datetime import datetime
-from time import time
 import math
 from libs.logger import Logger
+from libs.clock import clock
 from libs.sensors.odometry import odometry
 
 
@@ -10,7 +9,7 @@ class WaypointsCreator:
 
   def __init__(self):
     self.logger = Logger('waypoint_creator')
-    self.last_write_time = datetime.now()
+    self.last_write_time = clock.now()
 
     try:
       self.file = open('modules/map/waypoints.csv', 'w', encoding="utf-8")
@@ -22,11 +21,11 @@ class WaypointsCreator:
 
 
   def handle(self, state = None):
-    delta_t = (datetime.now() - self.last_write_time).total_seconds()
-    if delta_t < self.WRITE_DT_TIME:
+    now = clock.now()
+    if now - self.last_write_time < self.WRITE_DT_TIME:
       return
 
-    self.last_write_time = datetime.now()
+    self.last_write_time = now
 
     self.logger.debug("Writing data to file")
 
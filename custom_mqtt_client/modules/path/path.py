@@ -5,11 +5,12 @@ from time import sleep
 from matplotlib.pylab import Enum
 from modules.map.waypoints_creator import WaypointsCreator
 from modules.map.pure_pursuit import PurePursuit
-from libs.logger import Logger
+from libs.logger import Logger, console
 from libs.commands import *
 from libs.sensors.ir import ir
 from modules.line_follower.line_follower import line_follower
-from modules.line_follower.line_detector import LineDetector
+from modules.line_follower.intersection_detector import intersection_detector
+from modules.line_follower.manoeuvre_engine import manoeuvre_engine, Call, FollowLine, Stop, Wait, WaitUntil
 from modules.golf_ball.golf_ball_follower import golf_ball_follower
 # from modules.hole.hole_follower import hole_follower
 
@@ -48,14 +49,18 @@ class Path:
         self.finished = False
 
         self.old_state = self.state
-        self.line_detector = LineDetector('logger')
+        # Shared with the line follower, so a sample is only detected once
+        self.line_detector = line_follower.line_detector
         self.path_logger = Logger('path')
-        self.intersection_counter = 0.5
+        # Intersections passed, the first one (intersection_map[0]) is skipped
+        self.intersection_counter = 0
         # self.pure_pursuit = PurePursuit(save_animation=True)
         # self.pure_pursuit_waypoints_creator = WaypointsCreator()
         # distance sensor initialization
 
-        self.just_handled_intersection = True
+        # Future of the running manoeuvre, and the state after it
+        self.manoeuvre = None
+        self.next_state = None
 
 
     def __log(self, state):
@@ -65,6 +70,80 @@ class Path:
             self.old_state = state
 
 
+    def __start_manoeuvre(self, name, steps, next_state=None):
+        self.manoeuvre = manoeuvre_engine.run(name, steps)
+        self.next_state = next_state
+
+
+    def __is_manoeuvring(self):
+        """
+        True while the manoeuvre engine drives the robot
+        """
+        if self.manoeuvre is None:
+            return False
+        if not self.manoeuvre.done():
+            return True
+
+        if self.manoeuvre.cancelled():
+            # Stopped, the state is kept so the manoeuvre runs again after the next start
+            self.path_logger.warning(f"Manoeuvre cancelled, staying in {self.state}")
+        elif self.manoeuvre.exception() is not None:
+            # The robot is somewhere unknown, give up the mission
+            self.path_logger.error(f"Manoeuvre failed: {self.manoeuvre.exception()}")
+            self.state = State.FINISHED
+        elif self.next_state is not None:
+            self.state = self.next_state
+        self.manoeuvre = None
+        self.next_state = None
+
+        # The lines crossed during the manoeuvre are not intersections of the map
+        intersection_detector.clear()
+        return False
+
+
+    def __basket_manoeuvre(self):
+        steps = line_follower.manoeuvre('basket')
+        steps += [
+            Stop(),
+            Wait(0.5),
+            Call(SERVO_set, 0), # lower the servo but not on the ground
+            FollowLine(0.1, duration=0.8), # move in front to bump the basket
+            # putting the servo back
+            Wait(0.5),
+            Call(SERVO_set, 90),
+            Wait(0.5),
+            Call(SERVO_off),
+        ]
+        # do a turn around
+        steps += line_follower.manoeuvre('back')
+        steps += line_follower.manoeuvre('180')
+        # move in front for a bit then turn right
+        steps.append(FollowLine(0.1, duration=0.8))
+        steps += line_follower.manoeuvre('90right')
+        return steps
+
+
+    def __axe_manoeuvre(self):
+        # go slow until the axe is in front, stop while it blocks the way, then pass it fast
+        steps = line_follower.manoeuvre('axe')
+        steps += [
+            FollowLine(0.07, until=ir.is_object_detected_in_front),
+            Stop(),
+            WaitUntil(lambda: not ir.is_object_detected_in_front()),
+            FollowLine(0.3, duration=1.0),
+        ]
+        # delete if we don't wanna do the axe also the way back
+        steps += line_follower.manoeuvre('180')
+        steps += [
+            FollowLine(0.05, until=ir.is_object_detected_in_front),
+            Stop(),
+            WaitUntil(lambda: not ir.is_object_detected_in_front()),
+            Call(print, 'Go Fast Second time'),
+            FollowLine(0.3, duration=0.8),
+        ]
+        return steps
+
+
     def handle_path(self):
         # Reset here stuff if needed (this will run once after the 1st finish)
         if self.finished:
@@ -72,6 +151,11 @@ class Path:
             line_follower.reset()
             self.finished = False
 
+        # The manoeuvre engine drives the robot until the manoeuvre is done
+        if self.__is_manoeuvring():
+            self.__log(self.state)
+            return False
+
         ############################################################
         
         if self.state == State.PURE_PURSUIT:
@@ -83,109 +167,32 @@ class Path:
 
             # self.pure_pursuit_waypoints_creator.handle()
 
+            # Followed by the line control thread
             line_follower.set_line_control(0.23)
-            line_follower.follow_line()
 
-            detect_results = self.line_detector.detect()
-            active_sensors = detect_results['active_sensors']
+            # Detected by the line control thread, only read here
+            result = self.line_detector.result
 
-            if not active_sensors:
+            if not result.active_sensors:
                 self.state = State.FINISHED
 
-            # normal intersection
-            if self.line_detector.is_intersection_detected():
-                # first intersection, turn right
-                self.intersection_counter += 0.5
-                print(f'INTERSECTION: {self.intersection_counter}')
-            # 90 degree intersection
-            elif self.line_detector.is_90_intersection_detected():
-                self.intersection_counter += 0.5
-                print(f'90 INTERSECTION: {self.intersection_counter}')
-                
-            if self.intersection_counter == int(self.intersection_counter) and self.intersection_counter > 0 and self.intersection_counter < len(self.intersection_map) and self.just_handled_intersection:
-                line_follower.handle_intersection(self.intersection_map[int(self.intersection_counter)])
-                print(f'Direction: {self.intersection_map[int(self.intersection_counter)]}')
-
-                if self.intersection_map[int(self.intersection_counter)] == 'search_ball':
-                    self.state: State = State.GOLF_BALL_FOLLOWING
-
-                if self.intersection_map[int(self.intersection_counter)] == 'basket':
-                    self.just_handled_intersection = False
-
-                    mqtt_service.send_cmd("ti/rc", f"0 0 {time()}")
-                    sleep(0.5)
-                    SERVO_set(0) #lower the servo but not on the ground
-                    
-                    # move in front for 1 sec to bump the basket
-                    str_duration = 0.8
-                    line_follower.set_line_control(0.1)
-                    start_time = time()
-                    while time() - start_time < str_duration:
-                        pass
-                    #putting the servo back
-                    sleep(0.5)
-                    SERVO_set(90)
-                    sleep(0.5)
-                    SERVO_off()
-
-                    # do a turn around
-                    line_follower.handle_intersection('back')
-                    line_follower.handle_intersection('180')
-                    # move in front for a bit then turn right
-                    str_duration = 0.8
-                    line_follower.set_line_control(0.1)
-                    start_time = time()
-                    while time() - start_time < str_duration:
-                        pass
-                    line_follower.handle_intersection('90right')
-
-                    print('resume line following')
-                    self.just_handled_intersection = True
-
-                if self.intersection_map[int(self.intersection_counter)] == 'axe':
-                    self.just_handled_intersection = False
-                    #print('go slow')
-                    line_follower.set_line_control(0.07)
-                    #mqtt_service.send_cmd("ti/rc", f"{0.05} 0 {time()}")
-                    while not ir.is_object_detected_in_front():
-                        print('OBJ not detected')
-                    
-                    while ir.is_object_detected_in_front():
-                        mqtt_service.send_cmd("ti/rc", f"0 0 {time()}")
-                        print('STOP')
-
-                    #print('Go Fast')
-                    str_duration = 1.0
-                    line_follower.set_line_control(0.3)
-                    start_time = time()
-                    while time() - start_time < str_duration:
-                        pass
-                
-                #######################
-                # delete if we don't wanna do the axe also the way back
-                    ## turning back
-                    line_follower.handle_intersection('180')
-                    ## check again for the axe
-                    
-                    line_follower.set_line_control(0.05)
-                    #mqtt_service.send_cmd("ti/rc", f"{0.05} 0 {time()}")
-                    while not ir.is_object_detected_in_front():
-                        print('OBJ2 not detected')
-                    
-                    while ir.is_object_detected_in_front():
-                        mqtt_service.send_cmd("ti/rc", f"0 0 {time()}")
-                        print('STOP2')
-
-                    print('Go Fast Second time')
-                    str_duration = 0.8
-                    line_follower.set_line_control(0.3)
-                    start_time = time()
-                    while time() - start_time < str_duration:
-                        pass
-                    self.just_handled_intersection = True
-
-
-                self.intersection_counter += 0.5
+            # Intersections are detected on every line sample, one event each
+            event = intersection_detector.pop_event()
+            if event is not None:
+                self.intersection_counter += 1
+                print(f'{event.kind.upper()} INTERSECTION: {self.intersection_counter}')
+
+            if event is not None and self.intersection_counter < len(self.intersection_map):
+                direction = self.intersection_map[self.intersection_counter]
+                print(f'Direction: {direction}')
+
+                if direction == 'basket':
+                    steps = self.__basket_manoeuvre()
+                elif direction == 'axe':
+                    steps = self.__axe_manoeuvre()
+                else:
+                    steps = line_follower.manoeuvre(direction)
+                self.__start_manoeuvre(direction, steps, State.GOLF_BALL_FOLLOWING if direction == 'search_ball' else None)
 
         ############################################################
 
@@ -200,13 +207,13 @@ class Path:
             #line_follower.handle_intersection('left')
 
             if golf_ball_follower is not None:
-                print("GOLF_BALL_FOLLOWING")
+                console.print("GOLF_BALL_FOLLOWING")
                 golf_ball_follower.set_ball_follower(0.2)
                 golf_ball_follower.follow_ball()
             else:
-                print("golf_ball_follower is not set!")
+                console.print("golf_ball_follower is not set!")
 
-            print("Distance to the ball: ", golf_ball_follower.camera_service.ball['z_mm'])
+            console.print("Distance to the ball: {}", golf_ball_follower.camera_service.ball['z_mm'])
             if golf_ball_follower.camera_service.ball['z_mm'] < 240 and golf_ball_follower.camera_service.ball['z_mm'] > 0:
                 golf_ball_follower.stop_ball_follower()
 
@@ -233,23 +240,24 @@ class Path:
         if self.state == State.HEAD_TO_HOLE:
             # Turn around 180 degrees
             self.path_logger.info('Head to hole state started')
-            line_follower.handle_intersection("turn_to_hole")
-            line_follower.handle_intersection("approach_hole")
-            line_follower.handle_intersection("wiggle")
-            sleep(0.5)
-            SERVO_set(90)
-            sleep(0.5)
-            SERVO_off()
-            line_follower.handle_intersection('90left')
-            line_follower.handle_intersection('back_to_line')
-            
-            # Go back to line following
-            self.state = State.FOLLOWING_LINE
+            steps = line_follower.manoeuvre("turn_to_hole")
+            steps += line_follower.manoeuvre("approach_hole")
+            steps += line_follower.manoeuvre("wiggle")
+            steps += [Wait(0.5), Call(SERVO_set, 90), Wait(0.5), Call(SERVO_off)]
+            steps += line_follower.manoeuvre('90left')
+            steps += line_follower.manoeuvre('back_to_line')
+
+            # Go back to line following, once the manoeuvre is done
+            self.__start_manoeuvre('head_to_hole', steps, State.FOLLOWING_LINE)
             #self.state = State.FINISHED
 
 
         ############################################################
 
+        # Intersections only count while following the line
+        if self.state != State.FOLLOWING_LINE:
+            intersection_detector.clear()
+
         self.__log(self.state)
 
         # If finished, robot returns to waiting state
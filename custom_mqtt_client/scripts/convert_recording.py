@@ -0,0 +1,25 @@
+import argparse
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+from libs.services.recorder import to_dataframe
+
+
+# Converts recordings of the Recorder (logs/data_log, logs/line_follower) to csv.
+# Example: python convert_recording.py ../logs/data_log ../logs/line_follower
+
+
+parser = argparse.ArgumentParser(description="Convert Recorder recordings (.bin + .json) to csv")
+parser.add_argument('paths', nargs='+', help="Recording paths, with or without the .bin/.json extension")
+parser.add_argument('--out-dir', type=str, default=None, help="Folder of the csv files (default: next to the recording)")
+args = parser.parse_args()
+
+
+for path in args.paths:
+    path = os.path.splitext(path)[0] if path.endswith((".bin", ".json")) else path
+    data = to_dataframe(path)
+
+    out_dir = args.out_dir if args.out_dir is not None else os.path.dirname(path)
+    csv_path = os.path.join(out_dir, os.path.basename(path) + ".csv")
+    data.to_csv(csv_path, index=False)
+    print(f"[+] {path}: {len(data)} rows -> {csv_path}")
@@ -0,0 +1,95 @@
+import argparse
+import json
+import os
+import sys
+from time import perf_counter_ns
+import numpy as np
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../../")))
+
+
+# Compares the line position estimators of the LineDetector: cost (ns/sample, batch and one sample at a time),
+# jitter (std of the change between consecutive samples) and noise (std around a moving average).
+# Recorded bags have no ground truth, the synthetic line (default without bags) also gives the error.
+# Example: python benchmark_estimators.py line_sensor_bag.json
+
+
+parser = argparse.ArgumentParser(description="Accuracy/cost benchmark of the line position estimators")
+parser.add_argument('bags', nargs='*', help="Bags saved by line_sensor_mqtt.py (json list of {timestamp, payload})")
+parser.add_argument('--samples', type=int, default=20000, help="Samples of the synthetic line (without bags)")
+parser.add_argument('--single-samples', type=int, default=2000, help="Samples timed one at a time")
+parser.add_argument('--smoothing', type=int, default=15, help="Moving average window (samples) for the noise")
+parser.add_argument('--seed', type=int, default=1)
+args = parser.parse_args()
+# libs.args parses the command line of the mqtt client when imported
+sys.argv = sys.argv[:1]
+from modules.line_follower.line_detector import ESTIMATORS, LineDetector, NUM_OF_SENSORS
+
+
+def load_bag(path):
+    with open(path, "r") as f:
+        messages = json.load(f)
+    rows = np.array([[float(x) for x in message["payload"].split()[:9]] for message in messages])
+    return rows[:, 1:], None
+
+
+def synthetic_line(samples, seed):
+    """
+    Gaussian line moving under the bar with noise, like the simulator, returns (values, true positions)
+    """
+    rng = np.random.default_rng(seed)
+    centres = 3.5 + 3 * np.sin(np.linspace(0, 20, samples))
+    sensors = np.arange(NUM_OF_SENSORS)
+    values = 60 + 940 * np.exp(-(sensors[None, :] - centres[:, None]) ** 2 / (2 * 0.8 ** 2)) + rng.normal(0, 15, (samples, NUM_OF_SENSORS))
+    return np.clip(values, 0, 1000), (centres - (NUM_OF_SENSORS - 1) / 2) / (NUM_OF_SENSORS / 2)
+
+
+def evaluate(estimator, values, truth):
+    start = perf_counter_ns()
+    positions = estimator.estimate(values)
+    batch_ns = (perf_counter_ns() - start) / len(values)
+
+    single = values[:args.single_samples]
+    start = perf_counter_ns()
+    for i in range(len(single)):
+        estimator.estimate(single[i:i + 1])
+    single_ns = (perf_counter_ns() - start) / len(single)
+
+    known = ~np.isnan(positions)
+    p = positions[known]
+    smooth = np.convolve(p, np.ones(args.smoothing) / args.smoothing, mode='same')
+    edge = args.smoothing // 2
+    result = {
+        'batch_ns': batch_ns,
+        'single_ns': single_ns,
+        'known_%': 100 * known.mean(),
+        'jitter': float(np.diff(p).std()),
+        'noise': float((p - smooth)[edge:-edge].std()),
+    }
+    if truth is not None:
+        error = p - truth[known]
+        result['bias'] = float(error.mean())
+        result['rmse'] = float(np.sqrt((error ** 2).mean()))
+    return result
+
+
+def report(name, values, truth):
+    # Only the samples the detector estimates a position for
+    detector = LineDetector(None)
+    batch = detector.detect_batch(values, np.zeros(len(values)))
+    has_line = ~np.isnan(batch.raw_positions)
+    values = values[has_line]
+    truth = truth[has_line] if truth is not None else None
+    print(f"[+] {name}: {len(values)} samples with a line")
+
+    results = {key: evaluate(estimator(), values, truth) for key, estimator in ESTIMATORS.items()}
+    columns = list(next(iter(results.values())).keys())
+    print(f"    {'estimator':12s}" + "".join(f"{column:>12s}" for column in columns))
+    for key, result in results.items():
+        print(f"    {key:12s}" + "".join(f"{result[column]:12.4f}" for column in columns))
+
+
+if args.bags:
+    for path in args.bags:
+        report(path, *load_bag(path))
+else:
+    report("synthetic line", *synthetic_line(args.samples, args.seed))
@@ -0,0 +1,60 @@
+import argparse
+import os
+import sys
+from time import perf_counter_ns
+import numpy as np
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../../")))
+
+
+# Cost per livn sample of LineDetector.detect: a new sample, and the cached result read again
+# by the other consumers of the same sample (path, intersection checks).
+# Example: python benchmark_line_detector.py --samples 100000
+
+
+parser = argparse.ArgumentParser(description="Microbenchmark of the LineDetector")
+parser.add_argument('--samples', type=int, default=20000, help="Number of simulated line samples")
+parser.add_argument('--seed', type=int, default=1)
+args = parser.parse_args()
+# libs.args parses the command line of the mqtt client when imported
+sys.argv = sys.argv[:1]
+from libs.sensors.line import line_sensor
+from modules.line_follower.line_detector import LineDetector
+
+
+# A line (gaussian over ~2 sensors) moving slowly under the bar, with noise
+rng = np.random.default_rng(args.seed)
+centres = 3.5 + 3 * np.sin(np.linspace(0, 20, args.samples))
+sensors = np.arange(line_sensor.NUM_OF_SENSORS)
+samples = 60 + 940 * np.exp(-(sensors[None, :] - centres[:, None]) ** 2 / 2) + rng.normal(0, 15, (args.samples, line_sensor.NUM_OF_SENSORS))
+samples = np.clip(samples, 0, 1000).tolist()
+
+detector = LineDetector(None)
+
+
+def measure(name, function):
+    times = np.empty(len(samples))
+    for i, values in enumerate(samples):
+        # A new sample from the MQTT thread
+        line_sensor.values[:] = line_sensor.values.__class__('d', values)
+        line_sensor.update_count += 1
+        start = perf_counter_ns()
+        function()
+        times[i] = perf_counter_ns() - start
+    print(f"[+] {name:40s} mean {times.mean() / 1000:6.2f} us, p99 {np.percentile(times, 99) / 1000:6.2f} us")
+
+
+def consumers():
+    # Line follower, path and the intersection checks on the same sample
+    detector.detect()
+    detector.detect()
+    detector.is_intersection_detected()
+    detector.is_90_intersection_detected()
+
+
+measure("detect (new sample)", detector.detect)
+measure("detect + 3 cached reads (per sample)", consumers)
+
+start = perf_counter_ns()
+for _ in range(len(samples)):
+    detector.detect()
+print(f"[+] {'cached read':40s} mean {(perf_counter_ns() - start) / len(samples) / 1000:6.2f} us")
@@ -0,0 +1,76 @@
+import argparse
+import json
+import os
+import sys
+from time import perf_counter
+import numpy as np
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../../")))
+
+
+# Replays recorded livn samples through LineDetector.detect_batch, with the current thresholds and with changed ones.
+# Record a bag with: python line_sensor_mqtt.py --save
+# Example: python evaluate_line_detector.py line_sensor_bag.json --valid-threshold 650 --crossing-threshold 850
+
+
+parser = argparse.ArgumentParser(description="Offline evaluation of the LineDetector thresholds on recorded livn data")
+parser.add_argument('bags', nargs='+', help="Bags saved by line_sensor_mqtt.py (json list of {timestamp, payload})")
+parser.add_argument('--crossing-threshold', type=float, default=None, help="Candidate LINE_CROSSING_THRESHOLD")
+parser.add_argument('--valid-threshold', type=float, default=None, help="Candidate LINE_VALID_THRESHOLD")
+parser.add_argument('--min-max-delta', type=float, default=None, help="Candidate MIN_MAX_DELTA_THRESHOLD")
+args = parser.parse_args()
+# libs.args parses the command line of the mqtt client when imported
+sys.argv = sys.argv[:1]
+from modules.line_follower.line_detector import LineDetector
+
+
+def load_bag(path):
+    """
+    Returns (values (N, 8), timestamps (N,)), the timestamp is the teensy_interface time in the payload
+    """
+    with open(path, "r") as f:
+        messages = json.load(f)
+    rows = np.array([[float(x) for x in message["payload"].split()[:9]] for message in messages])
+    return rows[:, 1:], rows[:, 0]
+
+
+def rising_edges(flags):
+    return int(np.count_nonzero(flags[1:] & ~flags[:-1]) + (1 if len(flags) > 0 and flags[0] else 0))
+
+
+def evaluate(detector, values, timestamps):
+    start = perf_counter()
+    batch = detector.detect_batch(values, timestamps)
+    elapsed = perf_counter() - start
+
+    positions = batch.raw_positions[~np.isnan(batch.raw_positions)]
+    return {
+        'detect_ms': elapsed * 1000,
+        'valid_%': 100 * batch.is_line_valid.mean(),
+        'crossings': rising_edges(batch.is_crossing_line),
+        'intersections': rising_edges(batch.is_intersection),
+        '90_intersections': rising_edges(batch.is_90_intersection),
+        'line_lost': rising_edges(batch.time_since_valid >= detector.MAX_TIME_LINE_LOST),
+        'position_jitter': float(np.diff(positions).std()) if len(positions) > 2 else float('nan'),
+    }
+
+
+candidate = LineDetector(None)
+if args.crossing_threshold is not None:
+    candidate.LINE_CROSSING_THRESHOLD = args.crossing_threshold
+if args.valid_threshold is not None:
+    candidate.LINE_VALID_THRESHOLD = args.valid_threshold
+if args.min_max_delta is not None:
+    candidate.MIN_MAX_DELTA_THRESHOLD = args.min_max_delta
+
+for path in args.bags:
+    start = perf_counter()
+    values, timestamps = load_bag(path)
+    load_time = perf_counter() - start
+    duration = timestamps[-1] - timestamps[0] if len(timestamps) > 1 else 0.0
+    print(f"[+] {path}: {len(values)} samples, {duration:.1f} sec of data, loaded in {load_time * 1000:.0f} ms")
+
+    current = evaluate(LineDetector(None), values, timestamps)
+    changed = evaluate(candidate, values, timestamps)
+    print(f"    {'':18s} {'current':>12s} {'candidate':>12s}")
+    for key in current:
+        print(f"    {key:18s} {current[key]:12.3f} {changed[key]:12.3f}")
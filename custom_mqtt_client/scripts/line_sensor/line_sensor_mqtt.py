@@ -90,7 +90,7 @@ def on_message(client, userdata, msg):
         
         # Choose one of the methods to use as the position
         pp = {
-            'line_detector': res['position'],
+            'line_detector': res.position,
             # 'weighted_avg_pos': weighted_avg_pos,
             # 'quadratic_interp_pos': quadratic_interp_pos,
         }
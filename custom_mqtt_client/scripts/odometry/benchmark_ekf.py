@@ -0,0 +1,78 @@
+import argparse
+import math
+import os
+import random
+import sys
+from time import perf_counter
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../../")))
+
+
+# Cost per sample of the odometry EKF (it runs on the paho thread) and its error on a simulated drive.
+# Example: python benchmark_ekf.py --duration 60
+
+
+parser = argparse.ArgumentParser(description="Benchmark of the odometry EKF")
+parser.add_argument('--duration', type=float, default=30.0, help="Simulated drive (sec)")
+parser.add_argument('--vel-rate', type=float, default=50.0, help="T0/vel rate (Hz)")
+parser.add_argument('--gyro-rate', type=float, default=100.0, help="T0/gyro rate (Hz)")
+parser.add_argument('--seed', type=int, default=1)
+args = parser.parse_args()
+# libs.args parses the command line of the mqtt client when imported
+sys.argv = sys.argv[:1]
+from libs.sensors.odometry import PoseEkf
+
+WHEEL_BASE = 0.23
+random.seed(args.seed)
+
+
+def motion(t):
+    # Velocity (m/s) and turnrate (rad/s): straight, curve, turn on the spot
+    phase = t % 6
+    if phase < 2:
+        return 0.3, 0.0
+    if phase < 4:
+        return 0.2, 0.8
+    return 0.0, -1.5
+
+
+# Measurements of both streams, merged in time order
+samples = []
+for i in range(int(args.duration * args.vel_rate)):
+    t = i / args.vel_rate
+    v, w = motion(t)
+    left = v - w * WHEEL_BASE / 2 + random.gauss(0, 0.02)
+    right = v + w * WHEEL_BASE / 2 + random.gauss(0, 0.02)
+    samples.append((t, 'vel', left, right))
+for i in range(int(args.duration * args.gyro_rate)):
+    t = i / args.gyro_rate
+    samples.append((t + 0.0005, 'gyro', motion(t)[1] + random.gauss(0, 0.02), 0))
+samples.sort()
+
+# Ground truth
+x = y = heading = 0.0
+dt = 0.001
+for i in range(int(args.duration / dt)):
+    v, w = motion(i * dt)
+    x += v * math.cos(heading) * dt
+    y += v * math.sin(heading) * dt
+    heading += w * dt
+
+ekf = PoseEkf()
+times = {'vel': [], 'gyro': []}
+for t, kind, a, b in samples:
+    start = perf_counter()
+    if kind == 'vel':
+        ekf.update_wheels(t, a, b, WHEEL_BASE)
+    else:
+        ekf.update_gyro(t, a)
+    times[kind].append(perf_counter() - start)
+
+for kind, values in times.items():
+    values.sort()
+    print(f"[+] {kind:4s} {len(values)} samples: mean {sum(values) / len(values) * 1e6:.1f} us, "
+          f"p99 {values[int(len(values) * 0.99)] * 1e6:.1f} us, max {values[-1] * 1e6:.1f} us")
+
+state = ekf.state
+print(f"[+] End pose x {state[0]:.3f} y {state[1]:.3f} heading {state[2]:.3f}, truth x {x:.3f} y {y:.3f} heading {heading:.3f}")
+print(f"[+] Position error {math.hypot(state[0] - x, state[1] - y):.3f} m, heading error {state[2] - heading:.4f} rad")
+print(f"[+] Position std {math.sqrt(ekf.covariance[0, 0]):.3f} m, {math.sqrt(ekf.covariance[1, 1]):.3f} m, heading std {math.sqrt(ekf.covariance[2, 2]):.4f} rad")
@@ -1,8 +1,11 @@
-import pandas as pd
+import os
+import sys
 import matplotlib.pyplot as plt
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+from libs.services.recorder import to_dataframe
 
-# Read the CSV file, skipping lines that start with '#'
-data = pd.read_csv('../logs/data_log.csv', comment='#', skipinitialspace=True)
+# Read the recording of the data logger
+data = to_dataframe('../logs/data_log')
 
 # Plot x and y positions
 plt.figure(figsize=(10, 5))
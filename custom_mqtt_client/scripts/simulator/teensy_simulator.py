@@ -0,0 +1,42 @@
+import argparse
+import json
+import os
+import sys
+from time import sleep
+import paho.mqtt.client as mqtt
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../../")))
+from libs.simulation.teensy_simulator import TeensySimulator
+
+
+# Runs the simulated Teensy against a real broker, start the mqtt client (main.py) on the same broker.
+# Example stress test: python teensy_simulator.py --rate-scale 10 --duration 30
+
+
+parser = argparse.ArgumentParser(description="Simulated Teensy / teensy_interface")
+parser.add_argument('--broker', type=str, default="localhost", help="MQTT broker host (default: localhost)")
+parser.add_argument('--port', type=int, default=1883, help="MQTT broker port (default: 1883)")
+parser.add_argument('--rate-scale', type=float, default=1.0, help="Multiply every topic rate, e.g. 10 for a stress test")
+parser.add_argument('--duration', type=float, default=0, help="Stop after this many seconds (default: run until Ctrl+C)")
+parser.add_argument('--report-interval', type=float, default=5.0, help="Print statistics every n seconds")
+args = parser.parse_args()
+
+
+client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+client.connect(args.broker, args.port, 60)
+
+simulator = TeensySimulator(client, rate_scale=args.rate_scale)
+simulator.start()
+print(f"[+] Simulating Teensy on {args.broker}:{args.port} (rate x{args.rate_scale})")
+
+elapsed = 0
+try:
+    while args.duration == 0 or elapsed < args.duration:
+        sleep(args.report_interval)
+        elapsed += args.report_interval
+        print(json.dumps(simulator.stats(), indent=2))
+except KeyboardInterrupt:
+    pass
+
+simulator.stop()
+client.loop_stop()
+print(json.dumps(simulator.stats(), indent=2))
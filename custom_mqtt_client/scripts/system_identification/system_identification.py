@@ -40,8 +40,8 @@ def on_message(client, userdata, msg):
     
     if msg.topic in TOPICS:
         res = line_detector.detect(sensor_values)
-        positions.append((time(), turnrate, res['position']))
-        f.write(f"{time()} {turnrate} {res['position']}\n")
+        positions.append((time(), turnrate, res.position))
+        f.write(f"{time()} {turnrate} {res.position}\n")
 
 
 # Setup MQTT client